@@ -1,18 +1,138 @@
 import asyncio
+import contextlib
 import datetime
+import importlib.util
 import logging
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from urllib.parse import urlencode
 
 import aiohttp
 
 from SearchAnalyzer.http_mode import get_GET_params_for_search_engine, headers
 from SearchAnalyzer.output_converter import store_serp_result
-from SearchAnalyzer.parser.tools import get_parser_by_search_engine, parse_serp
-from SearchAnalyzer.scraping import get_base_search_url_by_search_engine
+from SearchAnalyzer.parser.tools import parse_html, parse_serp
+from SearchAnalyzer.proxy_pool import proxy_name
+from SearchAnalyzer.rate_limiting import RateLimiter
+from SearchAnalyzer.scraping import detect_block, get_base_search_url_by_search_engine
 from SearchAnalyzer.utils import get_some_words
 
+"""
+Scrapes in a single thread with asyncio and aiohttp.
+
+All requests go through one long-lived aiohttp.ClientSession, such that the connections
+to the search engines are kept alive. At most `max_concurrent_requests` requests are in
+flight: the requests don't run in waves, a new one is started as soon as any finished,
+so a slow response only holds up its own slot. Every request is given up after
+`async_request_timeout` seconds.
+
+The SERP pages are not parsed on the event loop, which would stall all requests in
+flight while lxml is busy. They are parsed by a pool of `async_parse_workers` processes
+(or threads with `async_parse_executor = 'thread'`). At most `async_parse_queue_size`
+pages wait for or are being parsed; when the parsers fall behind, the requests that
+are done hold on to their slot in the window, so no new requests are started.
+
+The requests are spread over the proxies round-robin, with at most
+`max_concurrent_requests_per_proxy` requests in flight per proxy. They are paced per
+search engine and proxy by the RateLimiter, which slows down when a search engine
+blocks requests, see rate_limiting.py. Every proxy has its
+own session. HTTP proxies are supported by aiohttp, SOCKS proxies need the optional
+aiohttp_socks package. The SERPs record the proxy that served them in `requested_by`.
+
+The scrape jobs are taken in a separate thread, because looking them up in the cache
+replays the cached pages, which would stall the requests in flight as well.
+
+When the scraping is cancelled, e.g. with Ctrl-C, no new requests are started, the
+running ones are cancelled and the SERPs that were scraped so far are kept.
+"""
+
 logger = logging.getLogger(__name__)
 
+# The state of the workers of the parse pool
+_parse_config = None
+
+
+def _init_parse_worker(config):
+    global _parse_config
+    _parse_config = config
+
+
+def _parse_page(html, search_engine, query):
+    """Parse a SERP page in a worker of the parse pool."""
+    return parse_html(_parse_config, html, search_engine, query)
+
+
+def get_parse_executor(config):
+    """The executor that parses the SERP pages of the asynchronous mode.
+
+    Returns:
+        A ProcessPoolExecutor or a ThreadPoolExecutor if `async_parse_executor` is 'thread'.
+    """
+    num_workers = int(config.get('async_parse_workers', 0)) or os.cpu_count() or 1
+    if config.get('async_parse_executor', 'process') == 'thread':
+        return ThreadPoolExecutor(max_workers=num_workers, initializer=_init_parse_worker, initargs=(config,))
+    return ProcessPoolExecutor(max_workers=num_workers, initializer=_init_parse_worker, initargs=(config,))
+
+
+def proxy_supported(proxy):
+    """Whether the asynchronous mode can request through the proxy, None is the own ip."""
+    if proxy is None or proxy.proto == 'http':
+        return True
+    if proxy.proto in ('socks4', 'socks5'):
+        return importlib.util.find_spec('aiohttp_socks') is not None
+    return False
+
+
+class ProxySession(object):
+    """The aiohttp session that requests through a proxy, or directly if the proxy is None."""
+
+    def __init__(self, proxy):
+        """Prepare the session, open() creates it.
+
+        Args:
+            proxy: A proxies.Proxy or None.
+        """
+        self.proxy = proxy
+        self.name = proxy_name(proxy)
+        self.session = None
+        # the additional arguments of session.get()
+        self.request_kwargs = {}
+        # the errors of the proxy that aiohttp doesn't wrap in a ClientError
+        self.errors = ()
+
+        if proxy and proxy.proto == 'http':
+            self.request_kwargs['proxy'] = 'http://{}:{}'.format(proxy.host, proxy.port)
+            if proxy.username:
+                self.request_kwargs['proxy_auth'] = aiohttp.BasicAuth(proxy.username, proxy.password or '')
+
+    def connector(self, limit):
+        if self.proxy and self.proxy.proto in ('socks4', 'socks5'):
+            from aiohttp_socks import ProxyConnector, ProxyType
+            from python_socks import ProxyError
+
+            self.errors = (ProxyError,)
+            proxy_type = ProxyType.SOCKS5 if self.proxy.proto == 'socks5' else ProxyType.SOCKS4
+            return ProxyConnector(proxy_type=proxy_type, host=self.proxy.host, port=int(self.proxy.port),
+                                  username=self.proxy.username or None, password=self.proxy.password or None,
+                                  rdns=True, limit=limit)
+        return aiohttp.TCPConnector(limit=limit)
+
+    def open(self, limit, timeout):
+        """Create the session.
+
+        Args:
+            limit: The maximum number of connections.
+            timeout: The aiohttp.ClientTimeout of the requests.
+
+        Returns:
+            The aiohttp.ClientSession, close it when done.
+        """
+        self.session = aiohttp.ClientSession(connector=self.connector(limit), timeout=timeout)
+        return self.session
+
+
 class AsyncHttpScrape(object):
     """Scrape asynchronously using asyncio.
     
@@ -33,44 +153,67 @@ class AsyncHttpScrape(object):
         self.scrape_method = scrape_method
         self.requested_at = None
         self.requested_by = 'localhost'
-        self.parser = get_parser_by_search_engine(self.search_engine_name)
+        self.html = None
+        # whether the search engine blocked the request, None without a response
+        self.blocked = None
+        # the ParseResult once the page is parsed
+        self.parser = None
         self.base_search_url = get_base_search_url_by_search_engine(self.config, self.search_engine_name, 'http')
         self.params = get_GET_params_for_search_engine(self.query, self.search_engine_name,
-                                                       search_type=self.search_type)
+                                                       page_number=self.page_number, search_type=self.search_type)
         self.headers = headers
         self.status = 'successful'
 
-    def __call__(self):
-
-        @asyncio.coroutine
-        def request():
-            url = self.base_search_url + urlencode(self.params)
-
-            response = yield from aiohttp.request('GET', url, params=self.params, headers=self.headers)
-
-            if response.status != 200:
-                self.status = 'not successful: ' + str(response.status)
+    async def __call__(self, session, timeout=None, **kwargs):
+        """Request the SERP page.
 
-            self.requested_at = datetime.datetime.utcnow()
-
-            logger.info('[+] {} requested keyword \'{}\' on {}. Response status: {}'.format(
-                self.requested_by,
-                self.query,
-                self.search_engine_name,
-                response.status))
-
-            logger.debug('[i] URL: {} HEADERS: {}'.format(
-                url,
-                self.headers))
-
-            if response.status == 200:
-                body = yield from response.text()
-                self.parser = self.parser(config=self.config, html=body)
-                return self
+        Args:
+            session: The aiohttp.ClientSession to request with.
+            timeout: The aiohttp.ClientTimeout of the request, None for the one of the session.
+            kwargs: More arguments of session.get(), like the proxy.
 
+        Returns:
+            self with the `html` of the page, None if the request failed.
+        """
+        url = self.base_search_url + urlencode(self.params)
+        # aiohttp takes timeout=None as no timeout at all
+        if timeout:
+            kwargs['timeout'] = timeout
+
+        try:
+            async with session.get(url, headers=self.headers, **kwargs) as response:
+                self.requested_at = datetime.datetime.utcnow()
+
+                logger.info('[+] {} requested keyword \'{}\' on {}. Response status: {}'.format(
+                    self.requested_by,
+                    self.query,
+                    self.search_engine_name,
+                    response.status))
+
+                logger.debug('[i] URL: {} HEADERS: {}'.format(
+                    url,
+                    self.headers))
+
+                if response.status != 200:
+                    self.blocked = detect_block(self.search_engine_name, response.status, str(response.url))
+                    self.status = 'not successful: ' + str(response.status)
+                    return None
+
+                self.html = await response.text()
+                self.blocked = detect_block(self.search_engine_name, response.status, str(response.url), self.html)
+                if self.blocked:
+                    self.status = 'Malicious request detected'
+                    return None
+        except asyncio.TimeoutError:
+            self.status = 'Connection timeout'
+            logger.warning('Timeout while requesting \'{}\' on {}.'.format(self.query, self.search_engine_name))
+            return None
+        except (aiohttp.ClientError, OSError) as e:
+            self.status = 'Network problem occurred {}'.format(e)
+            logger.warning('Cannot request \'{}\' on {}: {}'.format(self.query, self.search_engine_name, e))
             return None
 
-        return request
+        return self
 
 
 class AsyncScrapeScheduler(object):
@@ -78,67 +221,172 @@ class AsyncScrapeScheduler(object):
     Processes the single requests in an asynchronous way.
     """
 
-    def __init__(self, config, scrape_jobs, cache_manager=None, session=None, scraper_search=None, db_lock=None):
+    def __init__(self, config, scrape_jobs, cache_manager=None, session=None, scraper_search=None, db_lock=None,
+                 persistence=None, proxies=None, rate_limiter=None):
         self.cache_manager = cache_manager
         self.config = config
-        self.max_concurrent_requests = self.config.get('max_concurrent_requests')
-        self.scrape_jobs = scrape_jobs
+        self.max_concurrent_requests = int(self.config.get('max_concurrent_requests', 100))
+        self.max_concurrent_per_proxy = int(self.config.get('max_concurrent_requests_per_proxy', 0)) or \
+            self.max_concurrent_requests
+        self.request_timeout = float(self.config.get('async_request_timeout', 15))
+        self.parse_queue_size = int(self.config.get('async_parse_queue_size', 100))
+        self.scrape_jobs = iter(scrape_jobs)
         self.session = session
         self.scraper_search = scraper_search
         self.db_lock = db_lock
-
-        self.loop = asyncio.get_event_loop()
-        self.requests = []
-        self.results = []
-
-    def get_requests(self):
-
-        self.requests = []
-        request_number = 0
-
-        while True:
-            request_number += 1
-            try:
-                job = self.scrape_jobs.pop()
-            except IndexError:
-                break
-
-            if job:
-                self.requests.append(AsyncHttpScrape(self.config, **job))
-
-            if request_number >= self.max_concurrent_requests:
-                break
+        self.persistence = persistence
+        # the session is used by the thread that takes the scrape jobs, too
+        self.session_lock = threading.Lock()
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter(self.config)
+
+        self.proxies = []
+        for proxy in proxies or [None]:
+            if proxy_supported(proxy):
+                self.proxies.append(proxy)
+            elif proxy.proto in ('socks4', 'socks5'):
+                logger.warning('Skipping proxy {}:{}, install aiohttp_socks to use SOCKS proxies in http-async mode.'
+                               .format(proxy.host, proxy.port))
+            else:
+                logger.warning('Skipping proxy {}:{}, protocol {} is not supported in http-async mode.'.format(
+                    proxy.host, proxy.port, proxy.proto))
+        if not self.proxies:
+            raise ValueError('None of the proxies can be used in http-async mode.')
+
+        self.num_requests = 0
+        self.num_scraped = 0
 
     def run(self):
+        """Scrape all jobs, returns when they are done or the scraping was cancelled."""
+        started = time.time()
+        executor = get_parse_executor(self.config)
+        try:
+            asyncio.run(self.scrape_all(executor))
+        except KeyboardInterrupt:
+            logger.warning('Scraping cancelled, stored the {} SERPs that were scraped so far.'.format(self.num_scraped))
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+        logger.info('Scraped {} of {} requested pages in {:.1f}s.'.format(self.num_scraped, self.num_requests,
+                                                                         time.time() - started))
+
+    async def scrape_all(self, executor):
+        """Keep `max_concurrent_requests` requests in flight until all jobs are requested.
+
+        Args:
+            executor: The executor that parses the SERP pages.
+        """
+        window = asyncio.Semaphore(self.max_concurrent_requests)
+        parse_queue = asyncio.Semaphore(self.parse_queue_size)
+        timeout = aiohttp.ClientTimeout(total=self.request_timeout)
+        running = set()
+        loop = asyncio.get_running_loop()
+        job_reader = ThreadPoolExecutor(max_workers=1)
+
+        # a free slot of a proxy is a place in the queue, they are interleaved to take turns
+        proxies = [ProxySession(proxy) for proxy in self.proxies]
+        free_proxies = asyncio.Queue()
+        for _ in range(self.max_concurrent_per_proxy):
+            for proxy in proxies:
+                free_proxies.put_nowait(proxy)
+
+        async with contextlib.AsyncExitStack() as sessions:
+            for proxy in proxies:
+                await sessions.enter_async_context(proxy.open(self.max_concurrent_per_proxy, timeout))
 
-        while True:
-            self.get_requests()
-
-            if not self.requests:
-                break
-
-            self.results = self.loop.run_until_complete(asyncio.wait([r()() for r in self.requests]))
-
-            for task in self.results[0]:
-                scrape = task.result()
-
-                if scrape:
-
-                    if self.cache_manager:
-                        self.cache_manager.cache_results(scrape.parser, scrape.query, scrape.search_engine_name, scrape.scrape_method,
-                                      scrape.page_number)
-
-                    if scrape.parser:
-                        serp = parse_serp(self.config, parser=scrape.parser, scraper=scrape, query=scrape.query)
-
-                        if self.scraper_search:
-                            self.scraper_search.serps.append(serp)
-
-                        if self.session:
-                            self.session.add(serp)
-                            self.session.commit()
-
-                        store_serp_result(serp, self.config)
+            try:
+                while True:
+                    job = await loop.run_in_executor(job_reader, self.next_job)
+                    if job is None:
+                        break
+                    # wait for a free slot
+                    await window.acquire()
+                    task = asyncio.ensure_future(self.scrape(free_proxies, window, job, executor, parse_queue))
+                    running.add(task)
+                    task.add_done_callback(running.discard)
+
+                if running:
+                    await asyncio.gather(*running)
+            finally:
+                for task in running:
+                    task.cancel()
+                await asyncio.gather(*running, return_exceptions=True)
+                job_reader.shutdown(wait=True)
+
+    def next_job(self):
+        """Take the next scrape job, called in the job reader thread.
+
+        Returns:
+            The scrape job or None if there are no more.
+        """
+        with self.session_lock:
+            for job in self.scrape_jobs:
+                if job:
+                    return job
+        return None
+
+    async def scrape(self, free_proxies, window, job, executor, parse_queue):
+        """Scrape a single job and free its slot in the window once the page is parsed."""
+        try:
+            self.num_requests += 1
+            scrape = AsyncHttpScrape(self.config, **job)
+
+            proxy = await free_proxies.get()
+            try:
+                scrape.requested_by = proxy.name
+                await self.rate_limiter.wait_async(scrape.search_engine_name, proxy.name)
+                scraped = await scrape(proxy.session, **proxy.request_kwargs)
+            except proxy.errors as e:
+                logger.warning('Proxy {} failed: {}'.format(proxy.name, e))
+                scraped = None
+            finally:
+                free_proxies.put_nowait(proxy)
+
+            if scrape.blocked is not None:
+                self.rate_limiter.feedback(scrape.search_engine_name, proxy.name, scrape.blocked)
+
+            scrape = scraped
+            if scrape:
+                async with parse_queue:
+                    scrape = await self.parse(executor, scrape)
+            if scrape:
+                self.store(scrape)
+        finally:
+            window.release()
+
+    async def parse(self, executor, scrape):
+        """Parse the page of a scrape in the executor.
+
+        Returns:
+            The scrape with its ParseResult as `parser`, None if the page cannot be parsed.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            scrape.parser = await loop.run_in_executor(executor, _parse_page, scrape.html, scrape.search_engine_name,
+                                                       scrape.query)
+        except Exception as e:
+            logger.warning('Cannot parse the page of \'{}\' on {}: {}'.format(scrape.query, scrape.search_engine_name, e))
+            return None
+        return scrape
+
+    def store(self, scrape):
+        if self.cache_manager:
+            self.cache_manager.cache_page(scrape.html, scrape.parser, scrape.query, scrape.search_engine_name,
+                                          scrape.scrape_method, scrape.page_number)
+
+        serp = parse_serp(self.config, parser=scrape.parser, scraper=scrape, query=scrape.query)
+
+        if self.persistence:
+            self.persistence.put(serp)
+        else:
+            with self.session_lock:
+                if self.scraper_search:
+                    self.scraper_search.serps.append(serp)
+                if self.session:
+                    self.session.add(serp)
+                    self.session.commit()
+
+        store_serp_result(serp, self.config)
+        self.num_scraped += 1
 
 
 if __name__ == '__main__':
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+
+import bz2
+import gzip
+import logging
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+from collections import Counter, defaultdict
+
+"""
+Dictionary compression for cached SERP pages.
+
+SERP pages of the same search engine share most of their markup. Compressing each
+page on its own (gz, bz2) pays for this boilerplate over and over again. With the
+compression algorithm 'zdict', a preset dictionary is trained for every search engine
+from the first pages that are cached for it, and all further pages are deflated
+against that dictionary (zlib's preset dictionary support).
+
+Dictionaries are stored in {cachedir}/dictionaries/{search_engine}.{version}.zdict
+and are never modified. Every compressed entry starts with a small header that
+records the search engine and the dictionary version, so entries written with an
+older dictionary can still be read after a dictionary has been retrained.
+"""
+
+logger = logging.getLogger(__name__)
+
+# magic, length of the search engine name, dictionary version
+ZDICT_HEADER = struct.Struct('<4sBI')
+ZDICT_MAGIC = b'SAZD'
+
+# deflate can't look back further than 32kb, so larger dictionaries are useless.
+MAX_DICTIONARY_SIZE = 32 * 1024
+
+# the chunks of markup a dictionary is assembled from. Each chunk ends
+# with a closing angle bracket.
+CHUNK_RE = re.compile(rb'[^>]{1,256}>')
+
+
+class NoSuchDictionaryException(Exception):
+    pass
+
+
+def train_dictionary(samples, size=MAX_DICTIONARY_SIZE):
+    """Build a preset dictionary from sample pages.
+
+    zlib has no dictionary trainer, so we assemble the dictionary from the chunks of
+    markup that appear in most of the samples. Chunks that save the most bytes are put
+    at the end of the dictionary, because deflate encodes short distances cheaper.
+
+    Args:
+        samples: A list of SERP pages (bytes) of the same search engine.
+        size: The maximum size of the dictionary in bytes.
+
+    Returns:
+        The dictionary as bytes.
+    """
+    size = min(size, MAX_DICTIONARY_SIZE)
+    document_frequency = Counter()
+    for sample in samples:
+        document_frequency.update(set(CHUNK_RE.findall(sample)))
+
+    # only markup that repeats across pages is worth it
+    min_frequency = 2 if len(samples) > 1 else 1
+    candidates = [chunk for chunk, freq in document_frequency.items() if freq >= min_frequency]
+    candidates.sort(key=lambda chunk: document_frequency[chunk] * len(chunk), reverse=True)
+
+    chosen = []
+    total = 0
+    for chunk in candidates:
+        if total + len(chunk) > size:
+            continue
+        chosen.append(chunk)
+        total += len(chunk)
+
+    return b''.join(reversed(chosen))
+
+
+class DictionaryStore(object):
+    """Loads and saves the dictionaries of all search engines."""
+
+    file_re = re.compile(r'^(?P<engine>.+)\.(?P<version>\d+)\.zdict$')
+
+    def __init__(self, path):
+        self.path = path
+        self.dictionaries = {}
+        self.latest = None
+        self.lock = threading.Lock()
+
+    def _path(self, search_engine, version):
+        return os.path.join(self.path, '{}.{:04d}.zdict'.format(search_engine, version))
+
+    def _scan(self):
+        latest = {}
+        if os.path.isdir(self.path):
+            for fname in os.listdir(self.path):
+                match = self.file_re.match(fname)
+                if match:
+                    engine, version = match.group('engine'), int(match.group('version'))
+                    latest[engine] = max(version, latest.get(engine, 0))
+        self.latest = latest
+
+    def latest_version(self, search_engine):
+        """The newest dictionary version of the search engine or None."""
+        with self.lock:
+            if self.latest is None:
+                self._scan()
+            return self.latest.get(search_engine)
+
+    def get(self, search_engine, version):
+        """Returns the dictionary.
+
+        Raises:
+            NoSuchDictionaryException if the dictionary is missing.
+        """
+        key = (search_engine, version)
+        with self.lock:
+            if key not in self.dictionaries:
+                try:
+                    with open(self._path(search_engine, version), 'rb') as fd:
+                        self.dictionaries[key] = fd.read()
+                except FileNotFoundError:
+                    raise NoSuchDictionaryException('No dictionary version {} for {} in {}'.format(
+                        version, search_engine, self.path))
+            return self.dictionaries[key]
+
+    def add(self, search_engine, dictionary):
+        """Save a new dictionary version for the search engine.
+
+        Returns:
+            The version of the new dictionary.
+        """
+        os.makedirs(self.path, exist_ok=True)
+
+        with self.lock:
+            if self.latest is None:
+                self._scan()
+            version = self.latest.get(search_engine, 0) + 1
+
+            while True:
+                try:
+                    # another process might have trained a dictionary concurrently
+                    fd = os.open(self._path(search_engine, version), os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+                    break
+                except FileExistsError:
+                    version += 1
+
+            with os.fdopen(fd, 'wb') as f:
+                f.write(dictionary)
+
+            self.dictionaries[(search_engine, version)] = dictionary
+            self.latest[search_engine] = version
+
+        return version
+
+
+def zdict_compress(data, search_engine, version, dictionary, level=9):
+    """Deflate data against a preset dictionary and prepend the zdict header."""
+    engine = search_engine.encode()
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, 9, zlib.Z_DEFAULT_STRATEGY, dictionary)
+    return ZDICT_HEADER.pack(ZDICT_MAGIC, len(engine), version) + engine + compressor.compress(data) + \
+        compressor.flush()
+
+
+def zdict_header(raw):
+    """Returns the tuple (search engine, dictionary version, offset of the deflate stream)."""
+    magic, engine_len, version = ZDICT_HEADER.unpack_from(raw)
+    if magic != ZDICT_MAGIC:
+        raise ValueError('Not a zdict compressed entry')
+    offset = ZDICT_HEADER.size + engine_len
+    return raw[ZDICT_HEADER.size:offset].decode(), version, offset
+
+
+def zdict_decompress(raw, dictionary, offset):
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS, dictionary)
+    return decompressor.decompress(raw[offset:]) + decompressor.flush()
+
+
+class DictionaryCompressor(object):
+    """Compresses SERP pages with the dictionary of their search engine.
+
+    Until enough pages of a search engine were seen to train its first dictionary,
+    pages are gzipped. After `retrain_after` pages were compressed with a dictionary,
+    the next pages are collected as samples for a new dictionary version.
+    """
+
+    def __init__(self, store, dictionary_size=MAX_DICTIONARY_SIZE, num_samples=100, retrain_after=0, level=9):
+        self.store = store
+        self.dictionary_size = dictionary_size
+        self.num_samples = num_samples
+        self.retrain_after = retrain_after
+        self.level = level
+
+        self.samples = defaultdict(list)
+        self.num_compressed = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def _maybe_train(self, data, search_engine, version):
+        """Collect data as sample and train a new dictionary when there are enough of them.
+
+        Returns:
+            The dictionary version to use.
+        """
+        with self.lock:
+            needs_samples = version is None or \
+                (self.retrain_after and self.num_compressed[search_engine] >= self.retrain_after)
+            if not needs_samples:
+                self.num_compressed[search_engine] += 1
+                return version
+
+            self.samples[search_engine].append(data)
+            if len(self.samples[search_engine]) < self.num_samples:
+                return version
+
+            samples = self.samples.pop(search_engine)
+            self.num_compressed[search_engine] = 0
+
+        dictionary = train_dictionary(samples, self.dictionary_size)
+        version = self.store.add(search_engine, dictionary)
+        logger.info('Trained compression dictionary version {} for {} from {} pages ({} bytes)'.format(
+            version, search_engine, len(samples), len(dictionary)))
+        return version
+
+    def compress(self, data, search_engine):
+        """Compress data for the search engine.
+
+        Returns:
+            The tuple (compressed data, compression algorithm).
+        """
+        version = self._maybe_train(data, search_engine, self.store.latest_version(search_engine))
+        if version is None:
+            return gzip.compress(data), 'gz'
+
+        dictionary = self.store.get(search_engine, version)
+        return zdict_compress(data, search_engine, version, dictionary, self.level), 'zdict'
+
+    def decompress(self, raw):
+        search_engine, version, offset = zdict_header(raw)
+        return zdict_decompress(raw, self.store.get(search_engine, version), offset)
+
+
+def benchmark_compression(pages, dictionary_size=MAX_DICTIONARY_SIZE):
+    """Compare gz, bz2 and dictionary compression on SERP pages.
+
+    The dictionary is trained on the first half of the pages and all algorithms are
+    measured on the second half.
+
+    Args:
+        pages: A list of SERP pages (bytes).
+
+    Returns:
+        A dict that maps the algorithm name to a dict with the keys
+        'ratio' (compressed size / original size), 'compress_mbs' and 'decompress_mbs'
+        (throughput in megabytes of uncompressed data per second).
+    """
+    half = max(1, len(pages) // 2)
+    training, test = pages[:half], pages[half:] or pages
+    dictionary = train_dictionary(training, dictionary_size)
+
+    algorithms = {
+        'gz': (gzip.compress, gzip.decompress),
+        'bz2': (bz2.compress, bz2.decompress),
+        'zdict': (lambda data: zdict_compress(data, 'benchmark', 1, dictionary),
+                  lambda raw: zdict_decompress(raw, dictionary, zdict_header(raw)[2])),
+    }
+
+    original_size = sum(len(page) for page in test)
+    megabytes = original_size / 1024 / 1024
+    report = {}
+
+    for name, (compress, decompress) in algorithms.items():
+        start = time.perf_counter()
+        compressed = [compress(page) for page in test]
+        compress_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for raw in compressed:
+            decompress(raw)
+        decompress_time = time.perf_counter() - start
+
+        report[name] = {
+            'ratio': sum(len(raw) for raw in compressed) / original_size if original_size else 0,
+            'compress_mbs': megabytes / compress_time if compress_time else 0,
+            'decompress_mbs': megabytes / decompress_time if decompress_time else 0,
+        }
+
+    report['zdict']['dictionary_size'] = len(dictionary)
+    return report
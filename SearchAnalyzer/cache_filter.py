@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import math
+import os
+import struct
+import threading
+
+"""
+A Bloom filter of the names in a cache.
+
+Most lookups of a run over a huge keyword list against a cold cache are misses.
+The filter answers them without asking the cache backend, which matters most
+for the cache server, where a lookup is a network round trip.
+
+A Bloom filter has no false negatives, but false positives at a rate that depends
+on its size: a filter for `capacity` names with an error rate of 1% needs about
+9.6 bits per name. Removed names stay in the filter, they are only dropped when
+the filter is rebuilt.
+"""
+
+# magic, number of hash functions, number of bits, capacity, number of added names
+FILTER_HEADER = struct.Struct('<4sBQQQ')
+FILTER_MAGIC = b'SABF'
+
+
+class BloomFilter(object):
+
+    def __init__(self, capacity, error_rate=0.01):
+        """Create an empty filter.
+
+        Args:
+            capacity: How many names can be added until the error rate is exceeded.
+            error_rate: The false positive rate at capacity.
+        """
+        self.capacity = max(1, int(capacity))
+        self.num_bits = max(8, int(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, int(round(self.num_bits / self.capacity * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def _positions(self, name):
+        digest = hashlib.blake2b(name.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, name):
+        positions = self._positions(name)
+        with self.lock:
+            for pos in positions:
+                self.bits[pos >> 3] |= 1 << (pos & 7)
+            self.count += 1
+
+    def update(self, names):
+        for name in names:
+            self.add(name)
+
+    def __contains__(self, name):
+        bits = self.bits
+        return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(name))
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def full(self):
+        return self.count > self.capacity
+
+    def to_bytes(self):
+        with self.lock:
+            return FILTER_HEADER.pack(FILTER_MAGIC, self.num_hashes, self.num_bits, self.capacity, self.count) + \
+                bytes(self.bits)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Reverse to_bytes().
+
+        Raises:
+            ValueError if the data is no valid filter.
+        """
+        if len(data) < FILTER_HEADER.size:
+            raise ValueError('Truncated filter header')
+
+        magic, num_hashes, num_bits, capacity, count = FILTER_HEADER.unpack_from(data)
+        if magic != FILTER_MAGIC or len(data) - FILTER_HEADER.size != (num_bits + 7) // 8:
+            raise ValueError('Invalid filter')
+
+        bloom = cls.__new__(cls)
+        bloom.capacity, bloom.num_bits, bloom.num_hashes, bloom.count = capacity, num_bits, num_hashes, count
+        bloom.bits = bytearray(data[FILTER_HEADER.size:])
+        bloom.lock = threading.Lock()
+        return bloom
+
+    def save(self, path, tag=b''):
+        """Persist the filter.
+
+        Args:
+            path: Where to save the filter.
+            tag: Saved along with the filter, load() only returns the filter for the same tag.
+        """
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp = path + '.{}.tmp'.format(os.getpid())
+        with open(tmp, 'wb') as fd:
+            fd.write(struct.pack('<H', len(tag)) + tag + self.to_bytes())
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path, tag=b''):
+        """Returns the filter saved at path or None if it is missing, invalid or has another tag."""
+        try:
+            with open(path, 'rb') as fd:
+                data = fd.read()
+            tag_len, = struct.unpack_from('<H', data)
+            if data[2:2 + tag_len] != tag:
+                return None
+            return cls.from_bytes(data[2 + tag_len:])
+        except (OSError, ValueError, struct.error):
+            return None
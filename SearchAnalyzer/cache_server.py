@@ -0,0 +1,508 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+import json
+import logging
+import math
+import os
+import re
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import requests
+
+from SearchAnalyzer.cache_filter import BloomFilter
+from SearchAnalyzer.caching import ALLOWED_COMPRESSION_ALGORITHMS, get_cache_backend, get_dictionary_compressor
+
+"""
+A shared cache for several scraper nodes.
+
+Nodes that scrape overlapping keywords would request the same SERP pages over and
+over again with their own caches. With the `cache_server_url` option set, the cache
+of a node gets a second tier: SERP pages are looked up in the local cache first and
+then on the cache server, and every page the node caches is uploaded to the server.
+
+The cache server is bundled and started with --cache-server-listen host:port. It keeps
+the pages in a cache backend of its own in `cache_server_dir` and speaks plain HTTP:
+
+    GET    /cache/<name>    The compressed page. The compression algorithm and the time the
+                            page was cached are in the X-Cache-Compression and X-Cache-Mtime headers.
+    PUT    /cache/<name>    Store a compressed page, same headers.
+    DELETE /cache/<name>    Remove a page.
+    POST   /batch/get       The body lists one name per line, the response contains all
+                            pages the server has as records (see pack_records()).
+    POST   /batch/put       Store all pages of the records in the body.
+    GET    /stats           The number of entries and their size as json.
+    GET    /filter          A BloomFilter of the names of all pages on the server.
+
+Names are the digests of CacheManager.cached_file_name(). Pages are passed through as
+they were compressed by the node, except for zdict compressed pages: the dictionaries are
+local to a node, so these pages are gzipped before they are uploaded. Uploads that are
+neither uncompressed nor gz or bz2 compressed are rejected with 400. Pages older than
+`cache_server_ttl` hours are not served anymore.
+
+Nodes download the filter of the server every `cache_server_filter_refresh` seconds
+and don't ask the server for pages that are not in it.
+
+The server has no authentication. Without a host it listens on 127.0.0.1 only, give the
+address of a private network interface to share it with other nodes. Request bodies larger
+than `cache_server_max_body_size` bytes are rejected with 413.
+"""
+
+logger = logging.getLogger(__name__)
+
+NAME_RE = re.compile(r'^[0-9a-f]{64}(\.parsed)?\.cache$')
+
+# length of the name, length of the compression, mtime, length of the data
+BATCH_RECORD = struct.Struct('<HBdI')
+
+# the compressions every node can decompress, '' for uncompressed pages
+PORTABLE_COMPRESSIONS = ('',) + ALLOWED_COMPRESSION_ALGORITHMS
+
+
+def valid_upload(compression, mtime):
+    """Whether a node may upload a page with this compression and mtime."""
+    return compression in PORTABLE_COMPRESSIONS and mtime is not None and math.isfinite(mtime)
+
+
+def pack_records(records):
+    """Serialize cache entries for the batch endpoints.
+
+    Args:
+        records: An iterable of tuples (name, compression, mtime, raw).
+
+    Returns:
+        The records as bytes.
+    """
+    chunks = []
+    for name, compression, mtime, raw in records:
+        name, compression = name.encode(), compression.encode()
+        chunks.append(BATCH_RECORD.pack(len(name), len(compression), mtime, len(raw)))
+        chunks.extend((name, compression, raw))
+    return b''.join(chunks)
+
+
+def unpack_records(data):
+    """Reverse pack_records().
+
+    Yields:
+        The tuples (name, compression, mtime, raw).
+
+    Raises:
+        ValueError if the data is truncated.
+    """
+    offset = 0
+    while offset < len(data):
+        if offset + BATCH_RECORD.size > len(data):
+            raise ValueError('Truncated record header at offset {}'.format(offset))
+        name_len, comp_len, mtime, data_len = BATCH_RECORD.unpack_from(data, offset)
+        offset += BATCH_RECORD.size
+
+        end = offset + name_len + comp_len + data_len
+        if end > len(data):
+            raise ValueError('Truncated record at offset {}'.format(offset))
+
+        name = data[offset:offset + name_len].decode()
+        compression = data[offset + name_len:offset + name_len + comp_len].decode()
+        yield name, compression, mtime, data[offset + name_len + comp_len:end]
+        offset = end
+
+
+class CacheServer(ThreadingHTTPServer):
+    """The bundled cache server."""
+
+    daemon_threads = True
+
+    def __init__(self, config, address=None):
+        self.config = dict(config)
+        self.config['cachedir'] = self.config.get('cache_server_dir', '.sharedcache/')
+        os.makedirs(self.config['cachedir'], exist_ok=True)
+
+        self.ttl = 60 * 60 * float(self.config.get('cache_server_ttl', 48))
+        self.max_body_size = int(self.config.get('cache_server_max_body_size', 64 * 1024 * 1024))
+        self.backend = get_cache_backend(self.config)
+        self.backend.open()
+        self.lock = threading.Lock()
+        self.rebuild_filter()
+
+        if not address:
+            host, _, port = self.config.get('cache_server_listen', '').rpartition(':')
+            address = (host or '127.0.0.1', int(port))
+
+        super().__init__(address, CacheRequestHandler)
+
+    def rebuild_filter(self):
+        capacity = max(int(self.config.get('cache_filter_capacity', 1000000)), 2 * len(self.backend))
+        self.filter = BloomFilter(capacity, float(self.config.get('cache_filter_error_rate', 0.01)))
+        self.filter.update(self.backend.names())
+
+    def get(self, name):
+        """Returns the tuple (name, compression, mtime, raw) or None if the page is missing or expired."""
+        with self.lock:
+            entry = self.backend.lookup(name)
+            if not entry:
+                return None
+
+            if self.ttl and time.time() - entry.mtime > self.ttl:
+                self.backend.remove(name)
+                return None
+
+            raw = self.backend.read_raw(name)
+            if raw is None:
+                return None
+            return name, raw[1], entry.mtime, raw[0]
+
+    def put(self, name, compression, mtime, raw):
+        with self.lock:
+            self.backend.write_raw(name, raw, compression, mtime)
+            self.filter.add(name)
+            if self.filter.full:
+                self.rebuild_filter()
+
+    def remove(self, name):
+        with self.lock:
+            self.backend.remove(name)
+
+    def server_close(self):
+        super().server_close()
+        with self.lock:
+            self.backend.close()
+
+
+class CacheRequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.debug('{} {}'.format(self.address_string(), format % args))
+
+    def send(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        """The body of the request or None if it was rejected, then the response is sent already."""
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            length = -1
+
+        # the body isn't read, so the connection can't be used for another request
+        if length < 0:
+            self.send(400, headers={'Connection': 'close'})
+            return None
+
+        if length > self.server.max_body_size:
+            self.send(413, headers={'Connection': 'close'})
+            return None
+
+        return self.rfile.read(length)
+
+    def entry_name(self):
+        """The name of the /cache/<name> path or None if the path is invalid."""
+        path = urlparse(self.path).path
+        if path.startswith('/cache/'):
+            name = path[len('/cache/'):]
+            if NAME_RE.match(name):
+                return name
+        return None
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/stats':
+            stats = {'entries': len(self.server.backend), 'size': self.server.backend.size}
+            self.send(200, json.dumps(stats).encode(), {'Content-Type': 'application/json'})
+            return
+
+        if urlparse(self.path).path == '/filter':
+            self.send(200, self.server.filter.to_bytes(), {'Content-Type': 'application/octet-stream'})
+            return
+
+        name = self.entry_name()
+        if not name:
+            self.send(400)
+            return
+
+        record = self.server.get(name)
+        if not record:
+            self.send(404)
+            return
+
+        _, compression, mtime, raw = record
+        self.send(200, raw, {'X-Cache-Compression': compression, 'X-Cache-Mtime': repr(mtime)})
+
+    def do_PUT(self):
+        name = self.entry_name()
+        body = self.read_body()
+        if body is None:
+            return
+        if not name:
+            self.send(400)
+            return
+
+        compression = self.headers.get('X-Cache-Compression', '')
+        try:
+            mtime = float(self.headers.get('X-Cache-Mtime') or time.time())
+        except ValueError:
+            mtime = None
+        if not valid_upload(compression, mtime):
+            self.send(400, b'Invalid compression or mtime')
+            return
+
+        self.server.put(name, compression, mtime, body)
+        self.send(204)
+
+    def do_DELETE(self):
+        name = self.entry_name()
+        if not name:
+            self.send(400)
+            return
+
+        self.server.remove(name)
+        self.send(204)
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        body = self.read_body()
+        if body is None:
+            return
+
+        if path == '/batch/get':
+            names = [name for name in body.decode().split('\n') if NAME_RE.match(name)]
+            records = filter(None, (self.server.get(name) for name in names))
+            self.send(200, pack_records(records), {'Content-Type': 'application/octet-stream'})
+        elif path == '/batch/put':
+            try:
+                records = list(unpack_records(body))
+            except ValueError as e:
+                self.send(400, str(e).encode())
+                return
+            if not all(valid_upload(compression, mtime) for _, compression, mtime, _ in records):
+                self.send(400, b'Invalid compression or mtime')
+                return
+            for name, compression, mtime, raw in records:
+                if NAME_RE.match(name):
+                    self.server.put(name, compression, mtime, raw)
+            self.send(204)
+        else:
+            self.send(404)
+
+
+def serve_cache(config):
+    """Run the cache server until it is interrupted."""
+    server = CacheServer(config)
+    logger.info('Serving the cache {} on {}:{}'.format(server.config['cachedir'], *server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+class RemoteCacheBackend(object):
+    """Client of the cache server.
+
+    Network errors are logged and treated like cache misses, an unreachable
+    cache server must not stop the scraping.
+    """
+
+    def __init__(self, config, url=None):
+        self.config = config
+        self.url = (url or self.config.get('cache_server_url', '')).rstrip('/')
+        self.timeout = float(self.config.get('cache_server_timeout', 10))
+        self.session = requests.Session()
+        # to gzip zdict compressed pages before they are uploaded
+        self.dictionaries = get_dictionary_compressor(self.config)
+
+    def close(self):
+        self.session.close()
+
+    def portable(self, raw, compression):
+        """Returns the tuple (raw, compression) of a page that any node can decompress."""
+        if compression == 'zdict':
+            return gzip.compress(self.dictionaries.decompress(raw)), 'gz'
+        return raw, compression
+
+    def get_filter(self):
+        """Returns the BloomFilter of the names on the server or None."""
+        try:
+            response = self.session.get('{}/filter'.format(self.url), timeout=self.timeout)
+            response.raise_for_status()
+            return BloomFilter.from_bytes(response.content)
+        except (requests.RequestException, ValueError) as e:
+            logger.warning('Cannot fetch the filter of the cache server {}: {}'.format(self.url, e))
+            return None
+
+    def get(self, name):
+        """Returns the tuple (name, compression, mtime, raw) or None."""
+        try:
+            response = self.session.get('{}/cache/{}'.format(self.url, name), timeout=self.timeout)
+        except requests.RequestException as e:
+            logger.warning('Cache server {} is not reachable: {}'.format(self.url, e))
+            return None
+
+        if response.status_code != 200:
+            return None
+
+        return name, response.headers.get('X-Cache-Compression', ''), \
+            float(response.headers.get('X-Cache-Mtime') or time.time()), response.content
+
+    def get_many(self, names):
+        """Returns the records (name, compression, mtime, raw) of all names the server has."""
+        try:
+            response = self.session.post('{}/batch/get'.format(self.url), data='\n'.join(names).encode(),
+                                         timeout=self.timeout)
+            response.raise_for_status()
+            return list(unpack_records(response.content))
+        except (requests.RequestException, ValueError) as e:
+            logger.warning('Cannot fetch {} entries from the cache server {}: {}'.format(len(names), self.url, e))
+            return []
+
+    def put_many(self, records):
+        """Upload the records (name, compression, mtime, raw)."""
+        uploads = []
+        for name, compression, mtime, raw in records:
+            raw, compression = self.portable(raw, compression)
+            uploads.append((name, compression, mtime, raw))
+
+        try:
+            response = self.session.post('{}/batch/put'.format(self.url), data=pack_records(uploads),
+                                         timeout=self.timeout)
+            response.raise_for_status()
+            return True
+        except requests.RequestException as e:
+            logger.warning('Cannot upload {} entries to the cache server {}: {}'.format(len(uploads), self.url, e))
+            return False
+
+    def remove(self, name):
+        try:
+            self.session.delete('{}/cache/{}'.format(self.url, name), timeout=self.timeout)
+        except requests.RequestException as e:
+            logger.warning('Cache server {} is not reachable: {}'.format(self.url, e))
+
+
+class TieredCacheBackend(object):
+    """A local cache backend in front of the cache server.
+
+    Lookups go to the local tier first. Pages that are only on the cache server
+    are downloaded into the local tier, but only if they are in the filter of the
+    cache server. Written pages are uploaded in batches of `cache_server_batch_size`.
+    Eviction and compaction only affect the local tier.
+    """
+
+    def __init__(self, config, local, remote):
+        self.config = config
+        self.local = local
+        self.remote = remote
+        self.batch_size = int(self.config.get('cache_server_batch_size', 500))
+        self.uploads = []
+        self.upload_lock = threading.Lock()
+
+        self.filter_refresh = float(self.config.get('cache_server_filter_refresh', 60))
+        self.remote_filter = None
+        self.filter_fetched_at = 0
+
+    def open(self):
+        self.local.open()
+
+    def close(self):
+        self.flush()
+        self.local.close()
+        self.remote.close()
+
+    def flush(self):
+        """Upload all pending pages to the cache server."""
+        with self.upload_lock:
+            uploads, self.uploads = self.uploads, []
+        if uploads:
+            self.remote.put_many(uploads)
+
+    def on_server(self, name):
+        """False if the page is certainly not on the cache server."""
+        if time.time() - self.filter_fetched_at > self.filter_refresh:
+            self.filter_fetched_at = time.time()
+            self.remote_filter = self.remote.get_filter()
+        return self.remote_filter is None or name in self.remote_filter
+
+    def _store_local(self, record):
+        name, compression, mtime, raw = record
+        self.local.write_raw(name, raw, compression, mtime)
+
+    def prefetch(self, names):
+        """Download all pages of names that are on the cache server but not in the local tier.
+
+        Returns:
+            The number of downloaded pages.
+        """
+        missing = [name for name in names if name not in self.local and self.on_server(name)]
+        num_fetched = 0
+        for i in range(0, len(missing), self.batch_size):
+            for record in self.remote.get_many(missing[i:i + self.batch_size]):
+                self._store_local(record)
+                num_fetched += 1
+
+        logger.debug('Fetched {} of {} entries from the cache server'.format(num_fetched, len(missing)))
+        return num_fetched
+
+    def _fetch(self, name):
+        if not self.on_server(name):
+            return False
+        record = self.remote.get(name)
+        if record:
+            self._store_local(record)
+            return True
+        return False
+
+    def lookup(self, name):
+        entry = self.local.lookup(name)
+        if not entry and self._fetch(name):
+            entry = self.local.lookup(name)
+        return entry
+
+    def read_raw(self, name):
+        raw = self.local.read_raw(name)
+        if raw is None and self._fetch(name):
+            raw = self.local.read_raw(name)
+        return raw
+
+    def write_raw(self, name, raw, compression, mtime=None):
+        mtime = mtime or time.time()
+        self.local.write_raw(name, raw, compression, mtime)
+
+        with self.upload_lock:
+            self.uploads.append((name, compression, mtime, raw))
+            full = len(self.uploads) >= self.batch_size
+        if full:
+            self.flush()
+
+    def remove(self, name):
+        self.local.remove(name)
+
+    def names(self):
+        return self.local.names()
+
+    def entry_size(self, name):
+        return self.local.entry_size(name)
+
+    @property
+    def size(self):
+        return self.local.size
+
+    def maybe_reclaim(self):
+        return self.local.maybe_reclaim()
+
+    def compact(self, max_age):
+        return self.local.compact(max_age)
+
+    def __contains__(self, name):
+        return name in self.local
+
+    def __len__(self):
+        return len(self.local)
@@ -1,26 +1,38 @@
 # -*- coding: utf-8 -*-
 
 import bz2
+import copy
 import gzip
 import hashlib
+import json
 import logging
 import os
+import pickle
+import queue
 import re
+import threading
 import time
+from collections import Counter, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 
+import lxml.html
+from lxml.html.clean import Cleaner
 from sqlalchemy.orm.exc import NoResultFound
 
+from SearchAnalyzer.cache_filter import BloomFilter
+from SearchAnalyzer.cache_compression import DictionaryCompressor, DictionaryStore, benchmark_compression
 from SearchAnalyzer.database import SearchEngineResultsPage
 from SearchAnalyzer.output_converter import store_serp_result
-from SearchAnalyzer.parser.tools import parse_serp
+from SearchAnalyzer.parser.parser import Parser
+from SearchAnalyzer.parser.tools import ParseResult, parse_html, parse_result_from_parser, parse_serp, parser_version
 
 """
 SearchAnalyzer is a complex application and thus searching is error prone. While developing,
 you may need to repeat the same searches several times and you might end up being banned by
 the search engine providers. This is why all searches are chached by default.
 
-Every SERP page is cached in a separate file. In the future, it might be more straightforward to
-cache scraping jobs in archives (zip files).
+By default every SERP page is cached in a separate file. With the `cache_backend` option set
+to 'packed', SERP pages are appended to a few large segment files instead (see packed_cache.py).
 
 What determines the uniqueness of a SERP result?
 - The complete url (because in URLs search queries and params are included)
@@ -43,6 +55,18 @@ logger = logging.getLogger(__name__)
 
 ALLOWED_COMPRESSION_ALGORITHMS = ('gz', 'bz2')
 
+# zdict entries are compressed with the dictionary of their search engine, see cache_compression.py
+CACHE_COMPRESSION_ALGORITHMS = ALLOWED_COMPRESSION_ALGORITHMS + ('zdict',)
+
+# The parse results of a SERP page are cached under the cache name of the page
+# with this suffix instead of '.cache', see parsed_name().
+PARSED_SUFFIX = '.parsed.cache'
+
+# A single file in the cache directory. `compression` is the
+# file extension of the compression algorithm or an empty string
+# if the file is not compressed. `size` is the size of the file in bytes.
+CacheEntry = namedtuple('CacheEntry', 'path, compression, mtime, size')
+
 class InvalidConfigurationFileException(Exception):
     """
     Used when the cache module cannot
@@ -124,15 +148,868 @@ class CompressedFile(object):
 
 
 
+class CacheIndex(object):
+    """In-process index of the files in the cache directory.
+
+    Listing a cache directory with millions of files takes seconds, so
+    the directory is scanned once and every later lookup is a dictionary
+    access. The index maps the name as returned by CacheManager.cached_file_name()
+    to a CacheEntry.
+
+    The index may be persisted as a snapshot. The modification time of the directory
+    is too coarse and doesn't change when a file is rewritten in place, so an index that
+    is loaded with snapshots also counts the changes in a generation file next to the
+    snapshot: the first change after loading or saving increments it. A snapshot is only
+    used as long as the generation and the modification time of the cache directory didn't
+    change since it was taken, otherwise the directory is scanned again.
+    """
+
+    snapshot_dir = '.index'
+    snapshot_name = 'index.snapshot'
+    generation_name = 'generation'
+
+    def __init__(self, cachedir):
+        self.cachedir = cachedir
+        self.entries = {}
+        # the size of all entries in bytes
+        self.size = 0
+        self.lock = threading.Lock()
+        # whether the changes are counted in the generation file
+        self.tracked = False
+        # the generation the entries are in sync with, None if another process changed the directory
+        self.generation = None
+        # whether the entries changed since they were loaded or saved
+        self.changed = False
+
+    @property
+    def snapshot_path(self):
+        return os.path.join(self.cachedir, self.snapshot_dir, self.snapshot_name)
+
+    @property
+    def generation_path(self):
+        return os.path.join(self.cachedir, self.snapshot_dir, self.generation_name)
+
+    def read_generation(self):
+        """The number of times the cache directory was changed by indexes that keep snapshots."""
+        try:
+            with open(self.generation_path, 'r') as fd:
+                return int(fd.read())
+        except (OSError, ValueError):
+            return 0
+
+    def _count_change(self):
+        """Increment the generation on the first change since the entries were loaded or saved.
+
+        Call it with the lock held.
+        """
+        if not self.tracked or self.changed:
+            return
+        self.changed = True
+
+        generation = self.read_generation()
+        os.makedirs(os.path.dirname(self.generation_path), exist_ok=True)
+        tmp = self.generation_path + '.tmp'
+        with open(tmp, 'w') as fd:
+            fd.write(str(generation + 1))
+        os.replace(tmp, self.generation_path)
+
+        # another process changed the directory since, the entries don't know its changes
+        self.generation = generation + 1 if generation == self.generation else None
+
+    @staticmethod
+    def split_name(fname):
+        """Split a file name of the cache directory in the cache name and the compression.
+
+        Returns:
+            A tuple (name, compression) or None if the file is no cache file.
+        """
+        for ext in CACHE_COMPRESSION_ALGORITHMS:
+            if fname.endswith('.cache.' + ext):
+                return fname[:-len(ext) - 1], ext
+        if fname.endswith('.cache'):
+            return fname, ''
+        return None
+
+    def entry_path(self, name, compression):
+        if compression:
+            name = '{}.{}'.format(name, compression)
+        return os.path.join(self.cachedir, name)
+
+    def load(self, use_snapshot=True):
+        """Fill the index from the snapshot or by scanning the cache directory.
+
+        Args:
+            use_snapshot: Whether a valid snapshot may be used instead of scanning.
+        """
+        self.tracked = use_snapshot
+        if use_snapshot and self._load_snapshot():
+            logger.debug('Loaded cache index with {} entries from {}'.format(len(self.entries), self.snapshot_path))
+            return
+
+        # read before scanning, a change while scanning only invalidates the snapshot
+        self.generation = self.read_generation()
+        self.scan()
+        logger.debug('Scanned {} cache files in {}'.format(len(self.entries), self.cachedir))
+        if use_snapshot:
+            self.save()
+
+    def scan(self):
+        """Build the index by reading the cache directory once."""
+        entries = {}
+        if os.path.isdir(self.cachedir):
+            for dirent in os.scandir(self.cachedir):
+                split = self.split_name(dirent.name)
+                if split and dirent.is_file():
+                    name, compression = split
+                    try:
+                        stat = dirent.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries[name] = CacheEntry(dirent.path, compression, stat.st_mtime, stat.st_size)
+
+        with self.lock:
+            self.entries = entries
+            self.size = sum(entry.size for entry in entries.values())
+
+    def _load_snapshot(self):
+        try:
+            with open(self.snapshot_path, 'rb') as fd:
+                # snapshots of older versions have no generation and fail to unpack
+                dir_mtime, generation, entries = pickle.load(fd)
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            return False
+
+        if dir_mtime != os.stat(self.cachedir).st_mtime_ns or generation != self.read_generation():
+            return False
+
+        try:
+            entries = {name: CacheEntry(self.entry_path(name, compression), compression, mtime, size)
+                       for name, (compression, mtime, size) in entries.items()}
+        except ValueError:
+            # written by an older version without file sizes
+            return False
+
+        with self.lock:
+            self.entries = entries
+            self.size = sum(entry.size for entry in entries.values())
+            self.generation = generation
+            self.changed = False
+        return True
+
+    def save(self):
+        """Persist the index so that the next start doesn't need to scan the cache directory."""
+        if not os.path.isdir(self.cachedir):
+            return
+
+        snapshot_dir = os.path.dirname(self.snapshot_path)
+        os.makedirs(snapshot_dir, exist_ok=True)
+
+        with self.lock:
+            # stat before copying, a file added in between only invalidates the snapshot.
+            dir_mtime = os.stat(self.cachedir).st_mtime_ns
+            entries = {name: (entry.compression, entry.mtime, entry.size) for name, entry in self.entries.items()}
+            generation = self.generation
+            # the next change is counted again
+            self.changed = False
+
+        tmp = self.snapshot_path + '.tmp'
+        with open(tmp, 'wb') as fd:
+            pickle.dump((dir_mtime, generation, entries), fd, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.snapshot_path)
+
+    def get(self, name):
+        return self.entries.get(name)
+
+    def add(self, name, compression, mtime=None, size=0):
+        entry = CacheEntry(self.entry_path(name, compression), compression, mtime or time.time(), size)
+        with self.lock:
+            old = self.entries.get(name)
+            if old:
+                self.size -= old.size
+            self.entries[name] = entry
+            self.size += size
+            self._count_change()
+        return entry
+
+    def remove(self, name):
+        with self.lock:
+            entry = self.entries.pop(name, None)
+            if entry:
+                self.size -= entry.size
+                self._count_change()
+            return entry
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def compress_data(data, algorithm):
+    """Compress data in memory.
+
+    Args:
+        data: The data to compress. Strings are utf-8 encoded.
+        algorithm: One of ALLOWED_COMPRESSION_ALGORITHMS or an empty string
+            to store the data uncompressed.
+
+    Returns:
+        The compressed bytes.
+    """
+    if not isinstance(data, bytes):
+        data = data.encode()
+
+    if algorithm == 'gz':
+        return gzip.compress(data)
+    elif algorithm == 'bz2':
+        return bz2.compress(data)
+    elif not algorithm:
+        return data
+
+    raise InvalidConfigurationFileException('{} is not a supported compression algorithm'.format(algorithm))
+
+
+def decompress_data(data, algorithm):
+    """Reverse compress_data().
+
+    Returns:
+        The decompressed data as string.
+    """
+    if algorithm == 'gz':
+        data = gzip.decompress(data)
+    elif algorithm == 'bz2':
+        data = bz2.decompress(data)
+    elif algorithm:
+        raise InvalidConfigurationFileException('{} is not a supported compression algorithm'.format(algorithm))
+
+    return data.decode()
+
+
+def parsed_name(name):
+    """The cache name of the parse results of the SERP page with the cache name."""
+    if name.endswith('.cache'):
+        name = name[:-len('.cache')]
+    return name + PARSED_SUFFIX
+
+
+def get_dictionary_compressor(config):
+    """The DictionaryCompressor for the zdict compressed entries in the cachedir."""
+    return DictionaryCompressor(
+        DictionaryStore(os.path.join(config.get('cachedir', '.scrapecache'), 'dictionaries')),
+        dictionary_size=int(config.get('cache_dictionary_size', 32 * 1024)),
+        num_samples=int(config.get('cache_dictionary_samples', 100)),
+        retrain_after=int(config.get('cache_dictionary_retrain_after', 0))
+    )
+
+
+def decompress_entry(raw, compression, dictionaries):
+    """Decompress a cache entry of any of the CACHE_COMPRESSION_ALGORITHMS."""
+    if compression == 'zdict':
+        return dictionaries.decompress(raw).decode()
+    return decompress_data(raw, compression)
+
+
+# The state of the worker processes of CacheManager.parse_all_cached_files()
+_replay_config = None
+_replay_dictionaries = None
+
+
+def _init_replay_worker(config):
+    global _replay_config, _replay_dictionaries
+    _replay_config = config
+    _replay_dictionaries = get_dictionary_compressor(config)
+
+
+def _replay_cache_entry(raw, compression, search_engine, query):
+    """Decompress and parse a cached SERP page in a worker process."""
+    html = decompress_entry(raw, compression, _replay_dictionaries)
+    return parse_html(_replay_config, html, search_engine, query)
+
+
+class FileCacheBackend(object):
+    """Stores every SERP page in a separate file in the cache directory.
+
+    This is the default cache backend. Files are named after CacheManager.cached_file_name()
+    plus the extension of the compression algorithm.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.cachedir = self.config.get('cachedir', '.scrapecache')
+        self.index = CacheIndex(self.cachedir)
+        self.persist_index = self.config.get('persist_cache_index', True)
+
+    def open(self):
+        self.index.load(use_snapshot=self.persist_index)
+
+    def close(self):
+        if self.persist_index:
+            self.index.save()
+
+    def lookup(self, name):
+        """Returns the CacheEntry for name or None."""
+        return self.index.get(name)
+
+    def read_raw(self, name):
+        """Returns the tuple (compressed data, compression) for name or None."""
+        entry = self.index.get(name)
+        if not entry:
+            return None
+
+        try:
+            with open(entry.path, 'rb') as fd:
+                return fd.read(), entry.compression
+        except FileNotFoundError:
+            # removed behind our back
+            self.index.remove(name)
+            return None
+
+    def write_raw(self, name, raw, compression, mtime=None):
+        """Store already compressed data."""
+        old = self.index.get(name)
+        path = self.index.entry_path(name, compression)
+
+        with open(path, 'wb') as fd:
+            fd.write(raw)
+
+        if mtime:
+            os.utime(path, (mtime, mtime))
+
+        # the same page was cached before with another compression algorithm
+        if old and old.path != path:
+            try:
+                os.remove(old.path)
+            except FileNotFoundError:
+                pass
+
+        self.index.add(name, compression, mtime, len(raw))
+
+    def remove(self, name):
+        entry = self.index.remove(name)
+        if entry:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+    def names(self):
+        return list(self.index.entries.keys())
+
+    def entry_size(self, name):
+        entry = self.index.get(name)
+        return entry.size if entry else 0
+
+    @property
+    def size(self):
+        """The size of all cached entries in bytes."""
+        return self.index.size
+
+    def maybe_reclaim(self):
+        """Removed files free their disk space immediately, nothing to do."""
+        pass
+
+    def compact(self, max_age):
+        """Delete all files older than max_age seconds.
+
+        Returns:
+            The number of deleted entries.
+        """
+        deadline = time.time() - max_age
+        expired = [name for name, entry in list(self.index.entries.items()) if entry.mtime < deadline]
+        for name in expired:
+            self.remove(name)
+        return len(expired)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+
+class CacheJanitor(threading.Thread):
+    """Keeps the cache below `max_cache_size` bytes while scraping.
+
+    Every `cache_janitor_interval` seconds the janitor sweeps the cache and evicts
+    entries in batches of `cache_janitor_batch` until it's small enough again.
+    """
+
+    def __init__(self, cache_manager, interval):
+        super().__init__(name='CacheJanitor', daemon=True)
+        self.cache_manager = cache_manager
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.cache_manager.evict(self.stopped)
+            except Exception as e:
+                logger.error('Cache janitor failed: {}'.format(e))
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def minimize_html(html):
+    """Strip scripts, styles and comments from a SERP page, like Parser.cleaned_html does."""
+    dom = lxml.html.document_fromstring(html, parser=lxml.html.HTMLParser(encoding='utf-8'))
+    cleaner = Cleaner(scripts=True, javascript=True, comments=True, style=True)
+    return lxml.html.tostring(cleaner.clean_html(dom))
+
+
+# A SERP page that waits in the queue of the CacheWriter.
+CacheWrite = namedtuple('CacheWrite', 'html, minimize, parse_result, query, search_engine, scrape_mode, page_number')
+
+
+class CacheWriter(object):
+    """Writes SERP pages to the cache in background threads.
+
+    Minimizing and compressing a SERP page takes longer than the request itself
+    for fast proxies, so the scraping threads only put their pages in a bounded queue.
+    If the queue is full, `policy` decides what happens:
+
+        'block': Wait until there is room in the queue.
+        'drop': Don't cache the page.
+        'inline': Write the page in the scraping thread.
+
+    close() writes all queued pages before it returns.
+    """
+
+    policies = ('block', 'drop', 'inline')
+
+    def __init__(self, cache_manager, num_threads=1, queue_size=1000, policy='block'):
+        if policy not in self.policies:
+            raise InvalidConfigurationFileException('No such cache write backpressure policy: "{}"'.format(policy))
+
+        self.cache_manager = cache_manager
+        self.policy = policy
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.threads = [threading.Thread(target=self.run, name='CacheWriter-{}'.format(i), daemon=True)
+                        for i in range(num_threads)]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, write):
+        if self.policy == 'block':
+            self.queue.put(write)
+            return
+
+        try:
+            self.queue.put_nowait(write)
+        except queue.Full:
+            if self.policy == 'drop':
+                with self.cache_manager.access_lock:
+                    self.cache_manager.stats['dropped_writes'] += 1
+            else:
+                self.cache_manager.write(write)
+
+    def run(self):
+        while True:
+            write = self.queue.get()
+            try:
+                if write is None:
+                    return
+                self.cache_manager.write(write)
+            except Exception as e:
+                logger.error('Cannot cache the SERP page for "{}": {}'.format(write.query, e))
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        """Wait until all queued pages are written."""
+        self.queue.join()
+
+    def close(self):
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+def get_cache_backend(config):
+    """Return the cache backend selected by the `cache_backend` option.
+
+    If `cache_server_url` is set, the backend is the local tier in front of the cache server.
+
+    Raises:
+        InvalidConfigurationFileException if there is no such backend.
+    """
+    backend = config.get('cache_backend', 'files')
+
+    if backend == 'files':
+        local = FileCacheBackend(config)
+    elif backend == 'packed':
+        from SearchAnalyzer.packed_cache import PackedCacheBackend
+        local = PackedCacheBackend(config)
+    else:
+        raise InvalidConfigurationFileException('No such cache backend: "{}"'.format(backend))
+
+    if config.get('cache_server_url'):
+        from SearchAnalyzer.cache_server import RemoteCacheBackend, TieredCacheBackend
+        return TieredCacheBackend(config, local, RemoteCacheBackend(config))
+
+    return local
+
+
 class CacheManager():
     """
     Manages caching for SearchAnalyzer.
+
+    Attributes:
+        stats: Counters of cache hits, misses, evictions and evicted bytes.
+        access: Maps cache names to the tuple (last access, number of accesses). Used
+            to pick the entries to evict when the cache grows larger than `max_cache_size`.
+        filter: A BloomFilter of the cached names that answers most misses without
+            asking the cache backend. None if disabled.
     """
 
+    access_snapshot = os.path.join(CacheIndex.snapshot_dir, 'access.snapshot')
+    filter_snapshot = os.path.join(CacheIndex.snapshot_dir, 'cache.filter')
+
     def __init__(self, config):
         self.config = config
         self.maybe_create_cache_dir()
 
+        self.backend = get_cache_backend(self.config)
+        if self.config.get('do_caching', True):
+            self.backend.open()
+
+        self.dictionaries = get_dictionary_compressor(self.config)
+
+        self.stats = Counter()
+        self.access = {}
+        self.access_lock = threading.Lock()
+        # the names that are being replayed, the janitor doesn't evict them
+        self.pinned = Counter()
+        self.janitor = None
+        self.writer = None
+        self.load_access()
+
+        self.filter = None
+        self.filter_lock = threading.Lock()
+        self.load_filter()
+
+    def close(self):
+        """Persist the state of the cache when the scrape is finished."""
+        self.stop_writer()
+        self.stop_janitor()
+        if self.config.get('do_caching', True):
+            self.save_access()
+            self.save_filter()
+            self.backend.close()
+            logger.info('Cache: {hits} hits, {misses} misses, {evictions} evictions ({evicted_bytes} bytes)'.format(
+                **{key: self.stats[key] for key in ('hits', 'misses', 'evictions', 'evicted_bytes')}))
+
+    @property
+    def access_snapshot_path(self):
+        return os.path.join(self.config.get('cachedir', '.scrapecache'), self.access_snapshot)
+
+    def load_access(self):
+        if not self.config.get('do_caching', True):
+            return
+        try:
+            with open(self.access_snapshot_path, 'rb') as fd:
+                self.access = pickle.load(fd)
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            self.access = {}
+
+    def save_access(self):
+        """Persist the access metadata of the entries that are still cached."""
+        with self.access_lock:
+            access = {name: value for name, value in self.access.items() if name in self.backend}
+
+        os.makedirs(os.path.dirname(self.access_snapshot_path), exist_ok=True)
+        tmp = self.access_snapshot_path + '.{}.tmp'.format(os.getpid())
+        with open(tmp, 'wb') as fd:
+            pickle.dump(access, fd, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.access_snapshot_path)
+
+    @property
+    def filter_snapshot_path(self):
+        return os.path.join(self.config.get('cachedir', '.scrapecache'), self.filter_snapshot)
+
+    def _filter_tag(self):
+        # a filter saved for another state of the cache is rebuilt
+        return '{}:{}'.format(len(self.backend), self.backend.size).encode()
+
+    def load_filter(self):
+        """Load the persisted BloomFilter of the cached names or build it.
+
+        Not used with a cache server, the filter only knows the local names.
+        """
+        if not self.config.get('do_caching', True) or not self.config.get('use_cache_filter', True) \
+                or self.config.get('cache_server_url'):
+            return
+
+        self.filter = BloomFilter.load(self.filter_snapshot_path, self._filter_tag())
+        if self.filter is None:
+            self.rebuild_filter()
+
+    def rebuild_filter(self):
+        """Build the BloomFilter from the names in the cache backend.
+
+        The filter is sized for `cache_filter_capacity` names, but at least for
+        twice the number of cached pages.
+        """
+        with self.filter_lock:
+            capacity = max(int(self.config.get('cache_filter_capacity', 1000000)), 2 * len(self.backend))
+            bloom = BloomFilter(capacity, float(self.config.get('cache_filter_error_rate', 0.01)))
+            bloom.update(name for name in self.backend.names() if not name.endswith(PARSED_SUFFIX))
+            self.filter = bloom
+
+        logger.debug('Built the cache filter for {} names ({} bytes)'.format(len(bloom), len(bloom.bits)))
+        return bloom
+
+    def save_filter(self):
+        if self.filter:
+            with self.filter_lock:
+                self.filter.save(self.filter_snapshot_path, self._filter_tag())
+
+    def might_be_cached(self, name):
+        """False if the cache name is certainly not cached."""
+        return self.filter is None or name in self.filter
+
+    def _add_to_filter(self, name):
+        if self.filter is None:
+            return
+
+        with self.filter_lock:
+            self.filter.add(name)
+            full = self.filter.full
+
+        if full:
+            self.rebuild_filter()
+
+    def touch(self, name):
+        """Record an access of a cache entry."""
+        with self.access_lock:
+            _, hits = self.access.get(name, (0, 0))
+            self.access[name] = (time.time(), hits + 1)
+            self.stats['hits'] += 1
+
+    def miss(self):
+        with self.access_lock:
+            self.stats['misses'] += 1
+
+    def pin(self, names):
+        """Keep the janitor from evicting entries until they are unpinned."""
+        with self.access_lock:
+            self.pinned.update(names)
+
+    def unpin(self, names):
+        with self.access_lock:
+            self.pinned.subtract(names)
+            self.pinned += Counter()
+
+    def start_writer(self):
+        """Write SERP pages in `cache_writer_threads` background threads from now on."""
+        num_threads = int(self.config.get('cache_writer_threads', 1))
+        if self.config.get('do_caching', True) and num_threads > 0 and not self.writer:
+            self.writer = CacheWriter(
+                self,
+                num_threads=num_threads,
+                queue_size=int(self.config.get('cache_write_queue_size', 1000)),
+                policy=self.config.get('cache_write_backpressure', 'block')
+            )
+            self.writer.start()
+
+    def stop_writer(self):
+        """Write all queued SERP pages and stop the writer threads."""
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+
+    def flush(self):
+        """Wait until all queued SERP pages are written."""
+        if self.writer:
+            self.writer.flush()
+        if hasattr(self.backend, 'flush'):
+            self.backend.flush()
+
+    def start_janitor(self):
+        """Start the background janitor if the cache size is limited."""
+        if self.config.get('do_caching', True) and int(self.config.get('max_cache_size', 0)) and not self.janitor:
+            self.janitor = CacheJanitor(self, float(self.config.get('cache_janitor_interval', 30)))
+            self.janitor.start()
+
+    def stop_janitor(self):
+        if self.janitor:
+            self.janitor.stop()
+            self.janitor = None
+
+    def _eviction_key(self, name):
+        entry = self.backend.lookup(name)
+        last_access, hits = self.access.get(name, (0, 0))
+        last_access = max(last_access, entry.mtime if entry else 0)
+        if self.config.get('cache_eviction_policy', 'lru') == 'lfu':
+            return hits, last_access
+        return last_access
+
+    def evict(self, stopped=None):
+        """Evict entries if the cache is larger than `max_cache_size` bytes.
+
+        Entries are evicted until the cache is below 90% of `max_cache_size`. The least
+        recently used entries go first or, with the `cache_eviction_policy` 'lfu', the least
+        frequently used ones. The candidates are ordered once per sweep and removed in
+        batches of `cache_janitor_batch`, pinned entries are skipped.
+
+        Args:
+            stopped: A threading.Event that ends the sweep after the current batch.
+
+        Returns:
+            The number of evicted entries.
+        """
+        max_size = int(self.config.get('max_cache_size', 0))
+        if not max_size or self.backend.size <= max_size:
+            return 0
+
+        to_free = self.backend.size - int(max_size * 0.9)
+        batch_size = max(1, int(self.config.get('cache_janitor_batch', 1000)))
+        # the victims are popped from the end
+        candidates = sorted((name for name in self.backend.names() if not name.endswith(PARSED_SUFFIX)),
+                            key=self._eviction_key, reverse=True)
+
+        freed = evicted = 0
+        while candidates and freed < to_free and not (stopped and stopped.is_set()):
+            with self.access_lock:
+                pinned = set(self.pinned)
+
+            batch_freed = batch_evicted = 0
+            while candidates and batch_evicted < batch_size and freed + batch_freed < to_free:
+                name = candidates.pop()
+                if name in pinned:
+                    continue
+                for victim in (name, parsed_name(name)):
+                    batch_freed += self.backend.entry_size(victim)
+                    self.backend.remove(victim)
+                with self.access_lock:
+                    self.access.pop(name, None)
+                batch_evicted += 1
+
+            with self.access_lock:
+                self.stats['evictions'] += batch_evicted
+                self.stats['evicted_bytes'] += batch_freed
+            self.backend.maybe_reclaim()
+            freed += batch_freed
+            evicted += batch_evicted
+
+        logger.debug('Evicted {} entries ({} bytes) from the cache'.format(evicted, freed))
+        return evicted
+
+    def compress(self, data, algorithm, search_engine):
+        """Compress a SERP page for the cache.
+
+        Args:
+            data: The html of the SERP page.
+            algorithm: One of CACHE_COMPRESSION_ALGORITHMS or an empty string.
+            search_engine: The search engine of the SERP page. Used to pick the dictionary.
+
+        Returns:
+            The tuple (compressed data, compression). The compression may differ from
+            the requested algorithm, zdict falls back to gz until a dictionary is trained.
+        """
+        if algorithm == 'zdict':
+            if not isinstance(data, bytes):
+                data = data.encode()
+            return self.dictionaries.compress(data, search_engine)
+
+        return compress_data(data, algorithm), algorithm
+
+    def decompress(self, raw, compression):
+        return decompress_entry(raw, compression, self.dictionaries)
+
+    def read(self, name):
+        """Returns the cached SERP page with the cache name or None."""
+        raw = self.backend.read_raw(name)
+        if raw is None:
+            return None
+        return self.decompress(*raw)
+
+    def benchmark_compression(self, num_pages=200):
+        """Print how well the compression algorithms do on the pages in the cache.
+
+        Args:
+            num_pages: How many cached pages to use.
+
+        Returns:
+            The report of cache_compression.benchmark_compression().
+        """
+        pages = []
+        for name in self.backend.names():
+            if name.endswith(PARSED_SUFFIX):
+                continue
+            html = self.read(name)
+            if html:
+                pages.append(html.encode())
+            if len(pages) >= num_pages:
+                break
+
+        if len(pages) < 2:
+            logger.warning('Need at least two cached pages to benchmark the compression.')
+            return {}
+
+        report = benchmark_compression(pages, int(self.config.get('cache_dictionary_size', 32 * 1024)))
+
+        print('{} cached pages, {} bytes'.format(len(pages), sum(len(page) for page in pages)))
+        print('{:<8}{:>10}{:>18}{:>20}'.format('', 'ratio', 'compress MB/s', 'decompress MB/s'))
+        for algorithm, values in report.items():
+            print('{:<8}{ratio:>10.3f}{compress_mbs:>18.1f}{decompress_mbs:>20.1f}'.format(algorithm, **values))
+
+        return report
+
+    def compact(self):
+        """Drop all cache entries that are older than `clean_cache_after` hours.
+
+        Returns:
+            The number of removed entries.
+        """
+        removed = self.backend.compact(60 * 60 * int(self.config.get('clean_cache_after', 48)))
+        logger.info('Removed {} expired entries from the cache. {} entries remain.'.format(removed, len(self.backend)))
+        return removed
+
+    def import_cache_directory(self, path):
+        """Copy all cache files of a cache directory into the configured cache backend.
+
+        Used to migrate an existing `.scrapecache` directory to the packed backend.
+        Compressed files are copied without recompressing them.
+
+        Args:
+            path: The cache directory to import.
+
+        Returns:
+            The number of imported files.
+        """
+        source = CacheIndex(path)
+        source.scan()
+
+        num_imported = 0
+        for name, entry in source.entries.items():
+            try:
+                with open(entry.path, 'rb') as fd:
+                    raw = fd.read()
+            except FileNotFoundError:
+                continue
+
+            self.backend.write_raw(name, raw, entry.compression, mtime=entry.mtime)
+            num_imported += 1
+
+            if num_imported % 10000 == 0:
+                logger.info('Imported {}/{} cache files.'.format(num_imported, len(source)))
+
+        logger.info('Imported {} cache files from {}'.format(num_imported, path))
+        if self.filter is not None:
+            self.rebuild_filter()
+        return num_imported
+
+    def is_stale(self, entry):
+        """Whether a cache entry is older than allowed by `clean_cache_after`."""
+        return (time.time() - entry.mtime) / 60 / 60 > int(self.config.get('clean_cache_after', 48))
+
 
     def maybe_create_cache_dir(self):
         if self.config.get('do_caching', True):
@@ -145,21 +1022,13 @@ class CacheManager():
         """
         Clean the cache.
 
-        Clean all cached searches (the obtained html code) in the cache directory iff
-        the respective files are older than specified in the configuration. Defaults to 12 hours.
+        Clean all cached searches (the obtained html code) iff they are older than
+        specified in the configuration and evict entries until the cache is smaller
+        than `max_cache_size`.
         """
-        cachedir = self.config.get('cachedir', '.scrapecache')
-        if os.path.exists(cachedir):
-            for fname in os.listdir(cachedir):
-                path = os.path.join(cachedir, fname)
-                if time.time() > os.path.getmtime(path) + (60 * 60 * int(self.config.get('clean_cache_after', 48))):
-                    # Remove the whole directory if necessary
-                    if os.path.isdir(path):
-                        import shutil
-
-                        shutil.rmtree(path)
-                    else:
-                        os.remove(os.path.join(cachedir, fname))
+        if self.config.get('do_caching', True):
+            self.compact()
+            self.evict()
 
 
     def cached_file_name(self, keyword, search_engine, scrape_mode, page_number):
@@ -206,25 +1075,25 @@ class CacheManager():
         """
         if self.config.get('do_caching', False):
             fname = self.cached_file_name(keyword, search_engine, scrapemode, page_number)
+            if not self.might_be_cached(fname):
+                self.miss()
+                return False
 
-            cdir = self.config.get('cachedir', '.scrapecache')
-
-            if fname in os.listdir(cdir):
-                # If the cached file is older than 12 hours, return False and thus
-                # make a new fresh request.
-                try:
-                    modtime = os.path.getmtime(os.path.join(cdir, fname))
-                except FileNotFoundError:
-                    return False
-
-                if (time.time() - modtime) / 60 / 60 > int(self.config('clean_cache_after', 48)):
-                    return False
+            entry = self.backend.lookup(fname)
+            # If the cached file is older than 12 hours, return False and thus
+            # make a new fresh request.
+            if not entry or self.is_stale(entry):
+                self.miss()
+                return False
 
-                path = os.path.join(cdir, fname)
-                return self.read_cached_file(path)
-            else:
+            html = self.read(fname)
+            if not html:
+                self.miss()
                 return False
 
+            self.touch(fname)
+            return html
+
     def read_cached_file(self, path):
         """Read a compressed or uncompressed file.
 
@@ -250,7 +1119,7 @@ class CacheManager():
             # The path needs to have an extension in any case.
             # When uncompressed, ext is 'cache', else it is the
             # compressing scheme file ending like .gz or .bz2 ...
-            assert ext in ALLOWED_COMPRESSION_ALGORITHMS or ext == 'cache', 'Invalid extension: {}'.format(ext)
+            assert ext in CACHE_COMPRESSION_ALGORITHMS or ext == 'cache', 'Invalid extension: {}'.format(ext)
 
             if ext == 'cache':
                 with open(path, 'r') as fd:
@@ -265,6 +1134,9 @@ class CacheManager():
                         # lead to a infinite recursion. This isn't proper coding,
                         # but convenient for the end user.
                         self.config['compress_cached_files'] = True
+            elif ext == 'zdict':
+                with open(path, 'rb') as fd:
+                    return self.decompress(fd.read(), ext)
             elif ext in ALLOWED_COMPRESSION_ALGORITHMS:
                 f = CompressedFile(path)
                 return f.read()
@@ -273,7 +1145,7 @@ class CacheManager():
 
 
     def cache_results(self, parser, query, search_engine, scrape_mode, page_number, db_lock=None):
-        """Stores the html of an parser in a file.
+        """Stores the html of an parser in the cache backend.
 
         The file name is determined by the parameters query, search_engine, scrape_mode and page_number.
         See cached_file_name() for more information.
@@ -287,35 +1159,60 @@ class CacheManager():
             search_engine: The search engine the keyword was scraped for.
             scrape_mode: The scrapemode that was used.
             page_number: The page number that the serp page is.
-            db_lock: If an db_lock is given, all action are wrapped in this lock.
+            db_lock: Not used anymore. The cache backends synchronize themselves.
         """
 
         if self.config.get('do_caching', False):
-            if db_lock:
-                db_lock.acquire()
-
-            if self.config.get('minimize_caching_files', True):
-                html = parser.cleaned_html
+            minimize = self.config.get('minimize_caching_files', True)
+            parse_result = None
+            if isinstance(parser, Parser):
+                # the scraper keeps using the parser while the page is written
+                parse_result = copy.deepcopy(parse_result_from_parser(parser))
+
+            if self.writer:
+                # minimized by the writer, the parser is not thread safe
+                self.writer.put(CacheWrite(parser.html, minimize, parse_result, query, search_engine, scrape_mode,
+                                           page_number))
             else:
-                html = parser.html
+                html = parser.cleaned_html if minimize else parser.html
+                self.write(CacheWrite(html, False, parse_result, query, search_engine, scrape_mode, page_number))
 
-            fname = self.cached_file_name(query, search_engine, scrape_mode, page_number)
-            cachedir = self.config.get('cachedir', '.scrapecache')
-            path = os.path.join(cachedir, fname)
+    def cache_page(self, html, parse_result, query, search_engine, scrape_mode, page_number):
+        """Stores the html of a SERP page that was parsed elsewhere, e.g. in another process.
 
-            if self.config.get('compress_cached_files'):
-                algorithm = self.config.get('compressing_algorithm', 'gz')
-                f = CompressedFile(path, algorithm=algorithm)
-                f.write(html)
+        Args:
+            html: The html of the SERP page.
+            parse_result: The ParseResult of the page or None.
+            query, search_engine, scrape_mode, page_number: See cache_results().
+        """
+        if self.config.get('do_caching', False):
+            write = CacheWrite(html, self.config.get('minimize_caching_files', True), parse_result, query,
+                               search_engine, scrape_mode, page_number)
+            if self.writer:
+                self.writer.put(write)
             else:
-                with open(path, 'w') as fd:
-                    if isinstance(html, bytes):
-                        fd.write(html.decode())
-                    else:
-                        fd.write(html)
+                self.write(write)
+
+    def write(self, write):
+        """Compress and store a SERP page.
+
+        Args:
+            write: A CacheWrite.
+        """
+        html = minimize_html(write.html) if write.minimize else write.html
+        fname = self.cached_file_name(write.query, write.search_engine, write.scrape_mode, write.page_number)
+
+        if self.config.get('compress_cached_files'):
+            algorithm = self.config.get('compressing_algorithm', 'gz')
+        else:
+            algorithm = ''
 
-            if db_lock:
-                db_lock.release()
+        raw, compression = self.compress(html, algorithm, write.search_engine)
+        self.backend.write_raw(fname, raw, compression)
+        self._add_to_filter(fname)
+
+        if write.parse_result:
+            self.store_parse_result(fname, write.parse_result, write.search_engine)
 
 
     def _get_all_cache_files(self):
@@ -363,75 +1260,208 @@ class CacheManager():
             return True
 
 
-    def parse_all_cached_files(self, scrape_jobs, session, scraper_search):
-        """Walk recursively through the cachedir (as given by the Config) and parse all cached files.
+    def store_parse_result(self, fname, result, search_engine):
+        """Cache the parse results of a SERP page next to its html.
+
+        The results are tagged with the version of the parser, see parser_version().
 
         Args:
-            session: An sql alchemy session to add the entities
-            scraper_search: Abstract object representing the current search.
+            fname: The cache name of the SERP page.
+            result: The ParseResult of the SERP page.
+            search_engine: The search engine of the SERP page.
+        """
+        if not self.config.get('cache_parse_results', True):
+            return
+
+        data = {
+            'version': parser_version(search_engine, self.config.get('search_type', 'normal')),
+            'result': result._asdict(),
+        }
+        raw = compress_data(json.dumps(data, separators=(',', ':')), 'gz')
+        self.backend.write_raw(parsed_name(fname), raw, 'gz')
+
+    def load_parse_result(self, fname, search_engine):
+        """Get the cached parse results of a SERP page.
 
         Returns:
-            The scrape jobs that couldn't be parsed from the cache directory.
+            The ParseResult or None if there is none or it was created by another parser version.
         """
-        files = self._get_all_cache_files()
-        num_cached = num_total = 0
-        mapping = {}
-        for job in scrape_jobs:
-            cache_name = self.cached_file_name(
-                job['query'],
-                job['search_engine'],
-                job['scrape_method'],
-                job['page_number']
-            )
-            mapping[cache_name] = job
-            num_total += 1
+        if not self.config.get('cache_parse_results', True):
+            return None
 
-        for path in files:
-            # strip of the extension of the path if it has eny
-            fname = os.path.split(path)[1]
-            clean_filename = fname
-            for ext in ALLOWED_COMPRESSION_ALGORITHMS:
-                if fname.endswith(ext):
-                    clean_filename = fname.rstrip('.' + ext)
+        raw = self.backend.read_raw(parsed_name(fname))
+        if raw is None:
+            return None
 
-            job = mapping.get(clean_filename, None)
+        try:
+            data = json.loads(decompress_data(*raw))
+        except (ValueError, OSError, EOFError) as e:
+            logger.warning('Corrupt parse results for {}: {}'.format(fname, e))
+            return None
 
-            if job:
-                # We found a file that contains the keyword, search engine name and
-                # search mode that fits our description. Let's see if there is already
-                # an record in the database and link it to our new ScraperSearch object.
-                serp = self.get_serp_from_database(session, job['query'], job['search_engine'], job['scrape_method'],
-                                              job['page_number'])
+        if data.get('version') != parser_version(search_engine, self.config.get('search_type', 'normal')):
+            return None
 
-                if not serp:
-                    serp = self.parse_again(fname, job['search_engine'], job['scrape_method'], job['query'])
+        return ParseResult(**data['result'])
 
+    def parse_all_cached_files(self, scrape_jobs, session, scraper_search, persistence=None):
+        """Look up all scrape jobs in the cache index and parse the cached files.
+
+        Cached parse results are used as long as the parser didn't change. All other
+        cached files are decompressed and parsed by `num_workers` worker processes.
+        The resulting SERP objects are stored by the persistence thread if given, else
+        they are added to the session in batches.
+
+        Args:
+            scrape_jobs: The scrape jobs to look up.
+            session: An sql alchemy session to add the entities
+            scraper_search: Abstract object representing the current search.
+            persistence: A SerpPersistence the SERPs are streamed to.
+
+        Returns:
+            The scrape jobs that couldn't be parsed from the cache directory.
+        """
+        names = [self.cached_file_name(job['query'], job['search_engine'], job['scrape_method'], job['page_number'])
+                 for job in scrape_jobs]
+
+        # the janitor runs during the replay, it must not evict the entries of the chunk
+        self.pin(names)
+        try:
+            return self._parse_cached_chunk(names, scrape_jobs, session, scraper_search, persistence)
+        finally:
+            self.unpin(names)
+
+    def _parse_cached_chunk(self, names, scrape_jobs, session, scraper_search, persistence):
+        # download what other nodes cached in one go instead of asking the cache server for every job
+        prefetch = getattr(self.backend, 'prefetch', None)
+        if prefetch:
+            prefetch(names + [parsed_name(cache_name) for cache_name in names])
+
+        cached = {}
+        for cache_name, job in zip(names, scrape_jobs):
+            if self.might_be_cached(cache_name) and cache_name in self.backend:
+                cached[cache_name] = job
+
+        num_cached = 0
+        replayed = set()
+
+        for cache_name, serp in self._replay_cached_files(cached, session):
+            store_serp_result(serp, self.config)
+
+            if persistence:
+                if serp.id is None:
+                    persistence.put(serp)
+                else:
+                    persistence.link(serp)
+            else:
                 serp.scraper_searches.append(scraper_search)
                 session.add(serp)
 
                 if num_cached % 200 == 0:
                     session.commit()
+            num_cached += 1
+            replayed.add(cache_name)
+            self.touch(cache_name)
 
-                store_serp_result(serp, self.config)
-                num_cached += 1
-                scrape_jobs.remove(job)
+        remaining = [job for cache_name, job in zip(names, scrape_jobs) if cache_name not in replayed]
+        with self.access_lock:
+            self.stats['misses'] += len(remaining)
 
-        logger.debug('{} cache files found in {}'.format(len(files), self.config.get('cachedir')))
+        logger.debug('{} entries in the cache {}'.format(len(self.backend), self.config.get('cachedir')))
         logger.debug('{}/{} objects have been read from the cache. {} remain to get scraped.'.format(
-            num_cached, num_total, num_total - num_cached))
+            num_cached, len(scrape_jobs), len(remaining)))
 
         session.add(scraper_search)
         session.commit()
 
-        return scrape_jobs
+        return remaining
+
+    def _replay_cached_files(self, cached, session):
+        """Get the SERP objects of cached scrape jobs.
+
+        Args:
+            cached: A dict that maps the cache name to the scrape job.
+            session: An sql alchemy session.
+
+        Yields:
+            The tuples (cache name, serp) in no particular order. Cache entries
+            that can't be parsed are skipped.
+        """
+        to_parse = []
+        for cache_name, job in cached.items():
+            # If there is already a record in the database, link it to our new ScraperSearch object.
+            serp = self.get_serp_from_database(session, job['query'], job['search_engine'], job['scrape_method'],
+                                               job['page_number'])
+            if serp:
+                yield cache_name, serp
+                continue
+
+            result = self.load_parse_result(cache_name, job['search_engine'])
+            if result:
+                yield cache_name, self._serp_from_result(result, job)
+            else:
+                to_parse.append(cache_name)
+
+        num_workers = int(self.config.get('num_workers', 1))
 
+        if num_workers <= 1 or len(to_parse) <= 1:
+            for cache_name in to_parse:
+                job = cached[cache_name]
+                try:
+                    result = parse_html(self.config, self.read(cache_name), job['search_engine'], job['query'])
+                except Exception as e:
+                    logger.warning('Cannot parse cached file {}: {}'.format(cache_name, e))
+                    continue
+                self.store_parse_result(cache_name, result, job['search_engine'])
+                yield cache_name, self._serp_from_result(result, job)
+            return
+
+        # keep the workers busy without reading the whole cache into memory
+        max_pending = num_workers * 8
+        pending = {}
+        to_submit = iter(to_parse)
+
+        with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_replay_worker,
+                                 initargs=(self.config,)) as executor:
+            while True:
+                for cache_name in to_submit:
+                    raw = self.backend.read_raw(cache_name)
+                    if raw is None:
+                        continue
+                    job = cached[cache_name]
+                    future = executor.submit(_replay_cache_entry, raw[0], raw[1], job['search_engine'], job['query'])
+                    pending[future] = cache_name
+                    if len(pending) >= max_pending:
+                        break
+
+                if not pending:
+                    break
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    cache_name = pending.pop(future)
+                    job = cached[cache_name]
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        logger.warning('Cannot parse cached file {}: {}'.format(cache_name, e))
+                        continue
+                    self.store_parse_result(cache_name, result, job['search_engine'])
+                    yield cache_name, self._serp_from_result(result, job)
+
+    def _serp_from_result(self, result, job):
+        """Create the SERP object of a scrape job from its ParseResult."""
+        serp = parse_serp(self.config, parser=result, query=job['query'])
+        serp.search_engine_name = job['search_engine']
+        serp.scrape_method = job['scrape_method']
+        serp.page_number = job['page_number']
+        return serp
 
     def parse_again(self, fname, search_engine, scrape_method, query):
         """
         @todo: `scrape_method` is not used here -> check if scrape_method is passed to this function and remove it
         """
-        path = os.path.join(self.config.get('cachedir', '.scrapecache'), fname)
-        html = self.read_cached_file(path)
+        html = self.read(fname)
         return parse_serp(
             self.config,
             html=html,
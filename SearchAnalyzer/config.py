@@ -47,10 +47,11 @@ def get_config(command_line_args=None, external_configuration_file=None, config_
         if os.path.exists(external_configuration_file) and external_configuration_file.endswith('.py'):
             exernal_config = load_source('external_config', external_configuration_file)
             members = inspect.getmembers(exernal_config)
-            update_members(members)
+            update_members({k: v for k, v in members if not k.startswith('_')})
 
     if command_line_args:
-        update_members(command_line_args)
+        # options that are not given on the command line are None and keep the value of the config files
+        update_members({k: v for k, v in command_line_args.items() if v is not None})
 
     if config_from_library_call:
         update_members(config_from_library_call)
@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import print_function
+import collections
+import contextlib
+import itertools
 import threading
 import datetime
 import sys
@@ -9,16 +12,22 @@ import os
 import queue
 from SearchAnalyzer.log import setup_logger
 from SearchAnalyzer.commandline import get_command_line
-from SearchAnalyzer.database import ScraperSearch, SERP, Link, get_session, fixtures
-from SearchAnalyzer.proxies import parse_proxy_file, get_proxies_from_mysql_db, add_proxies_to_db
+from SearchAnalyzer.database import ScraperSearch, SERP, Link, ScrapeResults, get_session, fixtures
+from SearchAnalyzer.persistence import get_persistence
+from SearchAnalyzer.proxies import parse_proxy_file, get_proxies_from_mysql_db, add_proxies_to_db, check_proxies, \
+    proxy_report
+from SearchAnalyzer.proxy_pool import ProxyPool
+from SearchAnalyzer.rate_limiting import RateLimiter
 from SearchAnalyzer.caching import CacheManager
 from SearchAnalyzer.config import get_config
-from SearchAnalyzer.scrape_jobs import default_scrape_jobs_for_keywords
+from SearchAnalyzer.scrape_jobs import KeywordSet, default_scrape_jobs_for_keywords, read_keywords
+from SearchAnalyzer.scheduler import JobScheduler
 from SearchAnalyzer.scraping import ScrapeWorkerFactory
+from SearchAnalyzer.transport import stats_info
 from SearchAnalyzer.output_converter import init_outfile
 from SearchAnalyzer.async_mode import AsyncScrapeScheduler
 import logging
-from SearchAnalyzer.utils import get_base_path
+from SearchAnalyzer.utils import chunked, get_base_path
 import SearchAnalyzer.config
 
 logger = logging.getLogger(__name__)
@@ -45,6 +54,23 @@ def id_for_keywords(keywords):
     return m.hexdigest()
 
 
+def replay_cache(cache_manager, scrape_jobs, chunk_size, session, scraper_search, persistence=None):
+    """Replay the cached scrape jobs chunk by chunk as the jobs are consumed.
+
+    The janitor and the writer of the cache are started before the replay, the
+    cache manager pins the entries of a chunk while it's replayed such that they
+    aren't evicted.
+
+    Yields:
+        The scrape jobs that aren't cached.
+    """
+    cache_manager.start_writer()
+    cache_manager.start_janitor()
+
+    for chunk in chunked(scrape_jobs, chunk_size):
+        yield from cache_manager.parse_all_cached_files(chunk, session, scraper_search, persistence=persistence)
+
+
 def scrape_with_config(config):
     """Runs SearchAnalyzer with the dict in config.
 
@@ -52,9 +78,8 @@ def scrape_with_config(config):
         config: A configuration dictionary that updates the global configuration.
 
     Returns:
-        The result of the main() function. Is a scraper search object.
-        In case you want to access the session, import it like this:
-        ```from SearchAnalyzer database import session```
+        The result of the main() function. Is a ScrapeResults handle that has the attributes
+        of the scraper search and loads its SERPs lazily from the database.
     """
     if not isinstance(config, dict):
         raise ValueError(
@@ -117,7 +142,7 @@ class ShowProgressQueue(threading.Thread):
 
         Args:
             queue: A queue.Queue instance to share among the worker threads.
-            num_keywords: The number of total keywords that need to be scraped.
+            num_keywords: The number of total keywords that need to be scraped. None while it is not known yet.
         """
         super().__init__()
         self.queue = queue
@@ -127,7 +152,7 @@ class ShowProgressQueue(threading.Thread):
         self.progress_fmt = '{}/{} keywords processed.'
 
     def run(self):
-        while self.num_already_processed < self.num_keywords:
+        while self.num_keywords is None or self.num_already_processed < self.num_keywords:
             e = self.queue.get()
 
             if e == 'done':
@@ -135,7 +160,8 @@ class ShowProgressQueue(threading.Thread):
 
             self.num_already_processed += 1
 
-            print(self.progress_fmt.format(self.num_already_processed, self.num_keywords), end='\r')
+            num_keywords = '?' if self.num_keywords is None else self.num_keywords
+            print(self.progress_fmt.format(self.num_already_processed, num_keywords), end='\r')
 
             # TODO: FIX THIS!
             # self.verbosity == 2 and self.num_already_processed % 5 == 0:
@@ -156,7 +182,7 @@ def main(return_results=False, parse_cmd_line=True, config_from_dict=None):
         parse_cmd_line: Whether to get options from the command line or not.
         config_from_dict: Configuration that is passed when SearchAnalyzer is called as library.
     Returns:
-        A database session to the results when return_results is True. Else, nothing.
+        A ScrapeResults handle to the results when return_results is True. Else, nothing.
     """
     external_config_file_path = cmd_line_args = None
 
@@ -236,11 +262,9 @@ def main(return_results=False, parse_cmd_line=True, config_from_dict=None):
         start_python_console(namespace)
         return
 
-    if not (keyword or keywords) and not kwfile:
-        # Just print the help.
-        get_command_line(True)
-        print('No keywords to scrape for. Please provide either an keyword file (Option: --keyword-file) or specify and '
-            'keyword with --keyword.')
+    if config.get('cache_server_listen'):
+        from SearchAnalyzer.cache_server import serve_cache
+        serve_cache(config)
         return
 
     cache_manager = CacheManager(config)
@@ -250,7 +274,53 @@ def main(return_results=False, parse_cmd_line=True, config_from_dict=None):
         logger.info('renaming done. restart for normal use.')
         return
 
+    if config.get('migrate_cache'):
+        cache_manager.import_cache_directory(config.get('migrate_cache'))
+        cache_manager.close()
+        return
+
+    if config.get('compact_cache'):
+        cache_manager.compact()
+        cache_manager.close()
+        return
+
+    if config.get('rebuild_cache_filter'):
+        cache_manager.rebuild_filter()
+        cache_manager.close()
+        return
+
+    if config.get('benchmark_cache_compression'):
+        cache_manager.benchmark_compression()
+        cache_manager.close()
+        return
+
+    if config.get('check_proxies_only'):
+        cache_manager.close()
+        proxies = []
+        if proxy_db:
+            proxies = get_proxies_from_mysql_db(proxy_db)
+        elif proxy_file:
+            proxies = parse_proxy_file(proxy_file)
+
+        if not proxies:
+            print('No proxies to check. Specify them with --proxy-file or --mysql-proxy-db.')
+            return
+        session = get_session(config, scoped=False)()
+        add_proxies_to_db(proxies, session)
+        print(proxy_report(check_proxies(config, proxies, engine=session.get_bind())))
+        session.close()
+        return
+
+    if not (keyword or keywords) and not kwfile:
+        # Just print the help.
+        get_command_line(True)
+        print('No keywords to scrape for. Please provide either an keyword file (Option: --keyword-file) or specify and '
+            'keyword with --keyword.')
+        return
+
     keywords = [keyword, ] if keyword else keywords
+    chunk_size = int(config.get('keyword_chunk_size', 10000))
+    keyword_set = KeywordSet(int(config.get('keyword_dedupe_memory', 1000000)), chunk_size)
     scrape_jobs = {}
     if kwfile:
         if not os.path.exists(kwfile):
@@ -265,14 +335,14 @@ def main(return_results=False, parse_cmd_line=True, config_from_dict=None):
                 except ImportError as e:
                     logger.warning(e)
             else:
-                # Clean the keywords of duplicates right in the beginning
-                keywords = set([line.strip() for line in open(kwfile, 'r').read().split('\n') if line.strip()])
+                # Stream the keywords and clean them of duplicates while they are read
+                keywords = keyword_set.unique(read_keywords(kwfile))
 
+    # the scrape jobs are generated lazily, they are never all in memory at once
+    num_keywords = len(keywords) if hasattr(keywords, '__len__') else None
     if not scrape_jobs:
         scrape_jobs = default_scrape_jobs_for_keywords(keywords, search_engines, scrape_method, pages)
 
-    scrape_jobs = list(scrape_jobs)
-
     if config.get('clean_cache_files', False):
         cache_manager.clean_cachefiles()
         return
@@ -304,7 +374,8 @@ def main(return_results=False, parse_cmd_line=True, config_from_dict=None):
         print('*' * 60 + 'SIMULATION' + '*' * 60)
         logger.info('If SearchAnalyzer would have been run without the --simulate flag, it would have:')
         logger.info('Scraped for {} keywords, with {} results a page, in total {} pages for each keyword'.format(
-            len(keywords), int(config.get('num_results_per_page', 0)),
+            num_keywords if num_keywords is not None else sum(1 for _ in keywords),
+            int(config.get('num_results_per_page', 0)),
             int(config.get('num_pages_for_keyword'))))
         if None in proxies:
             logger.info('Also using own ip address to scrape.')
@@ -319,8 +390,8 @@ def main(return_results=False, parse_cmd_line=True, config_from_dict=None):
                                                                        int(config.get('num_workers'))))
         return
 
-    # get a scoped sqlalchemy session
-    session_cls = get_session(config, scoped=False)
+    # get a scoped sqlalchemy session, every worker thread gets its own session of the registry
+    session_cls = get_session(config, scoped=True)
     session = session_cls()
 
     # add fixtures
@@ -329,6 +400,14 @@ def main(return_results=False, parse_cmd_line=True, config_from_dict=None):
     # add proxies to the database
     add_proxies_to_db(proxies, session)
 
+    # check all proxies at once before the workers start, only the live ones get workers
+    if config.get('check_proxies', True) and any(proxies):
+        dead = {check.proxy for check in check_proxies(config, proxies, engine=session.get_bind()) if not check.online}
+        proxies = [proxy for proxy in proxies if proxy not in dead]
+        if not proxies:
+            raise Exception('None of the proxies is online and using own IP is prohibited by configuration. '
+                            'Turning down.')
+
     # ask the user to continue the last scrape. We detect a continuation of a
     # previously established scrape, if the keyword-file is the same and unmodified since
     # the beginning of the last scrape.
@@ -353,19 +432,43 @@ def main(return_results=False, parse_cmd_line=True, config_from_dict=None):
             keyword_file=kwfile,
             number_search_engines_used=num_search_engines,
             number_proxies_used=len(proxies),
-            number_search_queries=len(keywords),
+            number_search_queries=num_keywords,
             started_searching=datetime.datetime.utcnow(),
             used_search_engines=','.join(search_engines)
         )
 
+    # stores the SERPs in batches from a single thread, without keeping them in memory
+    persistence = get_persistence(config, session, scraper_search)
+
+    # a continued scrape only needs to do the jobs that are still pending in the ledger
+    ledger = persistence.ledger if persistence else None
+    if ledger is not None:
+        if len(ledger):
+            logger.info('{} of {} scrape jobs remain in the job ledger.'.format(ledger.num_pending(), len(ledger)))
+        else:
+            ledger.register(scrape_jobs)
+        scrape_jobs = ledger.pending()
+
     # First of all, lets see how many requests remain to issue after searching the cache.
+    # The cache is searched chunk by chunk as the jobs are consumed.
     if config.get('do_caching'):
-        scrape_jobs = cache_manager.parse_all_cached_files(scrape_jobs, session, scraper_search)
+        scrape_jobs = replay_cache(cache_manager, scrape_jobs, chunk_size, session, scraper_search, persistence)
+
+    scrape_jobs = iter(scrape_jobs)
+    first_job = next(scrape_jobs, None)
 
-    if scrape_jobs:
+    if first_job is not None:
+        scrape_jobs = itertools.chain([first_job], scrape_jobs)
 
-        # Create a lock to synchronize database access in the sqlalchemy session
-        db_lock = threading.Lock()
+        # sqlite allows only one writer at a time, database servers handle concurrent sessions themselves
+        if session.get_bind().dialect.name == 'sqlite':
+            db_lock = threading.Lock()
+        else:
+            db_lock = contextlib.nullcontext()
+
+        # the workers' sessions reference the scraper search by id
+        session.add(scraper_search)
+        session.commit()
 
         # create a lock to cache results
         cache_lock = threading.Lock()
@@ -373,22 +476,24 @@ def main(return_results=False, parse_cmd_line=True, config_from_dict=None):
         # A lock to prevent multiple threads from solving captcha, used in selenium instances.
         captcha_lock = threading.Lock()
 
-        logger.info('Going to scrape {num_keywords} keywords with {num_proxies} proxies by using {num_threads} threads.'.format(
-            num_keywords=len(list(scrape_jobs)),
-            num_proxies=len(proxies),
-            num_threads=num_search_engines))
+        # paces the requests of all workers per search engine and proxy
+        rate_limiter = RateLimiter(config)
+
+        # hands the http workers the best available proxy for every request
+        proxy_pool = None
+        if method == 'http' and len(proxies) > 1 and config.get('use_proxy_pool', True):
+            proxy_pool = ProxyPool(config, proxies, engine=session.get_bind())
 
         progress_thread = None
 
         # Let the games begin
         if method in ('selenium', 'http'):
 
-            # Show the progress of the scraping
             q = queue.Queue()
-            progress_thread = ShowProgressQueue(config, q, len(scrape_jobs))
-            progress_thread.start()
 
-            workers = queue.Queue()
+            # the workers pull their jobs from the queue of their search engine
+            scheduler = JobScheduler(config)
+            threads = []
             num_worker = 0
             for search_engine in search_engines:
 
@@ -396,65 +501,87 @@ def main(return_results=False, parse_cmd_line=True, config_from_dict=None):
 
                     for worker in range(num_workers):
                         num_worker += 1
-                        workers.put(
-                            ScrapeWorkerFactory(
-                                config,
-                                cache_manager=cache_manager,
-                                mode=method,
-                                proxy=proxy,
-                                search_engine=search_engine,
-                                session=session,
-                                db_lock=db_lock,
-                                cache_lock=cache_lock,
-                                scraper_search=scraper_search,
-                                captcha_lock=captcha_lock,
-                                progress_queue=q,
-                                browser_num=num_worker
-                            )
+                        factory = ScrapeWorkerFactory(
+                            config,
+                            cache_manager=cache_manager,
+                            mode=method,
+                            proxy=proxy,
+                            search_engine=search_engine,
+                            session=session_cls,
+                            db_lock=db_lock,
+                            cache_lock=cache_lock,
+                            scraper_search=scraper_search,
+                            captcha_lock=captcha_lock,
+                            progress_queue=q,
+                            browser_num=num_worker,
+                            persistence=persistence,
+                            scheduler=scheduler,
+                            rate_limiter=rate_limiter,
+                            proxy_pool=proxy_pool,
                         )
+                        threads.append(factory.get_worker())
 
-            # here we look for suitable workers
-            # for all jobs created.
-            for job in scrape_jobs:
-                while True:
-                    worker = workers.get()
-                    workers.put(worker)
-                    if worker.is_suitabe(job):
-                        worker.add_job(job)
-                        break
-
-            threads = []
+            logger.info('Going to scrape with {num_proxies} proxies by using {num_threads} threads.'.format(
+                num_proxies=len(proxies),
+                num_threads=len(threads)))
 
-            while not workers.empty():
-                worker = workers.get()
-                thread = worker.get_worker()
-                if thread:
-                    threads.append(thread)
+            # Show the progress of the scraping, the total is known once all jobs are fed
+            progress_thread = ShowProgressQueue(config, q, None)
+            progress_thread.start()
 
             for t in threads:
                 t.start()
 
+            progress_thread.num_keywords = scheduler.feed(scrape_jobs)
+            scheduler.close()
+            logger.info('Queued {} scrape jobs.'.format(progress_thread.num_keywords))
+
             for t in threads:
                 t.join()
 
+            http_stats = [t.http.stats for t in threads if hasattr(t, 'http')]
+            if http_stats:
+                logger.info('HTTP: {}'.format(stats_info(sum(http_stats, collections.Counter()))))
+
+            if proxy_pool is not None:
+                proxy_pool.close()
+                for line in proxy_pool.summary():
+                    logger.info('Proxy {}'.format(line))
+
+            if scheduler.num_dropped or scheduler.num_failed:
+                logger.warning('{} pages were not scraped, {} failed too often.'.format(
+                    scheduler.num_dropped, scheduler.num_failed))
+
             # after threads are done, stop the progress queue.
             q.put('done')
             progress_thread.join()
 
         elif method == 'http-async':
             scheduler = AsyncScrapeScheduler(config, scrape_jobs, cache_manager=cache_manager, session=session, scraper_search=scraper_search,
-                                             db_lock=db_lock)
+                                             db_lock=db_lock, persistence=persistence, proxies=proxies,
+                                             rate_limiter=rate_limiter)
             scheduler.run()
 
         else:
             raise Exception('No such scrape_method {}'.format(config.get('scrape_method')))
 
+        for (search_engine, egress), rate in sorted(rate_limiter.rates().items()):
+            logger.info('Ended with {:.1f} requests per minute on {} via {}.'.format(rate, search_engine, egress))
+
+    if persistence:
+        persistence.close()
+
     from SearchAnalyzer.output_converter import close_outfile
     close_outfile()
 
+    cache_manager.close()
+
     scraper_search.stopped_searching = datetime.datetime.utcnow()
+    if scraper_search.number_search_queries is None:
+        scraper_search.number_search_queries = keyword_set.count
+    keyword_set.close()
     session.add(scraper_search)
     session.commit()
 
     if return_results:
-        return scraper_search
+        return ScrapeResults(session, scraper_search.id)
@@ -15,14 +15,19 @@ can be assigned to more than one ScraperSearch. Therefore we need a n:m relation
 """
 
 import datetime
+import logging
 from urllib.parse import urlparse
-from sqlalchemy import Column, String, Integer, ForeignKey, Table, DateTime, Enum, Boolean
+from sqlalchemy import Column, String, Integer, Float, ForeignKey, Table, DateTime, Enum, Boolean, Index
+from sqlalchemy import event, inspect
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, backref
 from sqlalchemy import create_engine, UniqueConstraint
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.orm import scoped_session
 from sqlalchemy.orm import sessionmaker
 
+logger = logging.getLogger(__name__)
+
 Base = declarative_base()
 
 scraper_searches_serps = Table('scraper_searches_serps', Base.metadata,
@@ -93,8 +98,9 @@ class SearchEngineResultsPage(Base):
     no_results = Column(Boolean, default=False)
 
     def __str__(self):
-        return '<SERP[{search_engine_name}] has [{num_results}] link results for query "{query}">'.format(
-            **self.__dict__)
+        # the SERP of a failed request has no results yet
+        return '<SERP[{}] has [{}] link results for query "{}">'.format(self.search_engine_name, self.num_results,
+                                                                       self.query)
 
     def __repr__(self):
         return self.__str__()
@@ -166,6 +172,10 @@ class SearchEngineResultsPage(Base):
 # Alias as a shorthand for working in the shell
 SERP = SearchEngineResultsPage
 
+# The lookup of CacheManager.get_serp_from_database()
+Index('ix_serp_lookup', SearchEngineResultsPage.query, SearchEngineResultsPage.search_engine_name,
+      SearchEngineResultsPage.scrape_method, SearchEngineResultsPage.page_number)
+
 
 class Link(Base):
     __tablename__ = 'link'
@@ -179,9 +189,11 @@ class Link(Base):
     rank = Column(Integer)
     link_type = Column(String)
 
-    serp_id = Column(Integer, ForeignKey('serp.id'))
+    serp_id = Column(Integer, ForeignKey('serp.id'), index=True)
     serp = relationship(SearchEngineResultsPage, backref=backref('links', uselist=True))
 
+    __table_args__ = (Index('ix_link_domain', 'domain'),)
+
     def __str__(self):
         return '<Link at rank {rank} has url: {link}>'.format(**self.__dict__)
 
@@ -214,6 +226,8 @@ class Proxy(Base):
 
     UniqueConstraint(ip, port, name='unique_proxy')
 
+    __table_args__ = (Index('ix_proxy_ip_port', 'ip', 'port'),)
+
     def __str__(self):
         return '<Proxy {ip}>'.format(**self.__dict__)
 
@@ -224,6 +238,39 @@ class Proxy(Base):
 db_Proxy = Proxy
 
 
+class ScrapeJob(Base):
+    """The state of a scrape job of a ScraperSearch, see ledger.py."""
+
+    __tablename__ = 'scrape_job'
+
+    id = Column(Integer, primary_key=True)
+    scraper_search_id = Column(Integer, ForeignKey('scraper_search.id'))
+    query = Column(String)
+    search_engine = Column(String)
+    scrape_method = Column(String)
+    page_number = Column(Integer)
+    search_type = Column(String, default='normal')
+
+    # pending, done or failed
+    status = Column(String, default='pending')
+    attempts = Column(Integer, default=0)
+    last_error = Column(String)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    updated_at = Column(DateTime)
+
+    __table_args__ = (
+        Index('ix_scrape_job_key', 'scraper_search_id', 'query', 'search_engine', 'scrape_method', 'page_number',
+              'search_type', unique=True),
+        Index('ix_scrape_job_status', 'scraper_search_id', 'status'),
+    )
+
+    def __str__(self):
+        return '<ScrapeJob[{search_engine}] "{query}" page {page_number}: {status}>'.format(**self.__dict__)
+
+    def __repr__(self):
+        return self.__str__()
+
+
 class SearchEngine(Base):
     __tablename__ = 'search_engine'
 
@@ -238,6 +285,7 @@ class SearchEngineProxyStatus(Base):
     """Stores last proxy status for the given search engine.
     
     A proxy can either work on a search engine or not.
+    The health of the proxy is kept up to date by the proxy pool, see proxy_pool.py.
     """
 
     __tablename__ = 'search_engine_proxy_status'
@@ -248,20 +296,192 @@ class SearchEngineProxyStatus(Base):
     available = Column(Boolean)
     last_check = Column(DateTime)
 
+    # moving averages of the response time in seconds and of the share of successful requests
+    latency = Column(Float)
+    success_rate = Column(Float)
+    num_requests = Column(Integer, default=0)
+    num_failures = Column(Integer, default=0)
+    num_bans = Column(Integer, default=0)
+    # how often the proxy was quarantined since its last successful request
+    backoff = Column(Integer, default=0)
+    quarantined_until = Column(DateTime)
+
+    __table_args__ = (Index('ix_search_engine_proxy_status', 'proxy_id', 'search_engine_id'),)
+
+
+# The PRAGMAs of the `sqlite_profile` options.
+# 'fast' is safe against crashes of SearchAnalyzer, but the last commits may be lost on power loss.
+SQLITE_PROFILES = {
+    'default': {},
+    'safe': {
+        'journal_mode': 'WAL',
+        'synchronous': 'FULL',
+    },
+    'fast': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        # in kibibytes if negative
+        'cache_size': -64 * 1024,
+        'mmap_size': 256 * 1024 * 1024,
+        'temp_store': 'MEMORY',
+    },
+}
+
+
+class SerpList(object):
+    """A read-only sequence of the SERPs of a query. Loads the SERPs on demand."""
+
+    def __init__(self, query, batch_size=1000):
+        self.query = query
+        self.batch_size = batch_size
+
+    def __len__(self):
+        return self.query.count()
+
+    def __iter__(self):
+        return iter(self.query.yield_per(self.batch_size))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.query[index]
+        if index < 0:
+            index += len(self)
+        serp = self.query.offset(index).first() if index >= 0 else None
+        if serp is None:
+            raise IndexError('SERP index out of range')
+        return serp
+
+
+class ScrapeResults(object):
+    """A handle to the results of a scraper search.
+
+    Has the attributes of the ScraperSearch, but its `serps` are queried lazily instead
+    of loading all of them with their links into the session.
+    """
+
+    def __init__(self, session, scraper_search_id):
+        self.session = session
+        self.scraper_search_id = scraper_search_id
+
+    @property
+    def scraper_search(self):
+        return self.session.query(ScraperSearch).get(self.scraper_search_id)
+
+    @property
+    def serps(self):
+        query = self.session.query(SearchEngineResultsPage).join(
+            scraper_searches_serps, scraper_searches_serps.c.serp_id == SearchEngineResultsPage.id
+        ).filter(scraper_searches_serps.c.scraper_search_id == self.scraper_search_id)
+        return SerpList(query.order_by(SearchEngineResultsPage.id))
+
+    @property
+    def links(self):
+        """A query of the links of all SERPs."""
+        return self.session.query(Link).join(
+            scraper_searches_serps, scraper_searches_serps.c.serp_id == Link.serp_id
+        ).filter(scraper_searches_serps.c.scraper_search_id == self.scraper_search_id)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.scraper_search, name)
+
+    def __repr__(self):
+        return '<ScrapeResults of {!r}>'.format(self.scraper_search)
+
+
+def sqlite_pragmas(config):
+    """The PRAGMAs of the configured `sqlite_profile` plus the single sqlite_* overrides.
+
+    Raises:
+        ValueError if there is no such profile.
+    """
+    profile = config.get('sqlite_profile', 'default')
+    if profile not in SQLITE_PROFILES:
+        raise ValueError('No such sqlite profile "{}". Use one of {}'.format(profile, ', '.join(SQLITE_PROFILES)))
+
+    pragmas = dict(SQLITE_PROFILES[profile])
+    for pragma in ('journal_mode', 'synchronous', 'cache_size', 'mmap_size'):
+        value = config.get('sqlite_' + pragma)
+        if value not in (None, ''):
+            pragmas[pragma] = value
+    return pragmas
+
+
+def migrate(engine):
+    """Create the columns and indexes that databases of older versions of SearchAnalyzer lack.
+
+    create_all() only creates the columns and indexes of tables it creates.
+    The added columns are nullable and existing rows get NULL.
+    """
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in columns:
+                logger.info('Adding column {} to {}'.format(column.name, table.name))
+                engine.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                    table.name, column.name, column.type.compile(engine.dialect)))
+
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                logger.info('Creating index {} on {}'.format(index.name, table.name))
+                index.create(engine)
+
+
+def database_url(config, path=None):
+    """The sqlalchemy url of the results database.
+
+    Args:
+        path: The path of a sqlite database. Takes precedence over the configuration.
+
+    Returns:
+        The `database_url` option or the sqlite database `database_name` in the working directory.
+    """
+    if path:
+        return 'sqlite:///' + path
+    return config.get('database_url') or 'sqlite:///' + config.get('database_name', 'search_analyzer') + '.db'
+
 
 def get_engine(config, path=None):
     """Return the sqlalchemy engine.
 
+    Every connection to a sqlite database is set up with the PRAGMAs of the `sqlite_profile`.
+    Connections to database servers are pooled, `database_pool_size` of them are kept open.
+
     Args:
         path: The path/name of the database to create/read from.
 
     Returns:
         The sqlalchemy engine.
     """
-    db_path = path if path else config.get('database_name', 'search_analyzer') + '.db'
+    url = make_url(database_url(config, path))
     echo = config.get('log_sqlalchemy', False)
-    engine = create_engine('sqlite:///' + db_path, echo=echo, connect_args={'check_same_thread': False})
+
+    if url.get_backend_name() == 'sqlite':
+        engine = create_engine(url, echo=echo, connect_args={'check_same_thread': False})
+
+        pragmas = sqlite_pragmas(config)
+
+        @event.listens_for(engine, 'connect')
+        def set_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for pragma, value in pragmas.items():
+                cursor.execute('PRAGMA {} = {}'.format(pragma, value))
+            cursor.close()
+    else:
+        engine = create_engine(
+            url,
+            echo=echo,
+            pool_size=int(config.get('database_pool_size', 5)),
+            max_overflow=int(config.get('database_max_overflow', 10)),
+            pool_timeout=float(config.get('database_pool_timeout', 30)),
+            pool_pre_ping=True,
+        )
+
     Base.metadata.create_all(engine)
+    migrate(engine)
 
     return engine
 
@@ -1,15 +1,14 @@
 # -*- coding: utf-8 -*-
 
 import datetime
-import json
 import logging
-import socket
 import threading
 from urllib.parse import urlencode
 
-import SearchAnalyzer.socks as socks
 from SearchAnalyzer.parser.tools import get_parser_by_search_engine
-from SearchAnalyzer.scraping import SearchEngineScrape, get_base_search_url_by_search_engine
+from SearchAnalyzer.proxy_pool import proxy_name
+from SearchAnalyzer.scraping import SearchEngineScrape, detect_block, get_base_search_url_by_search_engine
+from SearchAnalyzer.transport import get_http_session, stats_info
 from SearchAnalyzer.user_agents import random_user_agent
 
 logger = logging.getLogger(__name__)
@@ -151,10 +150,15 @@ class HttpScrape(SearchEngineScrape, threading.Timer):
         and from threading.Timer.
         """
         threading.Timer.__init__(self, time_offset, self.search)
+
+        # The http session of this worker, set_proxy() routes it through the proxy of the worker
+        self.http = get_http_session(config=config)
+        # the sessions of the other proxies the worker used, keeping their connections alive
+        self.http_sessions = {}
+
         SearchEngineScrape.__init__(self, config, *args, **kwargs)
 
-        # Bind the requests module to this instance such that each
-        # instance may have an own proxy
+        # the exceptions of the requests module
         self.requests = __import__('requests')
 
         # initialize the GET parameters for the search request
@@ -178,61 +182,29 @@ class HttpScrape(SearchEngineScrape, threading.Timer):
             self.startable = False
 
     def set_proxy(self):
-        """Setup a socks connection for the socks module bound to this instance.
+        """Route the requests of this worker through its proxy.
 
-        Args:
-            proxy: Namedtuple, Proxy to use for this thread.
+        Only the connections of this instance use the proxy, the socket module isn't patched.
         """
-
-        def create_connection(address, timeout=None, source_address=None):
-            sock = socks.socksocket()
-            sock.connect(address)
-            return sock
-
-        pmapping = {
-            'socks4': 1,
-            'socks5': 2,
-            'http': 3
-        }
-        # Patch the socket module
-        # rdns is by default on true. Never use rnds=False with TOR, otherwise you are screwed!
-        socks.setdefaultproxy(pmapping.get(self.proxy.proto), self.proxy.host, int(self.proxy.port), rdns=True)
-        socks.wrap_module(socket)
-        socket.create_connection = create_connection
+        self.http.close()
+        self.http = get_http_session(self.proxy, self.config, stats=self.http.stats)
 
     def switch_proxy(self, proxy):
-        super().switch_proxy()
-
-    def proxy_check(self, proxy):
-        assert self.proxy and self.requests, 'ScraperWorker needs valid proxy instance and requests library to make ' \
-                                             'the proxy check.'
-
-        online = False
-        status = 'Proxy check failed: {host}:{port} is not used while requesting'.format(**self.proxy.__dict__)
-        ipinfo = {}
-
-        try:
-            text = self.requests.get(self.config.get('proxy_info_url')).text
-            try:
-                ipinfo = json.loads(text)
-            except ValueError:
-                pass
-        except self.requests.ConnectionError as e:
-            status = 'No connection to proxy server possible, aborting: {}'.format(e)
-        except self.requests.Timeout as e:
-            status = 'Timeout while connecting to proxy server: {}'.format(e)
-        except self.requests.exceptions.RequestException as e:
-            status = 'Unknown exception: {}'.format(e)
+        """Route the next requests through another proxy, None for the own IP.
 
-        if 'ip' in ipinfo and ipinfo['ip']:
-            online = True
-            status = 'Proxy is working.'
-        else:
-            logger.warning(status)
-
-        super().update_proxy_status(status, ipinfo, online)
+        The session of the previous proxy is kept, such that its connections are reused when
+        the worker switches back.
+        """
+        if proxy == self.proxy:
+            return
 
-        return online
+        previous = self.http
+        self.http_sessions[self.proxy] = previous
+        self.proxy = proxy
+        self.http = self.http_sessions.pop(proxy, None)
+        if self.http is None:
+            self.http = get_http_session(proxy, self.config, stats=previous.stats)
+        self.requested_by = proxy_name(proxy)
 
     def handle_request_denied(self, status_code=''):
         """Handle request denied by the search engine.
@@ -266,17 +238,26 @@ class HttpScrape(SearchEngineScrape, threading.Timer):
         """
 
         success = True
+        # the response time and whether the search engine blocked the request, for the proxy pool
+        latency = None
+        blocked = False
+        # a captcha or error page is no SERP
+        denied = False
 
         self.build_search()
 
         if rand:
             self.headers['User-Agent'] = random_user_agent(only_desktop=True)
 
+        super().acquire_proxy()
+        # don't keep the page of the previous search if no response arrives
+        self.html = ''
+
         try:
             super().detection_prevention_sleep()
             super().keyword_info()
 
-            request = self.requests.get(self.base_search_url + urlencode(self.search_params),
+            request = self.http.get(self.base_search_url + urlencode(self.search_params),
                                         headers=self.headers, timeout=timeout)
 
             self.requested_at = datetime.datetime.utcnow()
@@ -298,21 +279,39 @@ class HttpScrape(SearchEngineScrape, threading.Timer):
             # in the actual request, just end the worker.
             self.status = 'Stopping scraping because {}'.format(e)
         else:
-            if not request.ok:
+            latency = request.elapsed.total_seconds()
+            blocked = detect_block(self.search_engine_name, request.status_code, request.url, self.html)
+            super().report_response(blocked)
+            if blocked or not request.ok:
                 self.handle_request_denied(request.status_code)
                 success = False
+                denied = True
+        finally:
+            super().release_proxy(success and latency is not None, latency=latency, blocked=blocked)
 
-        super().after_search()
+        super().after_search(store=latency is not None and not denied)
 
         return success
 
     def run(self):
-        super().before_search()
-
-        if self.startable:
-            for self.query, self.pages_per_keyword in self.jobs.items():
-
-                for self.page_number in self.pages_per_keyword:
-
-                    if not self.search(rand=True):
-                        self.missed_keywords.add(self.query)
+        try:
+            super().before_search()
+
+            if self.startable:
+                for self.query, self.pages_per_keyword in self.jobs.items():
+
+                    for i, self.page_number in enumerate(self.pages_per_keyword):
+
+                        if self.search(rand=True):
+                            self.consecutive_failures = 0
+                        elif self.search_failed(self.pages_per_keyword[i:]):
+                            break
+
+                    if self.banned:
+                        break
+        finally:
+            self.jobs.close()
+            self.http.close()
+            for http in self.http_sessions.values():
+                http.close()
+            logger.debug('{}: {}'.format(self.name, stats_info(self.http.stats)))
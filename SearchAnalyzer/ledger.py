@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import logging
+
+from sqlalchemy import and_, bindparam, func, select
+
+from SearchAnalyzer.database import ScrapeJob
+from SearchAnalyzer.utils import chunked
+
+"""
+A durable ledger of the scrape jobs of a ScraperSearch.
+
+When a scrape starts, every scrape job is registered as a pending row in the scrape_job
+table. The persistence thread marks the job of every stored SERP as done or failed in the
+same transaction that inserts the SERP. Resuming a scrape after a crash (continue_last_scrape)
+then selects the pending and failed rows of the scraper search with an index, instead of
+looking up every job of the keyword file in the cache again.
+
+Failed jobs are retried until they failed `job_ledger_max_attempts` times.
+"""
+
+logger = logging.getLogger(__name__)
+
+JOB_KEY = ('query', 'search_engine', 'scrape_method', 'page_number')
+
+# how many rows are inserted per statement
+REGISTER_BATCH_SIZE = 10000
+
+job_table = ScrapeJob.__table__
+
+
+def insert_ignore(dialect):
+    """An insert into the scrape_job table that skips rows that are already registered."""
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        return insert(job_table).on_conflict_do_nothing()
+    if dialect == 'mysql':
+        return job_table.insert().prefix_with('IGNORE')
+    return job_table.insert().prefix_with('OR IGNORE')
+
+
+def finish_jobs(connection, scraper_search_id, search_type, serps):
+    """Mark the jobs of stored SERPs as done or failed.
+
+    Args:
+        connection: The connection of the transaction that stores the SERPs.
+        scraper_search_id: The id of the ScraperSearch of the jobs.
+        search_type: The search type of the jobs.
+        serps: The SERP objects. Jobs of SERPs with another status than 'successful' failed.
+    """
+    if not serps:
+        return
+
+    statement = job_table.update().where(and_(
+        job_table.c.scraper_search_id == bindparam('b_scraper_search_id'),
+        job_table.c.search_type == bindparam('b_search_type'),
+        job_table.c.query == bindparam('b_query'),
+        job_table.c.search_engine == bindparam('b_search_engine'),
+        job_table.c.scrape_method == bindparam('b_scrape_method'),
+        job_table.c.page_number == bindparam('b_page_number'),
+    )).values(
+        status=bindparam('b_status'),
+        last_error=bindparam('b_last_error'),
+        attempts=job_table.c.attempts + 1,
+        updated_at=bindparam('b_updated_at'),
+    )
+
+    now = datetime.datetime.utcnow()
+    rows = []
+    for serp in serps:
+        successful = serp.status in (None, 'successful')
+        rows.append({
+            'b_scraper_search_id': scraper_search_id,
+            'b_search_type': search_type,
+            'b_query': serp.query,
+            'b_search_engine': serp.search_engine_name,
+            'b_scrape_method': serp.scrape_method,
+            'b_page_number': serp.page_number,
+            'b_status': 'done' if successful else 'failed',
+            'b_last_error': None if successful else serp.status,
+            'b_updated_at': now,
+        })
+    connection.execute(statement, rows)
+
+
+class JobLedger(object):
+    """The scrape jobs of a ScraperSearch in the scrape_job table."""
+
+    def __init__(self, config, engine, scraper_search_id):
+        """Create the ledger.
+
+        Args:
+            config: The configuration.
+            engine: The sqlalchemy engine of the results database.
+            scraper_search_id: The id of the ScraperSearch.
+        """
+        self.engine = engine
+        self.scraper_search_id = scraper_search_id
+        self.search_type = config.get('search_type', 'normal')
+        self.max_attempts = int(config.get('job_ledger_max_attempts', 3))
+
+    def __len__(self):
+        statement = select([func.count()]).select_from(job_table).where(
+            job_table.c.scraper_search_id == self.scraper_search_id)
+        with self.engine.connect() as connection:
+            return connection.execute(statement).scalar()
+
+    def register(self, jobs):
+        """Add the scrape jobs as pending. Call it once for a new ScraperSearch.
+
+        The jobs are consumed lazily, duplicates are ignored.
+
+        Returns:
+            The number of registered jobs.
+        """
+        now = datetime.datetime.utcnow()
+        with self.engine.begin() as connection:
+            statement = insert_ignore(connection.dialect.name)
+            for batch in chunked(jobs, REGISTER_BATCH_SIZE):
+                rows = []
+                for job in batch:
+                    row = {key: job.get(key) for key in JOB_KEY}
+                    row.update(scraper_search_id=self.scraper_search_id, search_type=self.search_type,
+                               status='pending', attempts=0, created_at=now)
+                    rows.append(row)
+                connection.execute(statement, rows)
+        return len(self)
+
+    def pending(self):
+        """The jobs that are pending or failed less than `job_ledger_max_attempts` times.
+
+        The jobs are read in pages of REGISTER_BATCH_SIZE rows.
+
+        Yields:
+            Scrape job dicts.
+        """
+        last_id = 0
+        while True:
+            statement = select([job_table.c.id] + [job_table.c[key] for key in JOB_KEY]).where(and_(
+                job_table.c.scraper_search_id == self.scraper_search_id,
+                job_table.c.status.in_(('pending', 'failed')),
+                job_table.c.attempts < self.max_attempts,
+                job_table.c.id > last_id,
+            )).order_by(job_table.c.id).limit(REGISTER_BATCH_SIZE)
+            with self.engine.connect() as connection:
+                rows = connection.execute(statement).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield dict(zip(JOB_KEY, row[1:]))
+            last_id = rows[-1][0]
+
+    def num_pending(self):
+        statement = select([func.count()]).select_from(job_table).where(and_(
+            job_table.c.scraper_search_id == self.scraper_search_id,
+            job_table.c.status.in_(('pending', 'failed')),
+            job_table.c.attempts < self.max_attempts,
+        ))
+        with self.engine.connect() as connection:
+            return connection.execute(statement).scalar()
+
+    def counts(self):
+        """A dict that maps the status to the number of jobs."""
+        statement = select([job_table.c.status, func.count()]).where(
+            job_table.c.scraper_search_id == self.scraper_search_id).group_by(job_table.c.status)
+        with self.engine.connect() as connection:
+            return dict(connection.execute(statement).fetchall())
@@ -0,0 +1,409 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import pickle
+import struct
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # no advisory file locks on this platform, only threads
+    # of the same process are synchronized then.
+    fcntl = None
+
+"""
+A cache backend that packs SERP pages into a few large segment files.
+
+Storing each SERP page in its own file exhausts the inodes of the file system
+when millions of pages are cached, and listing or backing up such directories
+takes ages. The packed backend appends all pages to segment files instead:
+
+    {cachedir}/packed/segment-000001.seg
+    {cachedir}/packed/segment-000002.seg
+    ...
+
+Each record in a segment consists of a fixed size header, the cache name
+(the hash as returned by CacheManager.cached_file_name()), the name of the compression
+algorithm and the compressed data. A record with the TOMBSTONE flag marks a
+deleted entry. The last record of a name wins.
+
+The offset index (which record in which segment holds the data for a name) lives in
+memory. It is rebuilt by reading the record headers of all segments or loaded from
+a snapshot; in the latter case only the segment tails written after the snapshot
+was taken are read.
+
+Appends are serialized with a lock file, so several scraper processes may share one
+packed cache. compact() rewrites all live and non-expired records into fresh
+segments and deletes the old ones.
+"""
+
+logger = logging.getLogger(__name__)
+
+# magic, flags, length of name, length of compression, mtime, length of data
+RECORD_HEADER = struct.Struct('<4sBHBdI')
+RECORD_MAGIC = b'SAPC'
+TOMBSTONE = 1
+
+PackedEntry = namedtuple('PackedEntry', 'segment, offset, length, compression, mtime')
+
+
+class CorruptSegmentException(Exception):
+    pass
+
+
+class PackedCacheBackend(object):
+    """Stores cached SERP pages in append-only segment files."""
+
+    packed_dir = 'packed'
+    segment_fmt = 'segment-{:06d}.seg'
+    snapshot_name = 'index.snapshot'
+    lock_name = '.lock'
+
+    def __init__(self, config, path=None):
+        self.config = config
+        self.path = path or os.path.join(self.config.get('cachedir', '.scrapecache'), self.packed_dir)
+        self.max_segment_size = int(self.config.get('packed_cache_segment_size', 256 * 1024 * 1024))
+
+        self.entries = {}
+        # the size of all live records in bytes
+        self.size = 0
+        # segment number => number of bytes that were indexed
+        self.indexed = {}
+        self.read_fds = {}
+        self.lock = threading.RLock()
+
+    @property
+    def snapshot_path(self):
+        return os.path.join(self.path, self.snapshot_name)
+
+    def segment_path(self, segment):
+        return os.path.join(self.path, self.segment_fmt.format(segment))
+
+    def segments(self):
+        """All segment numbers on disk in ascending order."""
+        numbers = []
+        for fname in os.listdir(self.path):
+            if fname.startswith('segment-') and fname.endswith('.seg'):
+                try:
+                    numbers.append(int(fname[len('segment-'):-len('.seg')]))
+                except ValueError:
+                    pass
+        return sorted(numbers)
+
+    @contextmanager
+    def file_lock(self, exclusive=True):
+        """Lock the packed directory against other processes."""
+        if not fcntl:
+            yield
+            return
+
+        with open(os.path.join(self.path, self.lock_name), 'a') as fd:
+            fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def open(self):
+        os.makedirs(self.path, exist_ok=True)
+
+        with self.lock, self.file_lock(exclusive=False):
+            if not self._load_snapshot():
+                self._reset()
+            self.refresh()
+
+        logger.debug('Packed cache {} has {} entries in {} segments'.format(self.path, len(self.entries),
+                                                                         len(self.indexed)))
+
+    def close(self):
+        with self.lock:
+            self.save()
+            self._close_read_fds()
+
+    def refresh(self):
+        """Index all records that were appended since the last refresh (by us or other processes)."""
+        with self.lock:
+            on_disk = self.segments()
+
+            if set(self.indexed) - set(on_disk):
+                # segments were compacted away by another process, start from scratch
+                self._reset()
+                self._close_read_fds()
+
+            for segment in on_disk:
+                self._scan_segment(segment, self.indexed.get(segment, 0))
+
+    def _reset(self):
+        self.entries, self.indexed, self.size = {}, {}, 0
+
+    def _set_entry(self, name, entry):
+        old = self.entries.get(name)
+        if old:
+            self.size -= old.length
+        self.entries[name] = entry
+        self.size += entry.length
+
+    def _drop_entry(self, name):
+        old = self.entries.pop(name, None)
+        if old:
+            self.size -= old.length
+
+    def _scan_segment(self, segment, offset):
+        """Index the records of a segment starting at offset."""
+        path = self.segment_path(segment)
+        with open(path, 'rb') as fd:
+            fd.seek(offset)
+            while True:
+                header = fd.read(RECORD_HEADER.size)
+                if not header:
+                    break
+
+                try:
+                    record = self._parse_header(header)
+                except CorruptSegmentException as e:
+                    # a torn write of a crashed process. The next append truncates it.
+                    logger.warning('{} at offset {}: {}'.format(path, offset, e))
+                    break
+
+                flags, name_len, comp_len, mtime, data_len = record
+                names = fd.read(name_len + comp_len)
+                if len(names) < name_len + comp_len:
+                    break
+
+                name = names[:name_len].decode()
+                compression = names[name_len:].decode()
+                data_offset = offset + RECORD_HEADER.size + name_len + comp_len
+
+                fd.seek(data_len, os.SEEK_CUR)
+                if fd.tell() > os.fstat(fd.fileno()).st_size:
+                    break
+
+                if flags & TOMBSTONE:
+                    self._drop_entry(name)
+                else:
+                    self._set_entry(name, PackedEntry(segment, data_offset, data_len, compression, mtime))
+
+                offset = data_offset + data_len
+
+        self.indexed[segment] = offset
+
+    @staticmethod
+    def _parse_header(header):
+        if len(header) < RECORD_HEADER.size:
+            raise CorruptSegmentException('Incomplete record header')
+
+        magic, flags, name_len, comp_len, mtime, data_len = RECORD_HEADER.unpack(header)
+        if magic != RECORD_MAGIC:
+            raise CorruptSegmentException('Invalid record magic {}'.format(magic))
+
+        return flags, name_len, comp_len, mtime, data_len
+
+    def _load_snapshot(self):
+        try:
+            with open(self.snapshot_path, 'rb') as fd:
+                indexed, entries = pickle.load(fd)
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            return False
+
+        self.indexed = indexed
+        self.entries = {name: PackedEntry(*values) for name, values in entries.items()}
+        self.size = sum(entry.length for entry in self.entries.values())
+        return True
+
+    def save(self):
+        """Persist the offset index."""
+        if not os.path.isdir(self.path):
+            return
+
+        with self.lock:
+            entries = {name: tuple(entry) for name, entry in self.entries.items()}
+            indexed = dict(self.indexed)
+
+        tmp = self.snapshot_path + '.{}.tmp'.format(os.getpid())
+        with open(tmp, 'wb') as fd:
+            pickle.dump((indexed, entries), fd, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.snapshot_path)
+
+    def _active_segment(self):
+        """The segment to append to. Opens a new one when the last one is full.
+
+        Must be called with the file lock held.
+        """
+        on_disk = self.segments()
+        if not on_disk:
+            segment = 1
+        else:
+            segment = on_disk[-1]
+            if os.path.getsize(self.segment_path(segment)) >= self.max_segment_size:
+                segment += 1
+
+        if segment not in self.indexed:
+            open(self.segment_path(segment), 'ab').close()
+            self.indexed[segment] = 0
+
+        return segment
+
+    def _append(self, name, raw, compression, mtime, flags=0):
+        name_bytes = name.encode()
+        comp_bytes = compression.encode()
+        header = RECORD_HEADER.pack(RECORD_MAGIC, flags, len(name_bytes), len(comp_bytes), mtime, len(raw))
+
+        with self.lock, self.file_lock():
+            segment = self._active_segment()
+            # pick up what other processes appended in the meantime
+            self._scan_segment(segment, self.indexed[segment])
+            offset = self.indexed[segment]
+
+            with open(self.segment_path(segment), 'r+b') as fd:
+                # drop a torn record of a crashed writer
+                fd.truncate(offset)
+                fd.seek(offset)
+                fd.write(header + name_bytes + comp_bytes + raw)
+
+            data_offset = offset + RECORD_HEADER.size + len(name_bytes) + len(comp_bytes)
+            self.indexed[segment] = data_offset + len(raw)
+
+            if flags & TOMBSTONE:
+                self._drop_entry(name)
+            else:
+                self._set_entry(name, PackedEntry(segment, data_offset, len(raw), compression, mtime))
+
+    def _read_fd(self, segment):
+        fd = self.read_fds.get(segment)
+        if fd is None:
+            fd = os.open(self.segment_path(segment), os.O_RDONLY)
+            self.read_fds[segment] = fd
+        return fd
+
+    def _close_read_fds(self):
+        for fd in self.read_fds.values():
+            os.close(fd)
+        self.read_fds = {}
+
+    def lookup(self, name):
+        return self.entries.get(name)
+
+    def read_raw(self, name):
+        """Returns the tuple (compressed data, compression) for name or None."""
+        with self.lock:
+            entry = self.entries.get(name)
+            if not entry:
+                return None
+
+            try:
+                fd = self._read_fd(entry.segment)
+            except FileNotFoundError:
+                # compacted by another process
+                self.refresh()
+                entry = self.entries.get(name)
+                if not entry:
+                    return None
+                fd = self._read_fd(entry.segment)
+
+            return os.pread(fd, entry.length, entry.offset), entry.compression
+
+    def write_raw(self, name, raw, compression, mtime=None):
+        self._append(name, raw, compression, mtime or time.time())
+
+    def remove(self, name):
+        if name in self.entries:
+            self._append(name, b'', '', time.time(), flags=TOMBSTONE)
+
+    def names(self):
+        return list(self.entries.keys())
+
+    def entry_size(self, name):
+        entry = self.entries.get(name)
+        return entry.length if entry else 0
+
+    def maybe_reclaim(self):
+        """Compact the segments when most of their bytes belong to removed or overwritten records.
+
+        Returns:
+            True if the segments were compacted.
+        """
+        with self.lock:
+            on_disk = sum(self.indexed.values())
+            if on_disk < self.max_segment_size or on_disk < 2 * self.size:
+                return False
+
+        logger.info('Compacting packed cache {}, {} of {} bytes are live'.format(self.path, self.size, on_disk))
+        self.compact()
+        return True
+
+    def compact(self, max_age=None):
+        """Rewrite all live records into new segments and delete the old segments.
+
+        Args:
+            max_age: Records older than max_age seconds are dropped. Keep all if None.
+
+        Returns:
+            The number of dropped entries.
+        """
+        deadline = time.time() - max_age if max_age is not None else None
+
+        with self.lock, self.file_lock():
+            self.refresh()
+            old_segments = self.segments()
+            if not old_segments:
+                return 0
+
+            segment = old_segments[-1] + 1
+            written = 0
+            out = open(self.segment_path(segment), 'wb')
+            entries = {}
+            dropped = 0
+
+            try:
+                for name, entry in sorted(self.entries.items(), key=lambda item: item[1][:2]):
+                    if deadline is not None and entry.mtime < deadline:
+                        dropped += 1
+                        continue
+
+                    raw = os.pread(self._read_fd(entry.segment), entry.length, entry.offset)
+                    name_bytes = name.encode()
+                    comp_bytes = entry.compression.encode()
+
+                    if written >= self.max_segment_size:
+                        out.close()
+                        segment += 1
+                        written = 0
+                        out = open(self.segment_path(segment), 'wb')
+
+                    out.write(RECORD_HEADER.pack(RECORD_MAGIC, 0, len(name_bytes), len(comp_bytes), entry.mtime,
+                                                 len(raw)))
+                    out.write(name_bytes + comp_bytes + raw)
+
+                    data_offset = written + RECORD_HEADER.size + len(name_bytes) + len(comp_bytes)
+                    entries[name] = PackedEntry(segment, data_offset, len(raw), entry.compression, entry.mtime)
+                    written = data_offset + len(raw)
+
+                out.flush()
+                os.fsync(out.fileno())
+            finally:
+                out.close()
+
+            self._close_read_fds()
+            for old in old_segments:
+                os.remove(self.segment_path(old))
+
+            self.entries = entries
+            self.size = sum(entry.length for entry in entries.values())
+            self.indexed = {}
+            for segment in self.segments():
+                self.indexed[segment] = os.path.getsize(self.segment_path(segment))
+
+            self.save()
+
+        return dropped
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __len__(self):
+        return len(self.entries)
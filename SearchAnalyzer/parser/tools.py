@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 
+import functools
+import hashlib
 import os
 import re
 import sys
+from collections import namedtuple
 
 from SearchAnalyzer.database import SearchEngineResultsPage
 from SearchAnalyzer.parser.ask_parser import AskParser
@@ -16,6 +19,15 @@ from SearchAnalyzer.parser.yahoo_parser import YahooParser
 from SearchAnalyzer.parser.yandex_parser import YandexParser
 from SearchAnalyzer.parser.exception import UnknowUrlException, NoParserForSearchEngineException
 
+# The values of a parser that make up a SERP. Unlike a parser
+# it can be pickled and sent between processes.
+ParseResult = namedtuple('ParseResult', 'num_results_for_query, num_results, effective_query, no_results, '
+                                        'total_results, search_results')
+
+# Bump this when the parsing code changes the results it extracts. Changes of
+# the selectors of a parser are picked up by parser_version() anyway.
+PARSE_RESULT_VERSION = 1
+
 
 def get_parser_by_url(url):
     """Get the appropriate parser by an search engine url.
@@ -89,6 +101,58 @@ def get_parser_by_search_engine(search_engine):
         raise NoParserForSearchEngineException('No such parser for "{}"'.format(search_engine))
 
 
+def parse_result_from_parser(parser):
+    """Get the ParseResult of a parser that has parsed a SERP page."""
+    return ParseResult(
+        num_results_for_query=parser.num_results_for_query,
+        num_results=parser.num_results,
+        effective_query=parser.effective_query,
+        no_results=parser.no_results,
+        total_results=parser.total_results,
+        search_results=parser.search_results
+    )
+
+
+@functools.lru_cache()
+def parser_version(search_engine, search_type='normal'):
+    """A tag that changes whenever the parser of the search engine would extract other results.
+
+    Args:
+        search_engine: The name of the search engine.
+        search_type: The search type of the configuration.
+
+    Returns:
+        A short hex string derived from PARSE_RESULT_VERSION and all selectors of the parser.
+    """
+    parser = get_parser_by_search_engine(search_engine)
+    selectors = {}
+    for cls in reversed(parser.__mro__):
+        for name, value in vars(cls).items():
+            if name.endswith(('_selector', '_selectors', '_re')) or name == 'search_types':
+                selectors[name] = value
+
+    tag = '{}|{}|{}|{}'.format(PARSE_RESULT_VERSION, search_engine, search_type, repr(sorted(selectors.items())))
+    return hashlib.sha1(tag.encode()).hexdigest()[:16]
+
+
+def parse_html(config, html, search_engine, query=''):
+    """Parse a SERP page.
+
+    Args:
+        config: The configuration.
+        html: The html of the SERP page.
+        search_engine: The search engine the SERP page belongs to.
+        query: The query of the SERP page.
+
+    Returns:
+        A ParseResult. It can be passed as parser to parse_serp().
+    """
+    parser = get_parser_by_search_engine(search_engine)
+    parser = parser(config, query=query)
+    parser.parse(html)
+    return parse_result_from_parser(parser)
+
+
 def parse_serp(config, html=None, parser=None, scraper=None, search_engine=None, query=''):
     """Store the parsed data in the sqlalchemy session.
 
@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+
+import io
+import logging
+import queue
+import threading
+import time
+from collections import namedtuple
+
+from sqlalchemy import inspect
+
+from SearchAnalyzer.database import Link, SearchEngineResultsPage, scraper_searches_serps
+from SearchAnalyzer.ledger import JobLedger, finish_jobs
+
+"""
+Stores the scraped SERP pages in the database from a single thread.
+
+When every scraping thread adds its SERP to the shared session and commits it, all
+threads serialize on the db lock and SQLite syncs the database file once per SERP page.
+Instead, the scraping threads hand their SERP objects to a SerpPersistence. Its thread
+drains the queue and inserts the SERPs, their links and their association with the
+ScraperSearch with plain insert statements, committing once per batch. A batch is written
+when `persistence_batch_size` rows are pending or the oldest pending SERP waited for
+`persistence_flush_interval` milliseconds.
+
+On PostgreSQL, the SERPs of a batch are inserted with multi-row inserts that return
+their ids and the links are loaded with COPY.
+
+put() returns an Ack that is set once the SERP is committed, flush() waits until
+everything that was put so far is committed. A batch that cannot be committed is tried
+again `persistence_retries` times, waiting `persistence_retry_delay` seconds and twice as
+long every time. If it still fails, the thread stops and the scrape fails: put(), link(),
+flush() and close() raise the error. The jobs of the lost SERPs stay pending in the job
+ledger, such that they are scraped again when the scrape is continued. SERPs that are already in the database,
+like the ones replayed from the cache, are associated with the ScraperSearch with link().
+The jobs of the SERPs are finished in the job ledger in the same transaction, see ledger.py.
+
+The SERP objects are never added to a session and dropped once they are written, the
+thread only keeps counters. Thus memory stays flat no matter how many keywords are
+scraped; get the results afterwards with database.ScrapeResults.
+"""
+
+logger = logging.getLogger(__name__)
+
+SERP_COLUMNS = [column.name for column in SearchEngineResultsPage.__table__.columns if column.name != 'id']
+LINK_COLUMNS = [column.name for column in Link.__table__.columns if column.name not in ('id', 'serp_id')]
+
+
+# A SERP that is already stored, with the attributes that finish_jobs() needs
+LinkedSerp = namedtuple('LinkedSerp', 'id query search_engine_name scrape_method page_number status')
+
+
+def serp_row(serp):
+    """The values of a transient SERP object as dict. Unset columns get their defaults on insert."""
+    values = ((name, getattr(serp, name)) for name in SERP_COLUMNS)
+    return {name: value for name, value in values if value is not None}
+
+
+def link_rows(serp):
+    return [{name: getattr(link, name) for name in LINK_COLUMNS} for link in serp.links]
+
+
+def csv_rows(rows, columns):
+    """The rows as csv for COPY ... WITH (FORMAT csv).
+
+    Strings are quoted, such that unquoted empty fields are NULL and quoted ones empty strings.
+    """
+    def field(value):
+        if value is None:
+            return ''
+        if isinstance(value, (int, float)):
+            return str(value)
+        return '"' + str(value).replace('"', '""') + '"'
+
+    buf = io.StringIO()
+    for row in rows:
+        buf.write(','.join(field(row.get(column)) for column in columns) + '\n')
+    buf.seek(0)
+    return buf
+
+
+def insert_serps(connection, rows):
+    """Insert SERP rows.
+
+    Returns:
+        The ids of the rows in the same order.
+    """
+    serp_table = SearchEngineResultsPage.__table__
+
+    if connection.dialect.name != 'postgresql':
+        # sqlite and most other drivers don't return the ids of executemany()
+        return [connection.execute(serp_table.insert(), row).inserted_primary_key[0] for row in rows]
+
+    # a multi-row insert needs the same columns in every row
+    groups = {}
+    for i, row in enumerate(rows):
+        groups.setdefault(tuple(sorted(row)), []).append(i)
+
+    ids = [None] * len(rows)
+    for indexes in groups.values():
+        statement = serp_table.insert().values([rows[i] for i in indexes]).returning(serp_table.c.id)
+        for i, (serp_id,) in zip(indexes, connection.execute(statement)):
+            ids[i] = serp_id
+    return ids
+
+
+def insert_links(connection, rows):
+    """Insert link rows, with COPY if the driver supports it."""
+    columns = LINK_COLUMNS + ['serp_id']
+    cursor = connection.connection.cursor()
+    try:
+        if hasattr(cursor, 'copy_expert'):
+            cursor.copy_expert('COPY link ({}) FROM STDIN WITH (FORMAT csv)'.format(', '.join(columns)),
+                               csv_rows(rows, columns))
+            return
+    finally:
+        cursor.close()
+
+    connection.execute(Link.__table__.insert(), rows)
+
+
+class Ack(object):
+    """Set when a SERP is committed to the database or failed to be stored."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.error = None
+
+    def set(self, error=None):
+        self.error = error
+        self.event.set()
+
+    def wait(self, timeout=None):
+        """Wait until the SERP is stored.
+
+        Returns:
+            True if the SERP was committed, False if it failed or the timeout expired.
+        """
+        return self.event.wait(timeout) and self.error is None
+
+
+class SerpPersistence(object):
+    """Inserts SERP pages and their links in batches from a single thread."""
+
+    def __init__(self, config, engine, scraper_search_id=None, ledger=None):
+        """Create the persistence thread. Call start() to run it.
+
+        Args:
+            config: The configuration.
+            engine: The sqlalchemy engine of the results database.
+            scraper_search_id: The id of the ScraperSearch the SERPs are associated with.
+            ledger: The JobLedger of the scraper search.
+        """
+        self.config = config
+        self.engine = engine
+        self.scraper_search_id = scraper_search_id
+        self.ledger = ledger
+        self.batch_size = int(self.config.get('persistence_batch_size', 500))
+        self.flush_interval = float(self.config.get('persistence_flush_interval', 200)) / 1000
+        self.max_retries = int(self.config.get('persistence_retries', 3))
+        self.retry_delay = float(self.config.get('persistence_retry_delay', 1))
+
+        self.queue = queue.Queue(maxsize=int(self.config.get('persistence_queue_size', 10000)))
+        self.thread = threading.Thread(target=self.run, name='SerpPersistence', daemon=True)
+        self.num_stored = 0
+        self.num_linked = 0
+        # the error that stopped the thread
+        self.error = None
+
+    def start(self):
+        self.thread.start()
+
+    def check(self):
+        """Raise the error that stopped the thread, the queued SERPs would never be stored."""
+        if self.error is not None:
+            raise self.error
+        if not self.thread.is_alive():
+            raise RuntimeError('The SERPs are not stored, the persistence thread is not running.')
+
+    def enqueue(self, item):
+        """Put an item into the queue, blocks while it is full and the thread is running."""
+        while True:
+            self.check()
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def put(self, serp):
+        """Queue a SERP object for storing.
+
+        The SERP must not be added to a session. Don't modify it afterwards.
+
+        Returns:
+            An Ack.
+
+        Raises:
+            The error that stopped the thread, see check().
+        """
+        ack = Ack()
+        self.enqueue((serp, ack))
+        return ack
+
+    def link(self, serp):
+        """Queue associating a SERP that is already stored with the ScraperSearch.
+
+        Returns:
+            An Ack.
+        """
+        ack = Ack()
+        linked = LinkedSerp(serp.id, serp.query, serp.search_engine_name, serp.scrape_method, serp.page_number,
+                            'successful')
+        self.enqueue((linked, ack))
+        return ack
+
+    def flush(self, timeout=None):
+        """Wait until all SERPs that were put so far are stored.
+
+        Returns:
+            True if all of them were committed.
+        """
+        ack = Ack()
+        self.enqueue((None, ack))
+        return ack.wait(timeout)
+
+    def close(self):
+        """Store all queued SERPs and stop the thread.
+
+        Raises:
+            The error that stopped the thread if SERPs couldn't be stored.
+        """
+        while self.thread.is_alive():
+            try:
+                self.queue.put(None, timeout=1)
+                self.thread.join()
+            except queue.Full:
+                pass
+
+        if self.error is not None:
+            raise self.error
+
+    def run(self):
+        try:
+            self.drain()
+        except Exception as e:
+            self.error = e
+            logger.error('Stopped storing SERPs: {}'.format(e))
+
+            # nobody takes the queued SERPs anymore
+            while True:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item:
+                    item[1].set(e)
+
+    def drain(self):
+        """Take the SERPs from the queue and write them in batches until close() is called."""
+        pending = []
+        num_rows = 0
+        deadline = None
+
+        while True:
+            timeout = max(0, deadline - time.time()) if deadline else None
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = ()
+
+            if item is None:
+                self.write(pending)
+                return
+
+            if item:
+                serp, ack = item
+                if serp is None:
+                    # a flush: commit everything before it
+                    try:
+                        self.write(pending)
+                    except Exception as e:
+                        ack.set(e)
+                        raise
+                    pending, num_rows, deadline = [], 0, None
+                    ack.set()
+                    continue
+
+                pending.append((serp, ack))
+                num_rows += 1 if isinstance(serp, LinkedSerp) else 1 + len(serp.links)
+                if deadline is None:
+                    deadline = time.time() + self.flush_interval
+
+            if pending and (num_rows >= self.batch_size or time.time() >= deadline):
+                self.write(pending)
+                pending, num_rows, deadline = [], 0, None
+
+    def write(self, pending):
+        """Insert a batch of SERPs in one transaction and acknowledge them.
+
+        Raises:
+            The error of the last attempt if the batch couldn't be committed.
+        """
+        if not pending:
+            return
+
+        serps = [serp for serp, _ in pending if not isinstance(serp, LinkedSerp)]
+        linked = [serp for serp, _ in pending if isinstance(serp, LinkedSerp)]
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.insert(serps, linked)
+                break
+            except Exception as e:
+                if attempt == self.max_retries:
+                    logger.error('Cannot store {} SERPs: {}'.format(len(pending), e))
+                    for _, ack in pending:
+                        ack.set(e)
+                    raise
+
+                delay = self.retry_delay * 2 ** attempt
+                logger.warning('Cannot store {} SERPs, trying again in {:.1f} seconds: {}'.format(
+                    len(pending), delay, e))
+                time.sleep(delay)
+
+        self.num_stored += len(serps)
+        self.num_linked += len(linked)
+        for _, ack in pending:
+            ack.set()
+
+    def insert(self, serps, linked):
+        """Insert new and link stored SERPs in one transaction."""
+        with self.engine.begin() as connection:
+            serp_ids = insert_serps(connection, [serp_row(serp) for serp in serps]) if serps else []
+            links, associations = [], []
+
+            for serp, serp_id in zip(serps, serp_ids):
+                for row in link_rows(serp):
+                    row['serp_id'] = serp_id
+                    links.append(row)
+
+            if self.scraper_search_id is not None:
+                associations = [{'scraper_search_id': self.scraper_search_id, 'serp_id': serp_id}
+                                for serp_id in serp_ids + [serp.id for serp in linked]]
+
+            if links:
+                insert_links(connection, links)
+            if associations:
+                connection.execute(scraper_searches_serps.insert(), associations)
+            if self.ledger is not None:
+                finish_jobs(connection, self.scraper_search_id, self.ledger.search_type, serps + linked)
+
+
+def get_persistence(config, session, scraper_search):
+    """Start a SerpPersistence for the results of the scraper search.
+
+    The scraper search is committed first, such that the SERPs can reference it.
+
+    Returns:
+        The SerpPersistence or None if it is disabled by the `persistence_batch_size` 0.
+        Its `ledger` is the JobLedger of the scraper search if `use_job_ledger` is set.
+    """
+    if not int(config.get('persistence_batch_size', 500)):
+        return None
+
+    if inspect(scraper_search).transient or inspect(scraper_search).pending:
+        session.add(scraper_search)
+        session.commit()
+
+    ledger = None
+    if config.get('use_job_ledger', True):
+        ledger = JobLedger(config, session.get_bind(), scraper_search.id)
+
+    persistence = SerpPersistence(config, session.get_bind(), scraper_search.id, ledger=ledger)
+    persistence.start()
+    return persistence
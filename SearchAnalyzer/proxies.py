@@ -1,15 +1,27 @@
 # -*- coding: utf-8 -*-
 
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import functools
 import os
 import pymysql
 import re
+import time
+import requests
 from SearchAnalyzer import database
+from SearchAnalyzer.transport import get_http_session
 import logging
 
 Proxy = namedtuple('Proxy', 'proto, host, port, username, password')
 logger = logging.getLogger(__name__)
 
+# The outcome of checking a proxy, see check_proxies()
+ProxyCheck = namedtuple('ProxyCheck', 'proxy, online, status, latency, ipinfo')
+
+# The fields of the proxy info that are stored with the proxy
+IPINFO_COLUMNS = ('hostname', 'city', 'region', 'country', 'loc', 'org', 'postal')
+
 
 def parse_proxy_file(fname):
     """Parses a proxy file
@@ -103,7 +115,7 @@ def get_proxies_from_mysql_db(s):
 def add_proxies_to_db(proxies, session):
     """Adds the list of proxies to the database.
 
-    If the proxy-ip already exists and the other data differs,
+    If the proxy with the ip and port already exists and the other data differs,
     it will be overwritten.
 
     Will not check the status of the proxy.
@@ -114,15 +126,135 @@ def add_proxies_to_db(proxies, session):
     """
     for proxy in proxies:
         if proxy:
-            p = session.query(database.Proxy).filter(proxy.host == database.Proxy.ip).first()
+            p = session.query(database.Proxy).filter(proxy.host == database.Proxy.ip,
+                                                     int(proxy.port) == database.Proxy.port).first()
 
             if not p:
-                p = database.Proxy(ip=proxy.host)
+                p = database.Proxy(ip=proxy.host, port=proxy.port)
 
-            p.port = proxy.port
             p.username = proxy.username
             p.password = proxy.password
             p.proto = proxy.proto
 
             session.add(p)
-            session.commit()
\ No newline at end of file
+
+    session.commit()
+
+
+def check_proxy(config, proxy):
+    """Request the proxy info url through a proxy.
+
+    The proxy works if the response names the ip address the request came from.
+
+    Args:
+        config: The configuration with the `proxy_info_url` and the `proxy_check_timeout`.
+        proxy: The Proxy to check.
+
+    Returns:
+        A ProxyCheck.
+    """
+    status = 'Proxy check failed: {}:{} is not used while requesting'.format(proxy.host, proxy.port)
+    latency = None
+    ipinfo = {}
+
+    try:
+        http = get_http_session(proxy, config)
+    except ValueError as e:
+        return ProxyCheck(proxy=proxy, online=False, status=str(e), latency=None, ipinfo={})
+
+    started = time.monotonic()
+    try:
+        response = http.get(config.get('proxy_info_url'), timeout=float(config.get('proxy_check_timeout', 5)))
+        latency = time.monotonic() - started
+        try:
+            ipinfo = response.json()
+        except ValueError:
+            pass
+    except requests.Timeout as e:
+        status = 'Timeout while connecting to proxy server: {}'.format(e)
+    except requests.ConnectionError as e:
+        status = 'No connection to proxy server possible: {}'.format(e)
+    except requests.RequestException as e:
+        status = 'Unknown exception: {}'.format(e)
+    finally:
+        http.close()
+
+    online = isinstance(ipinfo, dict) and bool(ipinfo.get('ip'))
+    if online:
+        status = 'Proxy is working.'
+    else:
+        ipinfo = {}
+    return ProxyCheck(proxy=proxy, online=online, status=status, latency=latency, ipinfo=ipinfo)
+
+
+def store_proxy_checks(engine, checks):
+    """Store the outcome of proxy checks with the proxies in the database, in one transaction.
+
+    Args:
+        engine: The sqlalchemy engine of the database the proxies were added to, see add_proxies_to_db().
+        checks: The ProxyChecks.
+    """
+    proxy_table = database.Proxy.__table__
+    checked_at = datetime.datetime.utcnow()
+
+    with engine.begin() as connection:
+        for check in checks:
+            values = {key: check.ipinfo[key] for key in IPINFO_COLUMNS if isinstance(check.ipinfo.get(key), str)}
+            values.update(online=check.online, status=check.status, checked_at=checked_at)
+            connection.execute(proxy_table.update().where(
+                (proxy_table.c.ip == check.proxy.host) & (proxy_table.c.port == int(check.proxy.port))), values)
+
+
+def check_proxies(config, proxies, engine=None):
+    """Check all proxies at once, before any worker starts.
+
+    The proxies are checked with check_proxy() by a pool of `proxy_check_workers` threads, such that
+    a dead proxy costs its thread at most `proxy_check_timeout` seconds instead of delaying a worker.
+
+    Args:
+        config: The configuration.
+        proxies: The proxies. None, the own IP, isn't checked.
+        engine: The sqlalchemy engine to store the outcome in, None to not store it.
+
+    Returns:
+        The ProxyChecks in the order of the proxies.
+    """
+    proxies = [proxy for proxy in proxies if proxy]
+    if not proxies:
+        return []
+
+    started = time.monotonic()
+    num_workers = max(1, min(len(proxies), int(config.get('proxy_check_workers', 50))))
+    with ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='ProxyCheck') as executor:
+        checks = list(executor.map(functools.partial(check_proxy, config), proxies))
+
+    if engine is not None:
+        store_proxy_checks(engine, checks)
+
+    logger.info('{} of {} proxies are online, checked in {:.1f} seconds.'.format(
+        sum(check.online for check in checks), len(checks), time.monotonic() - started))
+    return checks
+
+
+def proxy_report(checks):
+    """A readable report of proxy checks, the working proxies first.
+
+    Args:
+        checks: The ProxyChecks.
+
+    Returns:
+        The report as string.
+    """
+    lines = []
+    for check in sorted(checks, key=lambda check: (not check.online, check.latency or 0)):
+        proxy = check.proxy
+        if check.online:
+            location = ', '.join(check.ipinfo[key] for key in ('city', 'country', 'org') if check.ipinfo.get(key))
+            lines.append('online   {:<8}{:<24}{:>6.2f}s  {} {}'.format(
+                proxy.proto, proxy.host + ':' + str(proxy.port), check.latency, check.ipinfo['ip'], location).rstrip())
+        else:
+            lines.append('offline  {:<8}{:<24}{:>7}  {}'.format(
+                proxy.proto, proxy.host + ':' + str(proxy.port), '-', check.status))
+
+    lines.append('{} of {} proxies are online.'.format(sum(check.online for check in checks), len(checks)))
+    return '\n'.join(lines)
\ No newline at end of file
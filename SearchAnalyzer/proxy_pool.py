@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import logging
+import threading
+import time
+
+from sqlalchemy import select
+
+from SearchAnalyzer.database import Proxy as db_Proxy, SearchEngine, SearchEngineProxyStatus
+
+"""
+Hands the http workers the best available proxy for every request.
+
+When every worker is bound to one proxy, a dead or banned proxy wastes its worker for the
+rest of the scrape. Instead, the workers share a ProxyPool. Before every request a worker
+takes a proxy with acquire() and hands it back with the outcome of the request with release().
+
+The pool tracks the health of every proxy per search engine: the latency and the success
+rate as moving averages, the number of requests, failures and bans. acquire() returns the
+proxy with the best score, the success rate divided by 1 + latency, among the proxies that
+aren't quarantined. The score is divided by 1 + the number of workers that use the proxy
+right now, such that the requests spread over proxies of about the same health.
+
+A proxy that is blocked by a search engine or fails `proxy_max_failures` times in a row
+is quarantined on that search engine for `proxy_detected_timeout` seconds. Every time it
+is quarantined again, the quarantine takes twice as long, up to `proxy_max_quarantine_time`
+seconds. A successful request resets the backoff. When all proxies are quarantined,
+acquire() waits until the first one is released from quarantine.
+
+The health is stored in the search_engine_proxy_status table by flush(), whenever a proxy
+is quarantined and when the pool is closed. A new pool loads it, so a proxy that was banned
+in the last run stays quarantined. The health of the own IP isn't stored.
+"""
+
+logger = logging.getLogger(__name__)
+
+# the weight of the latest request in the moving averages
+SMOOTHING = 0.2
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def proxy_name(proxy):
+    return '{}:{}'.format(proxy.host, proxy.port) if proxy else 'localhost'
+
+
+class ProxyHealth(object):
+    """The health of a proxy on a search engine."""
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+        self.latency = None
+        self.success_rate = 1.0
+        self.num_requests = 0
+        self.num_failures = 0
+        self.num_bans = 0
+        self.consecutive_failures = 0
+        self.backoff = 0
+        self.quarantined_until = 0.0
+        self.in_use = 0
+        self.last_check = None
+        # whether it changed since it was stored
+        self.dirty = False
+
+    def score(self):
+        """Higher is better. A proxy without requests is assumed to be healthy, such that every proxy is tried."""
+        return self.success_rate / (1 + (self.latency or 0)) / (1 + self.in_use)
+
+    def row(self, now):
+        """The values of its search_engine_proxy_status row."""
+        return {
+            'available': self.quarantined_until <= now,
+            'last_check': self.last_check,
+            'latency': self.latency,
+            'success_rate': self.success_rate,
+            'num_requests': self.num_requests,
+            'num_failures': self.num_failures,
+            'num_bans': self.num_bans,
+            'backoff': self.backoff,
+            'quarantined_until': EPOCH + datetime.timedelta(seconds=self.quarantined_until)
+            if self.quarantined_until > now else None,
+        }
+
+    def restore(self, row):
+        """Take over the health stored in a search_engine_proxy_status row."""
+        if row.latency is not None:
+            self.latency = row.latency
+        if row.success_rate is not None:
+            self.success_rate = row.success_rate
+        self.num_requests = row.num_requests or 0
+        self.num_failures = row.num_failures or 0
+        self.num_bans = row.num_bans or 0
+        self.backoff = row.backoff or 0
+        self.last_check = row.last_check
+        if row.quarantined_until is not None:
+            self.quarantined_until = (row.quarantined_until - EPOCH).total_seconds()
+
+
+class ProxyPool(object):
+    """The proxies of a scrape and their health per search engine, shared by all http workers."""
+
+    def __init__(self, config, proxies, engine=None, clock=time.time):
+        """Create the pool and load the stored health of the proxies.
+
+        Args:
+            config: The configuration.
+            proxies: The proxies.Proxy tuples, None for the own IP.
+            engine: The sqlalchemy engine of the database with the proxies, None to not store the health.
+            clock: The time function, the seconds since the epoch.
+        """
+        self.proxies = list(proxies)
+        self.engine = engine
+        self.clock = clock
+        self.max_failures = int(config.get('proxy_max_failures', 3))
+        self.quarantine_time = float(config.get('proxy_detected_timeout', 400))
+        self.max_quarantine_time = float(config.get('proxy_max_quarantine_time', 3600))
+
+        self.condition = threading.Condition()
+        self.flush_lock = threading.Lock()
+        # search engine => proxy => ProxyHealth
+        self.health = {}
+        # the ids of the database rows
+        self.proxy_ids = {}
+        self.search_engine_ids = {}
+        self.status_ids = {}
+
+        if self.engine is not None:
+            self.load()
+
+    def healths(self, search_engine):
+        """The health of the proxies on a search engine. Call it with the condition held.
+
+        Returns:
+            A dict that maps the proxies to their ProxyHealth.
+        """
+        if search_engine not in self.health:
+            self.health[search_engine] = {proxy: ProxyHealth(proxy) for proxy in self.proxies}
+        return self.health[search_engine]
+
+    def acquire(self, search_engine):
+        """Take the best available proxy for a request.
+
+        Blocks while all proxies are quarantined on the search engine.
+
+        Returns:
+            The proxies.Proxy or None for the own IP. Hand it back with release().
+        """
+        with self.condition:
+            while True:
+                now = self.clock()
+                healths = self.healths(search_engine).values()
+                available = [health for health in healths if health.quarantined_until <= now]
+                if available:
+                    best = max(available, key=ProxyHealth.score)
+                    best.in_use += 1
+                    return best.proxy
+
+                delay = min(health.quarantined_until for health in healths) - now
+                logger.warning('All proxies are quarantined on {}, waiting {:.0f} seconds.'.format(search_engine, delay))
+                self.condition.wait(delay)
+
+    def release(self, proxy, search_engine, success, latency=None, blocked=False):
+        """Hand back a proxy with the outcome of the request.
+
+        Args:
+            proxy: The proxy returned by acquire().
+            search_engine: The name of the search engine.
+            success: Whether the request got a proper SERP.
+            latency: The response time in seconds, None if there was no response.
+            blocked: Whether the search engine blocked the request, see scraping.detect_block().
+        """
+        with self.condition:
+            now = self.clock()
+            health = self.healths(search_engine)[proxy]
+            health.in_use = max(0, health.in_use - 1)
+            health.num_requests += 1
+            health.success_rate += SMOOTHING * (float(success) - health.success_rate)
+            if latency is not None:
+                health.latency = latency if health.latency is None else \
+                    health.latency + SMOOTHING * (latency - health.latency)
+            health.last_check = datetime.datetime.utcnow()
+            health.dirty = True
+
+            if blocked:
+                health.num_bans += 1
+            if success:
+                health.consecutive_failures = 0
+                health.backoff = 0
+            else:
+                health.num_failures += 1
+                health.consecutive_failures += 1
+
+            # the other requests that were on the way when the proxy got quarantined don't extend it
+            quarantine = None
+            if (blocked or health.consecutive_failures >= self.max_failures) and health.quarantined_until <= now:
+                quarantine = min(self.max_quarantine_time, self.quarantine_time * 2 ** health.backoff)
+                health.quarantined_until = now + quarantine
+                health.backoff += 1
+                health.consecutive_failures = 0
+
+            self.condition.notify_all()
+
+        if quarantine is not None:
+            logger.warning('{} {} on {}, quarantined for {:.0f} seconds.'.format(
+                proxy_name(proxy), 'is blocked' if blocked else 'failed {} times'.format(self.max_failures),
+                search_engine, quarantine))
+            self.flush()
+
+    def summary(self):
+        """The health of all proxies that were used.
+
+        Returns:
+            A list of readable lines.
+        """
+        with self.condition:
+            now = self.clock()
+            lines = []
+            for search_engine, healths in sorted(self.health.items()):
+                for health in healths.values():
+                    if not health.num_requests:
+                        continue
+                    lines.append('{} via {}: {} requests, {:.0%} successful, {} latency, {} bans{}'.format(
+                        search_engine, proxy_name(health.proxy), health.num_requests, health.success_rate,
+                        '{:.2f}s'.format(health.latency) if health.latency is not None else 'no',
+                        health.num_bans, ', quarantined' if health.quarantined_until > now else ''))
+            return lines
+
+    def load(self):
+        """Load the stored health of the proxies."""
+        proxy_table = db_Proxy.__table__
+        search_engine_table = SearchEngine.__table__
+        status_table = SearchEngineProxyStatus.__table__
+
+        by_address = {(proxy.host, str(proxy.port)): proxy for proxy in self.proxies if proxy}
+
+        with self.engine.connect() as connection:
+            for row in connection.execute(select([proxy_table.c.id, proxy_table.c.ip, proxy_table.c.port])):
+                proxy = by_address.get((row.ip, str(row.port)))
+                if proxy:
+                    self.proxy_ids[proxy] = row.id
+            proxies = {proxy_id: proxy for proxy, proxy_id in self.proxy_ids.items()}
+
+            for row in connection.execute(select([search_engine_table.c.id, search_engine_table.c.name])):
+                self.search_engine_ids[row.name] = row.id
+            search_engines = {search_engine_id: name for name, search_engine_id in self.search_engine_ids.items()}
+
+            if not proxies:
+                return
+
+            statement = status_table.select().where(status_table.c.proxy_id.in_(list(proxies)))
+            with self.condition:
+                for row in connection.execute(statement):
+                    search_engine = search_engines.get(row.search_engine_id)
+                    if search_engine is None:
+                        continue
+                    proxy = proxies[row.proxy_id]
+                    self.status_ids[(search_engine, proxy)] = row.id
+                    self.healths(search_engine)[proxy].restore(row)
+
+    def flush(self):
+        """Store the health of the proxies that changed, in one transaction."""
+        if self.engine is None:
+            return
+
+        with self.flush_lock:
+            with self.condition:
+                now = self.clock()
+                rows = []
+                for search_engine, healths in self.health.items():
+                    for proxy, health in healths.items():
+                        if health.dirty and proxy in self.proxy_ids:
+                            rows.append((search_engine, proxy, health.row(now)))
+                            # cleared before the rows are stored, such that later changes are stored next time
+                            health.dirty = False
+
+            if not rows:
+                return
+
+            status_table = SearchEngineProxyStatus.__table__
+            # the ids of the inserted rows are only kept once they are committed
+            search_engine_ids = dict(self.search_engine_ids)
+            status_ids = dict(self.status_ids)
+            try:
+                with self.engine.begin() as connection:
+                    for search_engine in {search_engine for search_engine, _, _ in rows}:
+                        if search_engine not in search_engine_ids:
+                            result = connection.execute(SearchEngine.__table__.insert(), {'name': search_engine})
+                            search_engine_ids[search_engine] = result.inserted_primary_key[0]
+
+                    for search_engine, proxy, row in rows:
+                        status_id = status_ids.get((search_engine, proxy))
+                        if status_id is None:
+                            row.update(proxy_id=self.proxy_ids[proxy], search_engine_id=search_engine_ids[search_engine])
+                            result = connection.execute(status_table.insert(), row)
+                            status_ids[(search_engine, proxy)] = result.inserted_primary_key[0]
+                        else:
+                            connection.execute(status_table.update().where(status_table.c.id == status_id), row)
+            except Exception as e:
+                logger.error('Cannot store the health of {} proxies: {}'.format(len(rows), e))
+                # store them with the next flush
+                with self.condition:
+                    for search_engine, proxy, _ in rows:
+                        self.health[search_engine][proxy].dirty = True
+                return
+
+            self.search_engine_ids = search_engine_ids
+            self.status_ids = status_ids
+
+    def close(self):
+        """Store the health of the proxies."""
+        self.flush()
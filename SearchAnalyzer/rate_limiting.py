@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import logging
+import random
+import threading
+import time
+
+"""
+Paces the requests to the search engines.
+
+The sleeping ranges make every worker sleep on its own, no matter how many other
+workers hit the same search engine through the same IP. Instead, all workers share
+a RateLimiter with a token bucket per search engine and egress, i.e. the proxy or the
+own IP a request leaves through. A bucket allows `requests_per_minute` requests with
+bursts of `rate_limit_burst` requests, thus the rate is the same with 1 or 20 workers
+per proxy. Both can be set per search engine, like `google_requests_per_minute`.
+
+A request reserves a token and waits until it's due, so the threads of the http and
+selenium mode sleep with wait() and the http-async mode awaits wait_async(). A random
+jitter of up to `rate_limit_jitter` times the interval between two requests is added
+to every wait, such that the requests don't come in regular intervals.
+
+The rates adapt to the responses of the search engines (AIMD). The workers report
+every response with feedback(). While the responses are clean, the rate of a bucket
+grows by `rate_limit_increase` requests per minute every minute, up to
+`max_requests_per_minute`. A block, i.e. a 429 response, a redirect to a captcha or
+a captcha page, multiplies it by `rate_limit_decrease`, down to `min_requests_per_minute`.
+Thus every proxy settles close to the rate a search engine tolerates. rates() returns
+the current rates. Set `adaptive_rate_limit` to False to keep them fixed.
+
+A search engine with `requests_per_minute` 0 isn't rate limited, its workers sleep
+according to the sleeping ranges instead. That is the default, such that configurations
+that tuned the sleeping ranges keep working; set `requests_per_minute` to use the RateLimiter.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    """A token bucket that hands out reservations instead of refusing requests."""
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        """Create a full bucket.
+
+        Args:
+            rate: The number of tokens that are added per second.
+            burst: The capacity of the bucket.
+            clock: The time function.
+        """
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.clock = clock
+        self.tokens = self.burst
+        self.updated = clock()
+
+    def reserve(self):
+        """Take a token.
+
+        When the bucket is empty, the token is taken from the future, i.e. the
+        tokens become negative and the next request has to wait even longer.
+
+        Returns:
+            The seconds until the token is available.
+        """
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+
+class RateLimiter(object):
+    """Token buckets per (search engine, egress), shared by all workers."""
+
+    def __init__(self, config, clock=time.monotonic):
+        self.config = config
+        self.clock = clock
+        self.jitter = float(config.get('rate_limit_jitter', 0.5))
+        self.adaptive = config.get('adaptive_rate_limit', True)
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    def engine_option(self, search_engine, option, default):
+        return self.config.get('{}_{}'.format(search_engine, option), self.config.get(option, default))
+
+    def requests_per_minute(self, search_engine):
+        return float(self.engine_option(search_engine, 'requests_per_minute', 0))
+
+    def bucket(self, search_engine, egress):
+        """The bucket of a search engine and egress, created on first use. Call it with the lock held.
+
+        Returns:
+            The TokenBucket or None if the search engine isn't rate limited.
+        """
+        key = (search_engine, egress)
+        if key not in self.buckets:
+            requests_per_minute = self.requests_per_minute(search_engine)
+            if requests_per_minute <= 0:
+                return None
+            burst = int(self.engine_option(search_engine, 'rate_limit_burst', 3))
+            self.buckets[key] = TokenBucket(requests_per_minute / 60, burst, clock=self.clock)
+        return self.buckets[key]
+
+    def reserve(self, search_engine, egress):
+        """Reserve a request.
+
+        Args:
+            search_engine: The name of the search engine.
+            egress: The proxy as 'host:port' or 'localhost' for the own IP, see SearchEngineScrape.requested_by.
+
+        Returns:
+            The seconds to wait before sending the request or None if the search engine isn't rate limited.
+        """
+        with self.lock:
+            bucket = self.bucket(search_engine, egress)
+            if bucket is None:
+                return None
+            delay = bucket.reserve()
+            rate = bucket.rate
+
+        if self.jitter:
+            delay += random.uniform(0, self.jitter / rate)
+        return delay
+
+    def feedback(self, search_engine, egress, blocked):
+        """Adapt the rate of a bucket to a response.
+
+        Args:
+            search_engine: The name of the search engine.
+            egress: See reserve().
+            blocked: Whether the search engine blocked the request, see scraping.detect_block().
+        """
+        if not self.adaptive:
+            return
+
+        with self.lock:
+            bucket = self.bucket(search_engine, egress)
+            if bucket is None:
+                return
+
+            requests_per_minute = bucket.rate * 60
+            if blocked:
+                lowest = float(self.engine_option(search_engine, 'min_requests_per_minute', 1))
+                requests_per_minute = max(lowest, requests_per_minute * float(
+                    self.engine_option(search_engine, 'rate_limit_decrease', 0.5)))
+                # no burst right after a block
+                bucket.tokens = min(bucket.tokens, 0)
+            else:
+                highest = float(self.engine_option(search_engine, 'max_requests_per_minute', 120))
+                # there are about requests_per_minute responses per minute
+                increase = float(self.engine_option(search_engine, 'rate_limit_increase', 6)) / requests_per_minute
+                if requests_per_minute < highest:
+                    requests_per_minute = min(highest, requests_per_minute + increase)
+            bucket.rate = requests_per_minute / 60
+
+        if blocked:
+            logger.warning('{} blocked {}, slowing down to {:.1f} requests per minute.'.format(
+                search_engine, egress, requests_per_minute))
+
+    def rates(self):
+        """The current rates.
+
+        Returns:
+            A dict that maps (search engine, egress) to the requests per minute.
+        """
+        with self.lock:
+            return {key: bucket.rate * 60 for key, bucket in self.buckets.items()}
+
+    def wait(self, search_engine, egress):
+        """Block until the next request may be sent.
+
+        Returns:
+            The seconds slept or None if the search engine isn't rate limited.
+        """
+        delay = self.reserve(search_engine, egress)
+        if delay:
+            time.sleep(delay)
+        return delay
+
+    async def wait_async(self, search_engine, egress):
+        """Like wait(), for coroutines."""
+        delay = self.reserve(search_engine, egress)
+        if delay:
+            await asyncio.sleep(delay)
+        return delay
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import logging
+import threading
+
+"""
+Hands out the scrape jobs to the worker threads.
+
+The jobs are not divided among the workers in advance. Instead, there is one queue
+per search engine and scrape method, and every worker pulls the next keyword from the
+queue of its search engine when it is done with the previous one. Thus a slow worker
+scrapes fewer keywords and a fast worker more, and the run takes as long as the
+aggregate throughput of all workers demands.
+
+A work item is a keyword with the pages to scrape for it. The pages of a keyword stay
+together, because the selenium workers go to the next page by clicking on the link.
+When a worker fails to get a page or gives up because it's banned, it requeues the
+pages, so that another worker of the same search engine scrapes them. Every keyword
+is retried `scheduler_max_attempts` times.
+
+The queues are bounded, such that the jobs can be fed lazily while the workers run.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+def group_jobs(jobs):
+    """Group consecutive scrape jobs of the same keyword into work items.
+
+    Args:
+        jobs: An iterable of scrape job dicts.
+
+    Yields:
+        Dicts with the query, search engine, scrape method and the list of pages.
+    """
+    item = None
+    for job in jobs:
+        key = (job['query'], job['search_engine'], job['scrape_method'])
+        if item and (item['query'], item['search_engine'], item['scrape_method']) == key:
+            item['pages'].append(job['page_number'])
+            continue
+        if item:
+            yield item
+        item = {'query': key[0], 'search_engine': key[1], 'scrape_method': key[2], 'pages': [job['page_number']],
+                'attempts': 0}
+    if item:
+        yield item
+
+
+class JobScheduler(object):
+    """Queues of work items per (search engine, scrape method) that the workers pull from."""
+
+    def __init__(self, config):
+        """Create empty queues.
+
+        Args:
+            config: The configuration.
+        """
+        self.max_queued = int(config.get('scheduler_queue_size', 1000))
+        self.max_attempts = int(config.get('scheduler_max_attempts', 3))
+
+        self.condition = threading.Condition()
+        self.queues = collections.defaultdict(collections.deque)
+        # the number of workers per key that still take jobs
+        self.workers = collections.Counter()
+        # the number of work items per key that are being scraped right now
+        self.in_progress = collections.Counter()
+        self.closed = False
+
+        # the number of pages per key that were fed so far
+        self.num_fed = collections.Counter()
+        self.num_jobs = 0
+        self.num_dropped = 0
+        self.num_failed = 0
+
+    def stream(self, search_engine, scrape_method):
+        """Register a worker.
+
+        Returns:
+            The JobStream the worker takes its jobs from.
+        """
+        key = (search_engine, scrape_method)
+        with self.condition:
+            self.workers[key] += 1
+        return JobStream(self, key)
+
+    def feed(self, jobs):
+        """Queue scrape jobs, blocks while the queues are full.
+
+        Jobs for search engines without workers are dropped.
+
+        Returns:
+            The number of queued scrape jobs.
+        """
+        num_jobs = 0
+        for item in group_jobs(jobs):
+            key = (item['search_engine'], item['scrape_method'])
+            with self.condition:
+                while len(self.queues[key]) >= self.max_queued and self.workers[key]:
+                    self.condition.wait()
+
+                if not self.workers[key]:
+                    self.num_dropped += len(item['pages'])
+                    continue
+
+                self.queues[key].append(item)
+                self.num_fed[key] += len(item['pages'])
+                self.num_jobs += len(item['pages'])
+                self.condition.notify_all()
+            num_jobs += len(item['pages'])
+
+        return num_jobs
+
+    def close(self):
+        """No more jobs are fed. The workers stop when the queues are empty."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def exhausted(self, key):
+        """Whether all work items of a key were taken and none can be fed or requeued anymore."""
+        with self.condition:
+            return self.closed and not self.queues[key] and not self.in_progress[key]
+
+    def get(self, key):
+        """Take the next work item of a key.
+
+        Waits while the queue is empty, but jobs may still be fed or requeued.
+
+        Returns:
+            The work item or None if there won't be any more.
+        """
+        with self.condition:
+            while not self.queues[key] and (not self.closed or self.in_progress[key]):
+                self.condition.wait()
+
+            if not self.queues[key]:
+                return None
+
+            self.in_progress[key] += 1
+            self.condition.notify_all()
+            return self.queues[key].popleft()
+
+    def done(self, key):
+        """A worker finished the work item it took last."""
+        with self.condition:
+            self.in_progress[key] -= 1
+            self.condition.notify_all()
+
+    def requeue(self, item, pages):
+        """Give pages of a work item to another worker.
+
+        Returns:
+            True if the pages are requeued, False if they failed too often or no worker is left.
+        """
+        key = (item['search_engine'], item['scrape_method'])
+        retry = dict(item, pages=list(pages), attempts=item['attempts'] + 1)
+
+        with self.condition:
+            if retry['attempts'] >= self.max_attempts or not self.workers[key]:
+                self.num_failed += len(pages)
+                logger.info('Giving up on "{}" with {} after {} attempts.'.format(item['query'], key[0],
+                                                                                   retry['attempts']))
+                return False
+
+            self.queues[key].appendleft(retry)
+            self.condition.notify_all()
+            return True
+
+    def unregister(self, key):
+        """A worker stopped taking jobs."""
+        with self.condition:
+            self.workers[key] -= 1
+            if not self.workers[key]:
+                stranded = sum(len(item['pages']) for item in self.queues[key])
+                if stranded:
+                    logger.warning('No worker left for {}, {} pages are not scraped.'.format(key, stranded))
+                    self.num_dropped += stranded
+                    self.queues[key].clear()
+            self.condition.notify_all()
+
+
+class JobStream(object):
+    """The jobs of a single worker, pulled from the JobScheduler as the worker goes."""
+
+    def __init__(self, scheduler, key):
+        self.scheduler = scheduler
+        self.key = key
+        self.current = None
+        self.closed = False
+
+    def __len__(self):
+        """The number of pages that were fed for the search engine of the worker so far."""
+        return self.scheduler.num_fed[self.key]
+
+    def __bool__(self):
+        """Whether the worker may still get jobs."""
+        return not self.closed and not self.scheduler.exhausted(self.key)
+
+    def items(self):
+        """Yields the tuples (query, pages) until the scheduler runs out of jobs."""
+        while not self.closed:
+            self.current = self.scheduler.get(self.key)
+            if self.current is None:
+                break
+            try:
+                yield self.current['query'], self.current['pages']
+            finally:
+                self.scheduler.done(self.key)
+                self.current = None
+
+    def retry(self, pages):
+        """Requeue pages of the current keyword."""
+        if self.current and pages:
+            return self.scheduler.requeue(self.current, pages)
+        return False
+
+    def close(self):
+        """The worker stops, the other workers take over its jobs."""
+        if not self.closed:
+            self.closed = True
+            self.scheduler.unregister(self.key)
+
+
+class StaticJobs(dict):
+    """Jobs of a worker that are known in advance, a dict that maps the query to the list of pages."""
+
+    def retry(self, pages):
+        return False
+
+    def close(self):
+        pass
@@ -1,6 +1,12 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
 import logging
+import os
+import sqlite3
+import tempfile
+
+from SearchAnalyzer.utils import chunked
 
 logger = logging.getLogger(__name__)
 
@@ -76,4 +82,109 @@ def default_scrape_jobs_for_keywords(keywords, search_engines, scrape_method, nu
                     'search_engine': search_engine,
                     'scrape_method': scrape_method,
                     'page_number': page
-                }
\ No newline at end of file
+                }
+
+
+def read_keywords(path):
+    """Lazily read the keywords of a keyword file, one per line.
+
+    Empty lines are skipped. The file is never read into memory at once.
+
+    Args:
+        path: The path of the keyword file.
+
+    Yields:
+        The stripped keywords.
+    """
+    with open(path, 'r') as fd:
+        for line in fd:
+            keyword = line.strip()
+            if keyword:
+                yield keyword
+
+
+class KeywordSet(object):
+    """Remembers which keywords were seen, to drop duplicates in a stream of keywords.
+
+    Only a 64 bit hash of every keyword is kept. Up to `max_memory` hashes are held in
+    memory, beyond that they are moved to a temporary sqlite database, such that memory
+    stays bounded however large the keyword file is. Two keywords collide with a
+    probability of about n^2 / 2^65, that's 3 in a million for 10 million keywords.
+    """
+
+    def __init__(self, max_memory=1000000, chunk_size=10000):
+        """Create an empty set.
+
+        Args:
+            max_memory: How many hashes are held in memory before they are moved to disk.
+            chunk_size: How many keywords are looked up at once.
+        """
+        self.max_memory = max_memory
+        self.chunk_size = chunk_size
+        self.hashes = set()
+        self.db = None
+        self.path = None
+        self.count = 0
+
+    @staticmethod
+    def _hash(keyword):
+        # signed, that's what fits into an sqlite INTEGER
+        return int.from_bytes(hashlib.blake2b(keyword.encode(), digest_size=8).digest(), 'little', signed=True)
+
+    def _spill(self):
+        fd, self.path = tempfile.mkstemp(prefix='keywords-', suffix='.db')
+        os.close(fd)
+        self.db = sqlite3.connect(self.path)
+        self.db.execute('PRAGMA journal_mode = OFF')
+        self.db.execute('PRAGMA synchronous = OFF')
+        self.db.execute('CREATE TABLE seen (hash INTEGER PRIMARY KEY)')
+        self.db.executemany('INSERT INTO seen VALUES (?)', ((h,) for h in self.hashes))
+        self.db.commit()
+        self.hashes = set()
+        logger.debug('Moved {} keyword hashes to {}'.format(self.count, self.path))
+
+    def add_new(self, keywords):
+        """Add a chunk of keywords.
+
+        Returns:
+            The keywords that were not in the set yet, in their order.
+        """
+        chunk = {}
+        for keyword in keywords:
+            chunk.setdefault(self._hash(keyword), keyword)
+
+        if self.db is None:
+            new = [(h, keyword) for h, keyword in chunk.items() if h not in self.hashes]
+            self.hashes.update(h for h, _ in new)
+            if len(self.hashes) > self.max_memory:
+                self._spill()
+        else:
+            seen = set()
+            hashes = list(chunk)
+            # stay below the limit of sqlite's host parameters
+            for i in range(0, len(hashes), 500):
+                batch = hashes[i:i + 500]
+                statement = 'SELECT hash FROM seen WHERE hash IN ({})'.format(','.join('?' * len(batch)))
+                seen.update(h for h, in self.db.execute(statement, batch))
+            new = [(h, keyword) for h, keyword in chunk.items() if h not in seen]
+            self.db.executemany('INSERT INTO seen VALUES (?)', ((h,) for h, _ in new))
+            self.db.commit()
+
+        self.count += len(new)
+        return [keyword for _, keyword in new]
+
+    def unique(self, keywords):
+        """Drop the duplicates of a stream of keywords.
+
+        Yields:
+            Every keyword the first time it appears.
+        """
+        for chunk in chunked(keywords, self.chunk_size):
+            yield from self.add_new(chunk)
+
+    def close(self):
+        """Remove the temporary database."""
+        if self.db is not None:
+            self.db.close()
+            os.remove(self.path)
+            self.db = None
@@ -1,16 +1,17 @@
 # -*- coding: utf-8 -*-
 
 import abc
-import datetime
 import logging
 import os
 import random
 import time
 
-from SearchAnalyzer.database import db_Proxy
+from SearchAnalyzer.database import ScraperSearch
 from SearchAnalyzer.output_converter import store_serp_result
 from SearchAnalyzer.parser.tools import get_parser_by_search_engine, parse_serp
 from SearchAnalyzer.proxies import Proxy
+from SearchAnalyzer.rate_limiting import RateLimiter
+from SearchAnalyzer.scheduler import StaticJobs
 
 logger = logging.getLogger(__name__)
 
@@ -94,6 +95,32 @@ def get_base_search_url_by_search_engine(config, search_engine_name, search_mode
     return specific_base_url
 
 
+# The status codes the search engines answer with when they throttle us
+BLOCKED_STATUS_CODES = (429, 503)
+
+
+def detect_block(search_engine, status_code=200, url='', html=''):
+    """Whether a response means that the search engine blocked the request.
+
+    Args:
+        search_engine: The name of the search engine.
+        status_code: The status code of the response.
+        url: The url of the response, after redirects.
+        html: The page.
+
+    Returns:
+        True on a 429 or 503, a redirect to the captcha url or a captcha page, see
+        SearchEngineScrape.malicious_request_needles.
+    """
+    if status_code in BLOCKED_STATUS_CODES:
+        return True
+
+    needles = SearchEngineScrape.malicious_request_needles.get(search_engine)
+    if not needles:
+        return False
+    return bool(url and needles['inurl'] in url) or bool(html and needles['inhtml'] in html)
+
+
 class SearchEngineScrape(metaclass=abc.ABCMeta):
     """Abstract base class that represents a search engine scrape.
     
@@ -146,7 +173,8 @@ class SearchEngineScrape(metaclass=abc.ABCMeta):
     }
 
     def __init__(self, config, cache_manager=None, jobs=None, scraper_search=None, session=None, db_lock=None, cache_lock=None,
-                 start_page_pos=1, search_engine=None, search_type=None, proxy=None, progress_queue=None):
+                 start_page_pos=1, search_engine=None, search_type=None, proxy=None, progress_queue=None,
+                 persistence=None, rate_limiter=None, proxy_pool=None):
         """Instantiate an SearchEngineScrape object.
 
         Args:
@@ -169,11 +197,18 @@ class SearchEngineScrape(metaclass=abc.ABCMeta):
         else:
             self.search_type = search_type
 
-        self.jobs = jobs
+        # a dict that maps the queries to their pages or a JobStream of the scheduler
+        self.jobs = StaticJobs(jobs) if isinstance(jobs, dict) else jobs
 
         # the keywords that couldn't be scraped by this worker
         self.missed_keywords = set()
 
+        # After this many failed searches in a row, the worker is probably banned.
+        # It stops and leaves its keywords to the other workers.
+        self.consecutive_failures = 0
+        self.max_consecutive_failures = int(self.config.get('max_consecutive_failures', 5))
+        self.banned = False
+
         # the number of keywords
         self.num_keywords = len(self.jobs)
 
@@ -229,16 +264,25 @@ class SearchEngineScrape(metaclass=abc.ABCMeta):
         # to visualize the progress
         self.progress_queue = progress_queue
 
-        # set the session
+        # set the session, a scoped session gives every thread its own
         self.session = session
 
+        # stores the SERPs in batches if given, see persistence.py
+        self.persistence = persistence
+
         # the current request time
         self.requested_at = None
 
         # The name of the scraper
         self.name = '[{}]'.format(self.search_engine_name) + self.__class__.__name__
 
-        # How long to sleep (in seconds) after every n-th request
+        # Paces the requests of all workers per search engine and proxy, see rate_limiting.py
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter(self.config)
+
+        # Hands out the best available proxy for every request if given, see proxy_pool.py
+        self.proxy_pool = proxy_pool
+
+        # How long to sleep (in seconds) after every n-th request if the search engine isn't rate limited
         self.sleeping_ranges = dict()
         self.sleeping_ranges = self.config.get(
             '{search_engine}_sleeping_ranges'.format(search_engine=self.search_engine_name),
@@ -264,10 +308,6 @@ class SearchEngineScrape(metaclass=abc.ABCMeta):
     def switch_proxy(self, proxy):
         """Switch the proxy on the communication channel."""
 
-    @abc.abstractmethod
-    def proxy_check(self, proxy):
-        """Check whether the assigned proxy works correctly and react"""
-
     @abc.abstractmethod
     def handle_request_denied(self, status_code):
         """Generic behaviour when search engines detect our scraping.
@@ -286,11 +326,19 @@ class SearchEngineScrape(metaclass=abc.ABCMeta):
         else:
             self.parser = None
 
+        if self.persistence:
+            serp = parse_serp(self.config, parser=self.parser, scraper=self, query=self.query)
+            self.persistence.put(serp)
+            store_serp_result(serp, self.config)
+            return bool(serp.num_results)
+
         with self.db_lock:
 
             serp = parse_serp(self.config, parser=self.parser, scraper=self, query=self.query)
 
-            self.scraper_search.serps.append(serp)
+            # the scraper search belongs to the session of the main thread
+            scraper_search = self.session.query(ScraperSearch).get(self.scraper_search.id)
+            serp.scraper_searches.append(scraper_search)
             self.session.add(serp)
             self.session.commit()
 
@@ -308,7 +356,7 @@ class SearchEngineScrape(metaclass=abc.ABCMeta):
     def keyword_info(self):
         """Print a short summary where we are in the scrape and what's the next keyword."""
         logger.info(
-            '[{thread_name}][{ip}]]Keyword: "{keyword}" with {num_pages} pages, slept {delay} seconds before '
+            '[{thread_name}][{ip}]]Keyword: "{keyword}" with {num_pages} pages, slept {delay:.1f} seconds before '
             'scraping. {done}/{all} already scraped.'.format(
                 thread_name=self.name,
                 ip=self.requested_by,
@@ -316,7 +364,7 @@ class SearchEngineScrape(metaclass=abc.ABCMeta):
                 num_pages=self.pages_per_keyword,
                 delay=self.current_delay,
                 done=self.search_number,
-                all=self.num_keywords
+                all=len(self.jobs)
             ))
 
     def instance_creation_info(self, scraper_name):
@@ -326,6 +374,28 @@ class SearchEngineScrape(metaclass=abc.ABCMeta):
             len(self.jobs),
             self.pages_per_keyword))
 
+    def search_failed(self, pages):
+        """Let another worker retry a page of the current keyword that couldn't be scraped.
+
+        Args:
+            pages: The failed page and the pages of the keyword that follow it.
+
+        Returns:
+            True if the worker is banned and should stop. Then all the pages are requeued.
+        """
+        self.missed_keywords.add(self.query)
+        self.consecutive_failures += 1
+
+        if self.consecutive_failures >= self.max_consecutive_failures:
+            logger.warning('{} failed {} times in a row, stopping it.'.format(self.requested_by,
+                                                                              self.consecutive_failures))
+            self.banned = True
+            self.jobs.retry(pages)
+        else:
+            self.jobs.retry(pages[:1])
+
+        return self.banned
+
     def cache_results(self):
         """Caches the html for the current request."""
         self.cache_manager.cache_results(self.parser, self.query, self.search_engine_name, self.scrape_method, self.page_number,
@@ -350,18 +420,46 @@ class SearchEngineScrape(metaclass=abc.ABCMeta):
         # sleep one second
         return 1, 2
 
+    def report_response(self, blocked):
+        """Let the rate limiter adapt the rate of the search engine and proxy to a response.
+
+        Args:
+            blocked: Whether the search engine blocked the request, see detect_block().
+        """
+        self.rate_limiter.feedback(self.search_engine_name, self.requested_by, blocked)
+
+    def acquire_proxy(self):
+        """Switch to the best available proxy of the proxy pool for the next request."""
+        if self.proxy_pool is not None:
+            self.switch_proxy(self.proxy_pool.acquire(self.search_engine_name))
+
+    def release_proxy(self, success, latency=None, blocked=False):
+        """Hand the proxy back to the proxy pool with the outcome of the request, see ProxyPool.release()."""
+        if self.proxy_pool is not None:
+            self.proxy_pool.release(self.proxy, self.search_engine_name, success, latency=latency, blocked=blocked)
+
     def detection_prevention_sleep(self):
-        # match the largest sleep range
-        self.current_delay = random.randrange(*self._largest_sleep_range(self.search_number))
-        time.sleep(self.current_delay)
+        self.current_delay = self.rate_limiter.wait(self.search_engine_name, self.requested_by)
+        if self.current_delay is None:
+            # match the largest sleep range
+            self.current_delay = random.randrange(*self._largest_sleep_range(self.search_number))
+            time.sleep(self.current_delay)
 
-    def after_search(self):
+    def after_search(self, store=True):
         """Store the results and parse em.
 
         Notify the progress queue if necessary.
+
+        Args:
+            store: False if no response arrived or the search engine denied the request. Then the page
+                   is neither stored nor cached, such that its scrape job stays pending and the page
+                   is scraped again.
         """
         self.search_number += 1
 
+        if not store:
+            return
+
         if not self.store():
             logger.debug('No results to store for keyword: "{}" in search engine: {}'.format(self.query,
                                                                                     self.search_engine_name))
@@ -371,35 +469,10 @@ class SearchEngineScrape(metaclass=abc.ABCMeta):
         self.cache_results()
 
     def before_search(self):
-        """Things that need to happen before entering the search loop."""
-        # check proxies first before anything
-        if self.config.get('check_proxies', True) and self.proxy:
-            if not self.proxy_check():
-                self.startable = False
-
-    def update_proxy_status(self, status, ipinfo=None, online=True):
-        """Sets the proxy status with the results of ipinfo.io
+        """Things that need to happen before entering the search loop.
 
-        Args:
-            status: A string the describes the status of the proxy.
-            ipinfo: The json results from ipinfo.io
-            online: Whether the proxy is usable or not.
+        The proxies are checked all at once before the workers are created, see proxies.check_proxies().
         """
-        ipinfo = ipinfo or {}
-
-        with self.db_lock:
-
-            proxy = self.session.query(db_Proxy).filter(self.proxy.host == db_Proxy.ip).first()
-            if proxy:
-                for key in ipinfo.keys():
-                    setattr(proxy, key, ipinfo[key])
-
-                proxy.checked_at = datetime.datetime.utcnow()
-                proxy.status = status
-                proxy.online = online
-
-                self.session.add(proxy)
-                self.session.commit()
 
 
 from SearchAnalyzer.http_mode import HttpScrape
@@ -408,7 +481,8 @@ from SearchAnalyzer.selenium_mode import get_selenium_scraper_by_search_engine_n
 
 class ScrapeWorkerFactory():
     def __init__(self, config, cache_manager=None, mode=None, proxy=None, search_engine=None, session=None, db_lock=None,
-                 cache_lock=None, scraper_search=None, captcha_lock=None, progress_queue=None, browser_num=1):
+                 cache_lock=None, scraper_search=None, captcha_lock=None, progress_queue=None, browser_num=1,
+                 persistence=None, scheduler=None, rate_limiter=None, proxy_pool=None):
 
         self.config = config
         self.cache_manager = cache_manager
@@ -422,8 +496,16 @@ class ScrapeWorkerFactory():
         self.captcha_lock = captcha_lock
         self.progress_queue = progress_queue
         self.browser_num = browser_num
-
-        self.jobs = dict()
+        self.persistence = persistence
+        self.rate_limiter = rate_limiter
+        # only the http workers switch their proxy per request
+        self.proxy_pool = proxy_pool
+
+        # the worker pulls its jobs from the scheduler if given, else it gets the jobs added before
+        if scheduler:
+            self.jobs = scheduler.stream(search_engine, mode)
+        else:
+            self.jobs = dict()
 
     def is_suitabe(self, job):
 
@@ -459,6 +541,8 @@ class ScrapeWorkerFactory():
                     progress_queue=self.progress_queue,
                     captcha_lock=self.captcha_lock,
                     browser_num=self.browser_num,
+                    persistence=self.persistence,
+                    rate_limiter=self.rate_limiter,
                 )
 
             elif self.mode == 'http':
@@ -474,6 +558,9 @@ class ScrapeWorkerFactory():
                     db_lock=self.db_lock,
                     proxy=self.proxy,
                     progress_queue=self.progress_queue,
+                    persistence=self.persistence,
+                    rate_limiter=self.rate_limiter,
+                    proxy_pool=self.proxy_pool,
                 )
 
         return None
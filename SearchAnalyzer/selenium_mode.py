@@ -3,11 +3,9 @@
 import tempfile
 import threading
 from urllib.parse import quote
-import json
 import datetime
 import time
 import math
-import re
 import sys
 import os
 
@@ -24,7 +22,8 @@ except ImportError as ie:
     print(ie)
     sys.exit('You can install missing modules with `pip3 install [modulename]`')
 
-from SearchAnalyzer.scraping import SearchEngineScrape, SeleniumSearchError, get_base_search_url_by_search_engine, MaliciousRequestDetected
+from SearchAnalyzer.scraping import SearchEngineScrape, SeleniumSearchError, get_base_search_url_by_search_engine, MaliciousRequestDetected, \
+    detect_block
 from SearchAnalyzer.user_agents import random_user_agent
 import logging
 
@@ -154,35 +153,6 @@ class SelScrape(SearchEngineScrape, threading.Thread):
     def switch_proxy(self, proxy):
         """Switch the proxy on the communication channel."""
 
-    def proxy_check(self, proxy):
-        assert self.proxy and self.webdriver, 'Scraper instance needs valid webdriver and proxy instance to make the proxy check'
-
-        online = False
-        status = 'Proxy check failed: {host}:{port} is not used while requesting'.format(**self.proxy.__dict__)
-        ipinfo = {}
-
-        try:
-            self.webdriver.get(self.config.get('proxy_info_url'))
-            try:
-                text = re.search(r'(\{.*?\})', self.webdriver.page_source, flags=re.DOTALL).group(0)
-                ipinfo = json.loads(text)
-            except ValueError as v:
-                logger.critical(v)
-
-        except Exception as e:
-            status = str(e)
-
-        if 'ip' in ipinfo and ipinfo['ip']:
-            online = True
-            status = 'Proxy is working.'
-        else:
-            logger.warning(status)
-
-        super().update_proxy_status(status, ipinfo, online)
-
-        return online
-
-
     def _save_debug_screenshot(self):
         """
         Saves a debug screenshot of the browser window to figure
@@ -530,8 +500,13 @@ class SelScrape(SearchEngineScrape, threading.Thread):
 
             self.search_input = self._wait_until_search_input_field_appears()
 
+            if self.search_input is False:
+                super().report_response(True)
+
             if self.search_input is False and self.config.get('stop_on_detection'):
                 self.status = 'Malicious request detected'
+                # let the other workers scrape the keyword
+                self.jobs.retry(self.pages_per_keyword)
                 return
 
             if self.search_input is False:
@@ -587,7 +562,14 @@ class SelScrape(SearchEngineScrape, threading.Thread):
                 except WebDriverException as e:
                     self.html = self.webdriver.page_source
 
-                super().after_search()
+                blocked = detect_block(self.search_engine_name, url=self.webdriver.current_url, html=self.html)
+                super().report_response(blocked)
+                super().after_search(store=not blocked)
+
+                if blocked:
+                    # don't store the captcha page, let the other workers scrape the rest of the keyword
+                    self.jobs.retry(self.pages_per_keyword[self.pages_per_keyword.index(self.page_number):])
+                    break
 
                 # Click the next page link not when leaving the loop
                 # in the next iteration.
@@ -622,23 +604,28 @@ class SelScrape(SearchEngineScrape, threading.Thread):
 
         self._set_xvfb_display()
 
-        if not self._get_webdriver():
-            raise Exception('{}: Aborting due to no available selenium webdriver.'.format(self.name))
-
         try:
-            self.webdriver.set_window_size(400, 400)
-            self.webdriver.set_window_position(400 * (self.browser_num % 4), 400 * (math.floor(self.browser_num // 4)))
-        except WebDriverException as e:
-            logger.debug('Cannot set window size: {}'.format(e))
-
-        super().before_search()
+            if not self._get_webdriver():
+                raise Exception('{}: Aborting due to no available selenium webdriver.'.format(self.name))
 
-        if self.startable:
-            self.build_search()
-            self.search()
-
-        if self.webdriver:
-            self.webdriver.quit()
+            try:
+                self.webdriver.set_window_size(400, 400)
+                self.webdriver.set_window_position(400 * (self.browser_num % 4),
+                                                   400 * (math.floor(self.browser_num // 4)))
+            except WebDriverException as e:
+                logger.debug('Cannot set window size: {}'.format(e))
+
+            super().before_search()
+
+            if self.startable:
+                self.build_search()
+                self.search()
+
+            if self.webdriver:
+                self.webdriver.quit()
+        finally:
+            # the other workers take over the remaining jobs
+            self.jobs.close()
 
 
 """
@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import logging
+import socket
+import ssl
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+from urllib3.poolmanager import PoolManager
+
+import SearchAnalyzer.socks as socks
+
+"""
+Routes the requests of a worker through its own proxy.
+
+Patching the socket module with socks.wrap_module() sets one proxy for the whole process,
+so all threads share the proxy of the worker that started last. Instead, every HttpScrape
+worker gets a requests session with a ProxyAdapter. The connections of its pool connect
+through the proxy of the worker with a socks.socksocket, such that n proxies give
+n independent ways out that are used in parallel.
+
+SOCKS4, SOCKS5 and HTTP (CONNECT) proxies are supported, see socks.py.
+
+The session of a worker keeps its connections alive: there is a pool per search engine
+host of at most `http_pool_maxsize` connections, for at most `http_pool_connections`
+hosts. A session that was idle for `http_idle_timeout` seconds drops its connections
+before the next request instead of running into connections the server closed meanwhile.
+TLS sessions are cached per host, such that new connections resume them with an
+abbreviated handshake. urllib3 disables session tickets by default, TLSSessionContext
+enables them again.
+
+ConnectionStats counts the requests, connections and TLS handshakes of a session.
+"""
+
+logger = logging.getLogger(__name__)
+
+PROXY_TYPES = {
+    'socks4': socks.SOCKS4,
+    'socks5': socks.SOCKS5,
+    'http': socks.HTTP,
+}
+
+
+class ConnectionStats(collections.Counter):
+    """Counters of a http session, shared by its connections.
+
+    requests: The number of responses received.
+    connections: The number of connections opened.
+    connect_time: The seconds spent connecting, including the proxy and TLS handshakes.
+    tls_handshakes: The number of TLS handshakes.
+    tls_resumed: The number of TLS handshakes that resumed a cached session.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lock = threading.Lock()
+
+    def incr(self, name, value=1):
+        with self.lock:
+            self[name] += value
+
+
+def stats_info(stats):
+    """A readable summary of ConnectionStats or the sum of some.
+
+    The time saved by the reused connections is estimated from the average connect time.
+    """
+    reused = max(0, stats['requests'] - stats['connections'])
+    saved = reused * stats['connect_time'] / stats['connections'] if stats['connections'] else 0.0
+    return '{} requests over {} new and {} reused connections (~{:.1f}s connect time saved), ' \
+           '{} TLS handshakes with {} resumed sessions'.format(stats['requests'], stats['connections'], reused,
+                                                               saved, stats['tls_handshakes'], stats['tls_resumed'])
+
+
+class CountingConnection(HTTPConnection):
+    """A HTTP connection that counts the connections it opens in `stats`.
+
+    The pool managers set `stats` in a subclass of their own, see ConnectionPoolManager.
+    """
+
+    stats = None
+
+    def connect(self):
+        started = time.monotonic()
+        super().connect()
+        if self.stats is not None:
+            self.stats.incr('connections')
+            self.stats.incr('connect_time', time.monotonic() - started)
+
+
+class CountingHTTPSConnection(CountingConnection, HTTPSConnection):
+    pass
+
+
+class ProxyConnection(CountingConnection):
+    """A HTTP connection that connects through the proxy in `proxy_options`."""
+
+    proxy_options = None
+
+    def _new_conn(self):
+        options = self.proxy_options
+        sock = socks.socksocket()
+        if isinstance(self.timeout, (int, float)):
+            sock.settimeout(self.timeout)
+        # rdns: the proxy resolves the host names. Never resolve them locally with TOR.
+        sock.set_proxy(options['proxy_type'], options['host'], options['port'], rdns=True,
+                       username=options['username'], password=options['password'])
+
+        try:
+            sock.connect((self.host, self.port))
+        except socket.timeout as e:
+            sock.close()
+            raise ConnectTimeoutError(self, 'Connection to {} through proxy {}:{} timed out.'.format(
+                self.host, options['host'], options['port'])) from e
+        except (socks.ProxyError, OSError) as e:
+            sock.close()
+            raise NewConnectionError(self, 'Failed to establish a new connection through proxy {}:{}: {}'.format(
+                options['host'], options['port'], e)) from e
+
+        return sock
+
+
+class ProxyHTTPSConnection(ProxyConnection, CountingHTTPSConnection):
+    pass
+
+
+class TLSSessionSocket(ssl.SSLSocket):
+    """Hands its TLS session back to the TLSSessionContext when it's closed.
+
+    With TLS 1.3 the session ticket arrives after the handshake, so it's only known later.
+    """
+
+    def close(self):
+        if not self._closed:
+            self.context.remember(self)
+        super().close()
+
+
+class TLSSessionContext(ssl.SSLContext):
+    """A client SSLContext that resumes the last TLS session of a host."""
+
+    sslsocket_class = TLSSessionSocket
+
+    def __new__(cls, stats=None):
+        return super().__new__(cls, ssl.PROTOCOL_TLS_CLIENT)
+
+    def __init__(self, stats=None):
+        super().__init__()
+        self.stats = stats
+        self.sessions = {}
+        self.minimum_version = ssl.TLSVersion.TLSv1_2
+        self.load_default_certs()
+
+    @property
+    def verify_mode(self):
+        return super().verify_mode
+
+    @verify_mode.setter
+    def verify_mode(self, value):
+        # urllib3 sets the verify_mode of every connection, which fails with check_hostname for verify=False.
+        # Once it's off, urllib3 matches the host names of the verified connections itself.
+        if value == ssl.CERT_NONE:
+            self.check_hostname = False
+        ssl.SSLContext.verify_mode.__set__(self, value)
+
+    def remember(self, sock):
+        session = sock.session
+        if sock.server_hostname and session is not None and (session.has_ticket or session.id):
+            self.sessions[sock.server_hostname] = session
+
+    def wrap_socket(self, sock, *args, server_hostname=None, session=None, **kwargs):
+        if session is None:
+            session = self.sessions.get(server_hostname)
+        sslsock = super().wrap_socket(sock, *args, server_hostname=server_hostname, session=session, **kwargs)
+        self.remember(sslsock)
+        if self.stats is not None:
+            self.stats.incr('tls_handshakes')
+            if sslsock.session_reused:
+                self.stats.incr('tls_resumed')
+        return sslsock
+
+
+class ConnectionPoolManager(PoolManager):
+    """A pool manager whose connections count themselves in `stats`.
+
+    urllib3 passes only the options of its pool keys on to the connections, so the
+    shared options of the connections are class attributes of a connection class
+    that is created for every manager. Its pools are picked with the public
+    `pool_classes_by_scheme` of the PoolManager.
+    """
+
+    connection_classes = {
+        'http': (HTTPConnectionPool, CountingConnection),
+        'https': (HTTPSConnectionPool, CountingHTTPSConnection),
+    }
+
+    def __init__(self, stats, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = stats
+        self.pool_classes_by_scheme = {}
+        for scheme, (pool_cls, connection_cls) in self.connection_classes.items():
+            connection_cls = type(connection_cls.__name__, (connection_cls,), self.connection_options())
+            self.pool_classes_by_scheme[scheme] = type(pool_cls.__name__, (pool_cls,),
+                                                       {'ConnectionCls': connection_cls})
+
+    def connection_options(self):
+        """The class attributes of the connections of all pools."""
+        return {'stats': self.stats}
+
+
+class ProxyPoolManager(ConnectionPoolManager):
+    """A pool manager whose connections all go through one proxy."""
+
+    connection_classes = {
+        'http': (HTTPConnectionPool, ProxyConnection),
+        'https': (HTTPSConnectionPool, ProxyHTTPSConnection),
+    }
+
+    def __init__(self, proxy_options, *args, **kwargs):
+        self.proxy_options = proxy_options
+        super().__init__(*args, **kwargs)
+
+    def connection_options(self):
+        return dict(super().connection_options(), proxy_options=self.proxy_options)
+
+
+class PooledAdapter(HTTPAdapter):
+    """A transport adapter for requests that keeps its connections alive and counts them."""
+
+    stats = None
+    ssl_context = None
+    idle_timeout = 0
+    last_used = None
+
+    def __init__(self, stats=None, ssl_context=None, idle_timeout=0, **kwargs):
+        """Create the adapter.
+
+        Args:
+            stats: The ConnectionStats to count in.
+            ssl_context: The SSLContext of the https connections, None for the one of urllib3.
+            idle_timeout: Drop all connections before a request if the adapter was idle
+                          for this many seconds. 0 keeps them.
+            kwargs: The pool_connections, pool_maxsize and max_retries of the HTTPAdapter.
+        """
+        self.stats = stats if stats is not None else ConnectionStats()
+        self.ssl_context = ssl_context
+        self.idle_timeout = idle_timeout
+        self.last_used = None
+        super().__init__(**kwargs)
+
+    def pool_manager_kwargs(self, connections, maxsize, block, pool_kwargs):
+        kwargs = dict(pool_kwargs, num_pools=connections, maxsize=maxsize, block=block)
+        if self.ssl_context is not None:
+            kwargs['ssl_context'] = self.ssl_context
+        return kwargs
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        self._pool_connections = connections
+        self._pool_maxsize = maxsize
+        self._pool_block = block
+        self.poolmanager = ConnectionPoolManager(self.stats, **self.pool_manager_kwargs(connections, maxsize, block,
+                                                                                        pool_kwargs))
+
+    def send(self, request, *args, **kwargs):
+        now = time.monotonic()
+        if self.idle_timeout and self.last_used is not None and now - self.last_used > self.idle_timeout:
+            logger.debug('Dropping the connections that were idle for {:.0f}s.'.format(now - self.last_used))
+            self.poolmanager.clear()
+
+        try:
+            response = super().send(request, *args, **kwargs)
+        finally:
+            self.last_used = time.monotonic()
+
+        self.stats.incr('requests')
+        return response
+
+
+class ProxyAdapter(PooledAdapter):
+    """A transport adapter for requests that is bound to a proxy."""
+
+    def __init__(self, proxy, **kwargs):
+        """Create the adapter.
+
+        Args:
+            proxy: A proxies.Proxy.
+            kwargs: See PooledAdapter.
+
+        Raises:
+            ValueError if the protocol of the proxy is not supported.
+        """
+        if proxy.proto not in PROXY_TYPES:
+            raise ValueError('Unsupported proxy protocol "{}". Use one of {}'.format(
+                proxy.proto, ', '.join(PROXY_TYPES)))
+
+        self.proxy_options = {
+            'proxy_type': PROXY_TYPES[proxy.proto],
+            'host': proxy.host,
+            'port': int(proxy.port),
+            'username': proxy.username or None,
+            'password': proxy.password or None,
+        }
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        self._pool_connections = connections
+        self._pool_maxsize = maxsize
+        self._pool_block = block
+        self.poolmanager = ProxyPoolManager(self.proxy_options, self.stats,
+                                            **self.pool_manager_kwargs(connections, maxsize, block, pool_kwargs))
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state['proxy_options'] = self.proxy_options
+        return state
+
+
+def get_http_session(proxy=None, config=None, stats=None):
+    """A requests session that keeps its connections alive and connects through the proxy.
+
+    Args:
+        proxy: A proxies.Proxy or None to connect directly.
+        config: The configuration with the `http_pool_*`, `http_idle_timeout` and
+                `http_reuse_tls_sessions` options. None for the defaults.
+        stats: The ConnectionStats to count in, e.g. the ones of the session this one replaces.
+
+    Returns:
+        The requests.Session. Its connections are counted in its `stats`.
+    """
+    config = config or {}
+    stats = stats if stats is not None else ConnectionStats()
+
+    kwargs = {
+        'stats': stats,
+        'pool_connections': int(config.get('http_pool_connections', 10)),
+        'pool_maxsize': int(config.get('http_pool_maxsize', 4)),
+        'idle_timeout': float(config.get('http_idle_timeout', 60)),
+    }
+    if config.get('http_reuse_tls_sessions', True):
+        kwargs['ssl_context'] = TLSSessionContext(stats)
+
+    session = requests.Session()
+    session.stats = stats
+
+    if proxy:
+        # ignore the proxies of the environment, the proxy is set up by the adapter
+        session.trust_env = False
+        adapter = ProxyAdapter(proxy, **kwargs)
+    else:
+        adapter = PooledAdapter(**kwargs)
+
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-from itertools import zip_longest
+from itertools import islice, zip_longest
 import re
 import requests
 import os
@@ -25,6 +25,27 @@ def grouper(iterable, n, fillvalue=None):
     return [list(filter(None.__ne__, list(group))) for group in groups]
 
 
+def chunked(iterable, size):
+    """Lazily split an iterable into lists of size elements.
+
+    >>> list(chunked(range(5), 2))
+    [[0, 1], [2, 3], [4]]
+
+    Args:
+        iterable: An iterable, possibly infinite.
+        size: The length of the chunks. The last one may be shorter.
+
+    Yields:
+        The chunks as lists.
+    """
+    it = iter(iterable)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
 def chunk_it(seq, num):
     """Make num chunks from elements in seq.
 
@@ -2,6 +2,8 @@
 # -*- coding: utf-8 -*-
 
 import os
+import shutil
+import tempfile
 import unittest
 from collections import Counter
 
@@ -17,10 +19,21 @@ all_search_engines = config.get('supported_search_engines')
 
 class SearchAnalyzerIntegrationTestCase(unittest.TestCase):
     def setUp(self):
-        pass
+        self.tmpdir = tempfile.mkdtemp()
 
     def tearDown(self):
-        pass
+        shutil.rmtree(self.tmpdir)
+
+    def cachedir(self, name):
+        """A copy of a cache directory of the test data.
+
+        Scraping writes the parse results, the index and the access snapshot to the cache
+        directory, which must not end up next to the test data.
+        """
+        path = os.path.join(self.tmpdir, name)
+        if not os.path.exists(path):
+            shutil.copytree(os.path.join(base, 'data', name), path)
+        return path + '/'
 
     # Test (very) static parsing for all search engines. The html files are saved in 'data/uncompressed_serp_pages/'
     # The sample files may become old and the SERP format may change over time. But this is the only
@@ -166,7 +179,7 @@ class SearchAnalyzerIntegrationTestCase(unittest.TestCase):
             'search_engines': all_search_engines,
             'num_pages_for_keyword': 2,
             'scrape_method': 'selenium',
-            'cachedir': os.path.join(base, 'data/csv_tests/'),
+            'cachedir': self.cachedir('csv_tests'),
             'do_caching': True,
             'verbosity': 0,
             'output_filename': csv_outfile,
@@ -216,7 +229,7 @@ class SearchAnalyzerIntegrationTestCase(unittest.TestCase):
             'search_engines': all_search_engines,
             'num_pages_for_keyword': 2,
             'scrape_method': 'selenium',
-            'cachedir': os.path.join(base, 'data/json_tests/'),
+            'cachedir': self.cachedir('json_tests'),
             'do_caching': True,
             'verbosity': 0,
             'output_filename': json_outfile
@@ -303,15 +316,14 @@ class SearchAnalyzerIntegrationTestCase(unittest.TestCase):
         assert parser.page_number == 7, 'Wrong page number. Got {}'.format(parser.page_number)
 
     # test all SERP object indicate no results for all search engines.
-    @staticmethod
-    def test_no_results_serp_object():
+    def test_no_results_serp_object(self):
 
         cfg = {
             'keyword': '---; ;;; =++===',
             'search_engines': ['google', 'google_ua', 'bing'],
             'num_pages_for_keyword': 1,
             'scrape_method': 'http',
-            'cachedir': os.path.join(base, 'data/no_results/'),
+            'cachedir': self.cachedir('no_results'),
             'do_caching': True,
             'verbosity': 1,
         }
@@ -354,8 +366,7 @@ Was Titanic macht ist Satire."'
 
             # test correct parsing of the number of results for the query..
 
-    @staticmethod
-    def test_csv_file_header_always_the_same():
+    def test_csv_file_header_always_the_same(self):
         """
         Check that csv files have always the same order in their header.
         """
@@ -367,7 +378,7 @@ Was Titanic macht ist Satire."'
             'search_engines': all_search_engines,
             'num_pages_for_keyword': 2,
             'scrape_method': 'selenium',
-            'cachedir': os.path.join(base, 'data/csv_tests/'),
+            'cachedir': self.cachedir('csv_tests'),
             'do_caching': True,
             'verbosity': 0,
             'output_filename': csv_outfile_1,
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import time
+import unittest
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from SearchAnalyzer.async_mode import AsyncScrapeScheduler
+from SearchAnalyzer.config import get_config
+from SearchAnalyzer.proxies import Proxy
+
+with open(os.path.join(os.path.dirname(__file__), 'data/uncompressed_serp_pages/hello_bing_de_ip.html'), 'rb') as fd:
+    SERP_PAGE = fd.read()
+
+# how long the stub search engine takes to answer a query
+DELAYS = {'slow': 1.0, 'hanging': 5.0}
+
+
+class StubSearchEngine(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)['q'][0]
+        server = self.server
+        with server.lock:
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+
+        time.sleep(DELAYS.get(query, 0.1))
+
+        with server.lock:
+            server.in_flight -= 1
+        if query == 'blocked':
+            self.send_error(429)
+            return
+        try:
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(SERP_PAGE)))
+            self.end_headers()
+            self.wfile.write(SERP_PAGE)
+        except OSError:
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+class StubProxy(BaseHTTPRequestHandler):
+    """A forward HTTP proxy that counts its requests."""
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+            body = opener.open(self.path).read()
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server(handler):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.lock = threading.Lock()
+    server.requests = server.in_flight = server.max_in_flight = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class CollectingPersistence(object):
+    def __init__(self):
+        self.serps = []
+
+    def put(self, serp):
+        self.serps.append(serp)
+
+
+class AsyncModeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = start_server(StubSearchEngine)
+        self.servers = [self.server]
+
+        self.config = dict(get_config())
+        self.config.update({
+            'bing_search_url': 'http://127.0.0.1:{}/search?'.format(self.server.server_address[1]),
+            'max_concurrent_requests': 2,
+            'async_request_timeout': 2,
+            'async_parse_workers': 2,
+            'requests_per_minute': 0,
+        })
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def scrape(self, queries, proxies=None):
+        jobs = [{'query': query, 'search_engine': 'bing', 'scrape_method': 'http-async', 'page_number': 1}
+                for query in queries]
+        persistence = CollectingPersistence()
+        scheduler = AsyncScrapeScheduler(self.config, jobs, persistence=persistence, proxies=proxies)
+        scheduler.run()
+        self.serps = persistence.serps
+        return scheduler, [serp.query for serp in persistence.serps]
+
+    def test_sliding_window(self):
+        scheduler, queries = self.scrape(['slow', 'a', 'b', 'c', 'd'])
+
+        # the fast queries use the second slot while the slow one is running
+        assert queries == ['a', 'b', 'c', 'd', 'slow']
+        assert self.server.max_in_flight == 2
+        assert scheduler.num_scraped == scheduler.num_requests == 5
+
+    def test_timeout(self):
+        started = time.time()
+        scheduler, queries = self.scrape(['hanging', 'a'])
+
+        assert queries == ['a']
+        assert scheduler.num_requests == 2 and scheduler.num_scraped == 1
+        assert time.time() - started < DELAYS['hanging']
+
+    def test_parse_threads(self):
+        self.config.update({'async_parse_executor': 'thread', 'async_parse_workers': 1, 'async_parse_queue_size': 1})
+        scheduler, queries = self.scrape(['a', 'b', 'c'])
+
+        assert sorted(queries) == ['a', 'b', 'c']
+        assert scheduler.num_scraped == 3
+
+    def test_proxies(self):
+        servers = [start_server(StubProxy) for _ in range(2)]
+        self.servers += servers
+        proxies = [Proxy('http', '127.0.0.1', str(server.server_address[1]), '', '') for server in servers]
+        proxies.append(Proxy('ftp', '127.0.0.1', '21', '', ''))
+        self.config.update({'max_concurrent_requests': 10, 'max_concurrent_requests_per_proxy': 1})
+
+        scheduler, queries = self.scrape(['a', 'b', 'c', 'd'], proxies=proxies)
+
+        # the unsupported proxy is skipped, the others take turns one request at a time
+        assert sorted(queries) == ['a', 'b', 'c', 'd']
+        assert [server.requests for server in servers] == [2, 2]
+        assert [server.max_in_flight for server in servers] == [1, 1]
+        assert {serp.requested_by for serp in self.serps} == {proxy.host + ':' + proxy.port for proxy in proxies[:2]}
+
+        with self.assertRaises(ValueError):
+            AsyncScrapeScheduler(self.config, [], proxies=proxies[2:])
+
+    def test_proxy_with_int_port(self):
+        # the proxies loaded from the database have int ports
+        server = start_server(StubProxy)
+        self.servers.append(server)
+        proxy = Proxy('http', '127.0.0.1', server.server_address[1], '', '')
+
+        scheduler, queries = self.scrape(['a', 'b'], proxies=[proxy])
+
+        assert sorted(queries) == ['a', 'b']
+        assert server.requests == 2
+        assert {serp.requested_by for serp in self.serps} == {'127.0.0.1:{}'.format(proxy.port)}
+
+    def test_blocks_slow_down(self):
+        self.config.update({'requests_per_minute': 6000, 'rate_limit_burst': 10, 'rate_limit_jitter': 0})
+        scheduler, queries = self.scrape(['a', 'blocked'])
+
+        assert queries == ['a']
+        # halved by the block, the clean response adds next to nothing
+        self.assertAlmostEqual(scheduler.rate_limiter.rates()[('bing', 'localhost')], 3000, delta=0.01)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import requests
+
+from SearchAnalyzer.cache_server import CacheServer, RemoteCacheBackend, TieredCacheBackend, pack_records, \
+    unpack_records
+from SearchAnalyzer.caching import CacheManager
+from SearchAnalyzer.config import get_config
+
+
+class DummyParser(object):
+    def __init__(self, html):
+        self.html = html
+        self.cleaned_html = html
+
+
+class CacheServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config = dict(get_config())
+        self.config.update({
+            'do_caching': True,
+            'compress_cached_files': True,
+            'compressing_algorithm': 'gz',
+            'cache_server_dir': os.path.join(self.tmpdir, 'server'),
+        })
+
+        self.server = CacheServer(self.config, ('127.0.0.1', 0))
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.config['cache_server_url'] = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def node(self, name):
+        config = dict(self.config, cachedir=os.path.join(self.tmpdir, name))
+        return CacheManager(config)
+
+    def test_records(self):
+        records = [('a' * 64 + '.cache', 'gz', 1.5, b'\x00data'), ('b' * 64 + '.cache', '', 2.0, b'')]
+        assert list(unpack_records(pack_records(records))) == records
+
+        with self.assertRaises(ValueError):
+            list(unpack_records(pack_records(records)[:-3]))
+
+    def test_nodes_share_pages(self):
+        first = self.node('first')
+        assert isinstance(first.backend, TieredCacheBackend)
+        first.cache_results(DummyParser('<html>shared</html>'), 'shared', 'google', 'http', 1)
+        first.close()
+
+        second = self.node('second')
+        assert second.get_cached('shared', 'google', 'http', 1) == '<html>shared</html>'
+        # now it's in the local tier
+        assert second.cached_file_name('shared', 'google', 'http', 1) in second.backend.local
+        assert second.get_cached('shared', 'google', 'http', 2) is False
+        # misses are answered by the filter of the server
+        assert not second.backend.on_server(second.cached_file_name('shared', 'google', 'http', 2))
+
+    def test_batch_prefetch(self):
+        first = self.node('first')
+        for page in range(1, 4):
+            first.cache_results(DummyParser('<html>{}</html>'.format(page)), 'batch', 'bing', 'http', page)
+        first.flush()
+
+        second = self.node('second')
+        names = [second.cached_file_name('batch', 'bing', 'http', page) for page in range(1, 5)]
+        assert second.backend.prefetch(names) == 3
+        assert all(name in second.backend for name in names[:3])
+
+    def test_ttl(self):
+        self.server.ttl = 60
+        remote = RemoteCacheBackend(self.config)
+        name = 'c' * 64 + '.cache'
+        assert remote.put_many([(name, '', time.time() - 120, b'old')])
+        assert remote.get(name) is None
+        assert name not in self.server.backend
+
+    def test_body_size_limit(self):
+        self.server.max_body_size = 100
+        url = '{}/cache/{}'.format(self.config['cache_server_url'], 'd' * 64 + '.cache')
+        response = requests.put(url, data=b'x' * 101, headers={'X-Cache-Compression': ''})
+        assert response.status_code == 413
+        assert 'd' * 64 + '.cache' not in self.server.backend
+
+        remote = RemoteCacheBackend(self.config)
+        assert not remote.put_many([('e' * 64 + '.cache', '', time.time(), b'x' * 200)])
+        assert remote.put_many([('e' * 64 + '.cache', '', time.time(), b'x' * 10)])
+
+    def test_rejects_invalid_uploads(self):
+        name = 'f' * 64 + '.cache'
+        url = '{}/cache/{}'.format(self.config['cache_server_url'], name)
+        for headers in ({'X-Cache-Compression': 'zdict'}, {'X-Cache-Compression': 'xz'},
+                        {'X-Cache-Compression': 'gz', 'X-Cache-Mtime': 'yesterday'}):
+            response = requests.put(url, data=b'page', headers=dict(headers, Connection='close'))
+            assert response.status_code == 400
+
+        batch_url = '{}/batch/put'.format(self.config['cache_server_url'])
+        for record in ((name, 'zdict', time.time(), b'page'), (name, 'gz', float('nan'), b'page')):
+            response = requests.post(batch_url, data=pack_records([record]), headers={'Connection': 'close'})
+            assert response.status_code == 400
+        assert name not in self.server.backend
+
+    def test_listens_on_localhost(self):
+        server = CacheServer(dict(self.config, cache_server_listen=':0',
+                                  cache_server_dir=os.path.join(self.tmpdir, 'local')))
+        assert server.server_address[0] == '127.0.0.1'
+        server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
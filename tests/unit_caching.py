@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+from SearchAnalyzer import scrape_config
+from SearchAnalyzer.cache_compression import benchmark_compression
+from SearchAnalyzer.cache_filter import BloomFilter
+from SearchAnalyzer.caching import CacheIndex, CacheManager, CacheWriter
+from SearchAnalyzer.commandline import get_command_line
+from SearchAnalyzer.packed_cache import PackedCacheBackend
+from SearchAnalyzer.config import get_config
+from SearchAnalyzer.core import replay_cache
+from SearchAnalyzer.database import ScraperSearch, SearchEngineResultsPage, get_session
+from SearchAnalyzer.parser.tools import get_parser_by_search_engine
+from SearchAnalyzer.scrape_jobs import default_scrape_jobs_for_keywords
+
+
+class DummyParser(object):
+    def __init__(self, html):
+        self.html = html
+        self.cleaned_html = html
+
+
+class CacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+        self.config = dict(get_config())
+        self.config.update({
+            'cachedir': self.cachedir,
+            'do_caching': True,
+            'compress_cached_files': True,
+            'compressing_algorithm': 'gz',
+        })
+
+    def tearDown(self):
+        shutil.rmtree(self.cachedir)
+
+    def test_cache_results_updates_index(self):
+        manager = CacheManager(self.config)
+        assert len(manager.backend.index) == 0
+
+        manager.cache_results(DummyParser('<html>hello</html>'), 'hello', 'google', 'http', 1)
+
+        fname = manager.cached_file_name('hello', 'google', 'http', 1)
+        assert fname in manager.backend.index
+        assert manager.backend.index.get(fname).compression == 'gz'
+        assert manager.get_cached('hello', 'google', 'http', 1) == '<html>hello</html>'
+        assert manager.get_cached('hello', 'google', 'http', 2) is False
+
+    def test_index_snapshot(self):
+        manager = CacheManager(self.config)
+        manager.cache_results(DummyParser('<html>snap</html>'), 'snap', 'bing', 'http', 1)
+        manager.close()
+
+        index = CacheIndex(self.cachedir)
+        assert index._load_snapshot()
+        assert manager.cached_file_name('snap', 'bing', 'http', 1) in index
+
+        # a new file invalidates the snapshot
+        open(os.path.join(self.cachedir, 'foreign.cache'), 'w').close()
+        index = CacheIndex(self.cachedir)
+        assert not index._load_snapshot()
+        index.load()
+        assert 'foreign.cache' in index
+
+    def test_rewrite_invalidates_snapshot(self):
+        manager = CacheManager(self.config)
+        manager.cache_results(DummyParser('<html>snap</html>'), 'snap', 'bing', 'http', 1)
+        manager.close()
+
+        # another process rewrites the page in place, the directory mtime stays the same
+        other = CacheManager(self.config)
+        other.cache_results(DummyParser('<html>changed, and longer</html>'), 'snap', 'bing', 'http', 1)
+        assert not CacheIndex(self.cachedir)._load_snapshot()
+
+        other.close()
+        index = CacheIndex(self.cachedir)
+        assert index._load_snapshot()
+        assert index.get(manager.cached_file_name('snap', 'bing', 'http', 1)).size == \
+            other.backend.lookup(manager.cached_file_name('snap', 'bing', 'http', 1)).size
+
+    def test_stale_entries_are_ignored(self):
+        self.config['clean_cache_after'] = 1
+        manager = CacheManager(self.config)
+        manager.cache_results(DummyParser('<html>old</html>'), 'old', 'google', 'http', 1)
+
+        fname = manager.cached_file_name('old', 'google', 'http', 1)
+        manager.backend.index.add(fname, 'gz', mtime=1)
+        assert manager.get_cached('old', 'google', 'http', 1) is False
+
+    def test_packed_backend(self):
+        self.config['cache_backend'] = 'packed'
+        manager = CacheManager(self.config)
+        assert isinstance(manager.backend, PackedCacheBackend)
+
+        manager.cache_results(DummyParser('<html>first</html>'), 'packed', 'google', 'http', 1)
+        manager.cache_results(DummyParser('<html>second</html>'), 'packed', 'google', 'http', 2)
+        manager.cache_results(DummyParser('<html>again</html>'), 'packed', 'google', 'http', 1)
+        assert manager.get_cached('packed', 'google', 'http', 1) == '<html>again</html>'
+        manager.close()
+
+        # reopen without snapshot, the index is rebuilt from the segments
+        os.remove(manager.backend.snapshot_path)
+        manager = CacheManager(self.config)
+        assert len(manager.backend) == 2
+        assert manager.get_cached('packed', 'google', 'http', 2) == '<html>second</html>'
+
+        manager.backend.remove(manager.cached_file_name('packed', 'google', 'http', 2))
+        assert manager.get_cached('packed', 'google', 'http', 2) is False
+
+        assert manager.backend.compact() == 0
+        assert len(manager.backend.segments()) == 1
+        assert manager.get_cached('packed', 'google', 'http', 1) == '<html>again</html>'
+        manager.close()
+
+    def test_migrate_to_packed_backend(self):
+        files = CacheManager(self.config)
+        files.cache_results(DummyParser('<html>migrate</html>'), 'migrate', 'bing', 'http', 1)
+
+        self.config.update({'cache_backend': 'packed', 'cachedir': os.path.join(self.cachedir, 'new')})
+        packed = CacheManager(self.config)
+        assert packed.import_cache_directory(self.cachedir) == 1
+        assert packed.get_cached('migrate', 'bing', 'http', 1) == '<html>migrate</html>'
+
+    def test_dictionary_compression(self):
+        self.config.update({'compressing_algorithm': 'zdict', 'cache_dictionary_samples': 2})
+        manager = CacheManager(self.config)
+        page = '<html><div class="result">{}</div><div class="footer">imprint</div></html>'
+
+        for i in range(3):
+            manager.cache_results(DummyParser(page.format(i)), 'zdict', 'google', 'http', i)
+
+        # gzipped until the dictionary is trained
+        assert manager.backend.index.get(manager.cached_file_name('zdict', 'google', 'http', 0)).compression == 'gz'
+        assert manager.backend.index.get(manager.cached_file_name('zdict', 'google', 'http', 2)).compression == 'zdict'
+        assert manager.dictionaries.store.latest_version('google') == 1
+        manager.close()
+
+        manager = CacheManager(self.config)
+        for i in range(3):
+            assert manager.get_cached('zdict', 'google', 'http', i) == page.format(i)
+
+    def test_benchmark_compression(self):
+        pages = ['<html><p>{}</p><footer>same for all</footer></html>'.format(i).encode() for i in range(10)]
+        report = benchmark_compression(pages)
+        assert set(report) == {'gz', 'bz2', 'zdict'}
+        assert report['zdict']['ratio'] < report['gz']['ratio']
+
+    def test_parse_all_cached_files(self):
+        self.config['num_workers'] = 2
+        manager = CacheManager(self.config)
+        path = os.path.join(os.path.dirname(__file__), 'data/uncompressed_serp_pages/hello_bing_de_ip.html')
+        with open(path, 'r') as fd:
+            html = fd.read()
+
+        for page in (1, 2):
+            manager.cache_results(DummyParser(html), 'hello', 'bing', 'http', page)
+        manager.cache_results(DummyParser(html), 'world', 'bing', 'http', 1)
+
+        jobs = list(default_scrape_jobs_for_keywords(['hello', 'world'], ['bing'], 'http', 3))
+        session = get_session(self.config, path=':memory:')()
+        scraper_search = ScraperSearch()
+
+        remaining = manager.parse_all_cached_files(jobs, session, scraper_search)
+
+        assert sorted((job['query'], job['page_number']) for job in remaining) == \
+            [('hello', 3), ('world', 2), ('world', 3)]
+        serps = session.query(SearchEngineResultsPage).all()
+        assert len(serps) == 3
+        assert all(serp.links and serp.search_engine_name == 'bing' for serp in serps)
+        assert len(scraper_search.serps) == 3
+
+        # the next replay doesn't need to parse the pages again
+        assert manager.load_parse_result(manager.cached_file_name('world', 'bing', 'http', 1), 'bing')
+
+    def test_replay_cache_starts_janitor_first(self):
+        self.config.update({'max_cache_size': 1000, 'cache_janitor_interval': 60})
+        manager = CacheManager(self.config)
+        manager.cache_results(DummyParser('hello'), 'hello', 'bing', 'http', 1)
+
+        jobs = default_scrape_jobs_for_keywords(['hello', 'world'], ['bing'], 'http', 1)
+        session = get_session(self.config, path=':memory:')()
+        remaining = replay_cache(manager, jobs, 1, session, ScraperSearch())
+
+        assert next(remaining)['query'] == 'world'
+        assert manager.janitor and manager.writer
+        assert next(remaining, None) is None
+        manager.close()
+
+    def test_replayed_entries_are_pinned(self):
+        self.config.update({'compress_cached_files': False, 'max_cache_size': 150})
+        manager = CacheManager(self.config)
+        for page in range(1, 3):
+            manager.cache_results(DummyParser('x' * 100), 'pinned', 'google', 'http', page)
+        fname = manager.cached_file_name('pinned', 'google', 'http', 1)
+
+        # the janitor runs while the chunk is replayed
+        replay = manager._replay_cached_files
+        evicted = []
+
+        def evicting_replay(cached, session):
+            evicted.append(manager.evict())
+            yield from replay(cached, session)
+
+        manager._replay_cached_files = evicting_replay
+        jobs = list(default_scrape_jobs_for_keywords(['pinned'], ['google'], 'http', 1))
+        session = get_session(self.config, path=':memory:')()
+        assert manager.parse_all_cached_files(jobs, session, ScraperSearch()) == []
+
+        assert evicted == [1] and fname in manager.backend
+        assert manager.get_cached('pinned', 'google', 'http', 2) is False
+        assert not manager.pinned
+
+    def test_cached_parse_results(self):
+        manager = CacheManager(self.config)
+        path = os.path.join(os.path.dirname(__file__), 'data/uncompressed_serp_pages/hello_bing_de_ip.html')
+        with open(path, 'r') as fd:
+            parser = get_parser_by_search_engine('bing')(self.config, html=fd.read(), query='hello')
+
+        manager.cache_results(parser, 'hello', 'bing', 'http', 1)
+        fname = manager.cached_file_name('hello', 'bing', 'http', 1)
+        result = manager.load_parse_result(fname, 'bing')
+        assert result.num_results == parser.num_results
+        assert result.search_results['results'] == parser.search_results['results']
+
+        # the parse results are found when the cache directory is scanned again
+        manager.backend.index.scan()
+        assert manager.load_parse_result(fname, 'bing')
+
+        # another parser version invalidates the parse results
+        self.config['search_type'] = 'image'
+        assert manager.load_parse_result(fname, 'bing') is None
+
+    def test_evict_least_recently_used(self):
+        self.config.update({'compress_cached_files': False, 'max_cache_size': 250})
+        manager = CacheManager(self.config)
+        for page in range(1, 4):
+            manager.cache_results(DummyParser('x' * 100), 'evict', 'google', 'http', page)
+        assert manager.backend.size == 300
+
+        # page 1 is older but was just used
+        assert manager.get_cached('evict', 'google', 'http', 1)
+        assert manager.evict() == 1
+        assert manager.get_cached('evict', 'google', 'http', 2) is False
+        assert manager.get_cached('evict', 'google', 'http', 1)
+        assert manager.backend.size == 200
+        assert manager.stats['evictions'] == 1 and manager.stats['hits'] == 2 and manager.stats['misses'] == 1
+        assert manager.evict() == 0
+
+    def test_evict_sweeps_in_batches(self):
+        self.config.update({'compress_cached_files': False, 'max_cache_size': 250, 'cache_janitor_batch': 2})
+        manager = CacheManager(self.config)
+        for page in range(1, 7):
+            manager.cache_results(DummyParser('x' * 100), 'sweep', 'google', 'http', page)
+        assert manager.get_cached('sweep', 'google', 'http', 5) and manager.get_cached('sweep', 'google', 'http', 6)
+
+        # the candidates are listed once per sweep, not once per batch
+        names = manager.backend.names
+        calls = []
+        manager.backend.names = lambda: calls.append(1) or names()
+
+        assert manager.evict() == 4
+        assert len(calls) == 1
+        assert manager.backend.size == 200
+        assert [manager.get_cached('sweep', 'google', 'http', page) is not False for page in range(1, 7)] == \
+            [False, False, False, False, True, True]
+
+    def test_cache_janitor(self):
+        self.config.update({'cache_backend': 'packed', 'max_cache_size': 1000, 'cache_janitor_interval': 0.01})
+        manager = CacheManager(self.config)
+        manager.start_janitor()
+        for page in range(1, 30):
+            manager.cache_results(DummyParser(os.urandom(50).hex()), 'janitor', 'google', 'http', page)
+
+        deadline = time.time() + 5
+        while manager.backend.size > 1000 and time.time() < deadline:
+            time.sleep(0.01)
+        manager.close()
+
+        assert manager.janitor is None
+        assert manager.backend.size <= 1000
+        assert manager.stats['evictions'] > 0
+
+    def test_command_line_keeps_config_file(self):
+        path = os.path.join(self.cachedir, 'config.py')
+        with open(path, 'w') as fd:
+            fd.write('max_cache_size = 1000\ncache_backend = \'packed\'\n')
+
+        argv, sys.argv = sys.argv, ['SearchAnalyzer']
+        saved = dict(vars(scrape_config))
+        try:
+            config = get_config(get_command_line(), path)
+            assert config['max_cache_size'] == 1000 and config['cache_backend'] == 'packed'
+            assert get_config({'max_cache_size': 5}, path)['max_cache_size'] == 5
+        finally:
+            sys.argv = argv
+            for name in set(vars(scrape_config)) - set(saved):
+                delattr(scrape_config, name)
+            vars(scrape_config).update(saved)
+
+    def test_cache_writer(self):
+        manager = CacheManager(self.config)
+        manager.start_writer()
+        manager.cache_results(DummyParser('<html><script>var a;</script><p>queued</p></html>'), 'queued', 'google',
+                              'http', 1)
+        manager.flush()
+
+        html = manager.get_cached('queued', 'google', 'http', 1)
+        assert 'queued' in html and 'script' not in html
+        manager.close()
+        assert manager.writer is None
+
+    def test_cache_writer_drops_when_full(self):
+        self.config['minimize_caching_files'] = False
+        manager = CacheManager(self.config)
+        manager.writer = CacheWriter(manager, num_threads=1, queue_size=1, policy='drop')
+        manager.cache_results(DummyParser('<p>first</p>'), 'drop', 'google', 'http', 1)
+        manager.cache_results(DummyParser('<p>second</p>'), 'drop', 'google', 'http', 2)
+        assert manager.stats['dropped_writes'] == 1
+
+        # closing writes what is queued
+        manager.writer.start()
+        manager.close()
+        assert manager.get_cached('drop', 'google', 'http', 1) == '<p>first</p>'
+        assert manager.get_cached('drop', 'google', 'http', 2) is False
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter(1000, 0.01)
+        names = ['{:064x}.cache'.format(i) for i in range(1000)]
+        bloom.update(names)
+        assert all(name in bloom for name in names)
+
+        false_positives = sum('{:064x}.cache'.format(i) in bloom for i in range(1000, 11000))
+        assert false_positives < 300
+
+        copy = BloomFilter.from_bytes(bloom.to_bytes())
+        assert len(copy) == 1000 and all(name in copy for name in names)
+
+    def test_cache_filter(self):
+        manager = CacheManager(self.config)
+        manager.cache_results(DummyParser('<html>filter</html>'), 'filter', 'google', 'http', 1)
+        assert manager.might_be_cached(manager.cached_file_name('filter', 'google', 'http', 1))
+        manager.close()
+
+        manager = CacheManager(self.config)
+        assert len(manager.filter) == 1
+
+        # misses don't reach the backend
+        def lookup(name):
+            raise AssertionError('lookup of {}'.format(name))
+        manager.backend.lookup = lookup
+        assert manager.get_cached('filter', 'google', 'http', 2) is False
+        del manager.backend.lookup
+        assert manager.get_cached('filter', 'google', 'http', 1) == '<html>filter</html>'
+
+        # a filter saved for another state of the cache is rebuilt
+        manager.close()
+        with open(os.path.join(self.cachedir, 'foreign.cache'), 'w') as fd:
+            fd.write('foreign')
+        manager = CacheManager(self.config)
+        assert manager.might_be_cached('foreign.cache') and len(manager.filter) == 2
+
+
+if __name__ == '__main__':
+    unittest.main()
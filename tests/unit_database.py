@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from sqlalchemy import inspect
+
+from SearchAnalyzer.config import get_config
+from SearchAnalyzer.database import get_engine, sqlite_pragmas
+
+
+class DatabaseTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'test.db')
+        self.config = dict(get_config())
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def pragma(self, engine, name):
+        with engine.connect() as connection:
+            return connection.execute('PRAGMA {}'.format(name)).scalar()
+
+    def test_profiles(self):
+        # sqlite's durable defaults unless a profile is chosen
+        assert sqlite_pragmas(self.config) == {}
+
+        self.config.update(sqlite_profile='fast', sqlite_synchronous='OFF')
+        engine = get_engine(self.config, path=self.path)
+        assert self.pragma(engine, 'journal_mode') == 'wal'
+        # 0 is OFF, 1 NORMAL, 2 FULL
+        assert self.pragma(engine, 'synchronous') == 0
+        assert self.pragma(engine, 'cache_size') == -65536
+
+        self.config.update(sqlite_profile='default', sqlite_synchronous='')
+        assert sqlite_pragmas(self.config) == {}
+        with self.assertRaises(ValueError):
+            sqlite_pragmas(dict(self.config, sqlite_profile='turbo'))
+
+    def test_migrate_adds_indexes(self):
+        # a database of an older version without the indexes
+        get_engine(self.config, path=self.path)
+        connection = sqlite3.connect(self.path)
+        for name in ('ix_serp_lookup', 'ix_link_serp_id', 'ix_link_domain', 'ix_proxy_ip_port'):
+            connection.execute('DROP INDEX {}'.format(name))
+        connection.commit()
+        connection.close()
+
+        engine = get_engine(self.config, path=self.path)
+        inspector = inspect(engine)
+        assert {'ix_link_serp_id', 'ix_link_domain'} <= {index['name'] for index in inspector.get_indexes('link')}
+        assert 'ix_serp_lookup' in {index['name'] for index in inspector.get_indexes('serp')}
+        assert 'ix_proxy_ip_port' in {index['name'] for index in inspector.get_indexes('proxy')}
+
+
+if __name__ == '__main__':
+    unittest.main()
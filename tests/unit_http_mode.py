@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from SearchAnalyzer import scrape_config, scrape_with_config
+from SearchAnalyzer.database import ScrapeJob, SearchEngineResultsPage, get_session
+
+
+class CaptchaHandler(BaseHTTPRequestHandler):
+    """Answers every search with a captcha page and a 200."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests += 1
+        body = b'<html><body>Our systems have detected unusual traffic from your computer network.</body></html>'
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class HttpModeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # scrape_with_config() writes the config into the module, the other tests must not scrape into the tmpdir
+        self.scrape_config = dict(vars(scrape_config))
+        self.tmpdir = tempfile.mkdtemp()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), CaptchaHandler)
+        self.server.requests = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+        for name in set(vars(scrape_config)) - set(self.scrape_config):
+            delattr(scrape_config, name)
+        vars(scrape_config).update(self.scrape_config)
+
+    def scrape(self, port, **options):
+        config = {
+            'keyword': 'hello',
+            'search_engines': 'google',
+            'scrape_method': 'http',
+            'google_search_url': 'http://127.0.0.1:{}/search?'.format(port),
+            'database_name': os.path.join(self.tmpdir, 'results'),
+            'cachedir': os.path.join(self.tmpdir, 'cache'),
+            'do_caching': True,
+            'check_proxies': False,
+            'num_workers': 1,
+            'requests_per_minute': 0,
+            'google_requests_per_minute': 0,
+            'sleeping_ranges': {1: (0, 1)},
+            'print_results': 'summarize',
+        }
+        config.update(options)
+        scrape_with_config(config)
+        return config
+
+    def assert_nothing_stored(self, config):
+        session = get_session(config)()
+        assert session.query(SearchEngineResultsPage).count() == 0
+        # the job is scraped again when the scrape is resumed
+        assert [job.status for job in session.query(ScrapeJob)] == ['pending']
+        session.close()
+
+        cached = [name for _, _, names in os.walk(config['cachedir']) for name in names if '.cache' in name]
+        assert cached == []
+
+    def test_captcha_page_is_not_stored(self):
+        config = self.scrape(self.server.server_address[1])
+        assert self.server.requests >= 1
+        self.assert_nothing_stored(config)
+
+    def test_connection_error_is_not_stored(self):
+        # nothing listens on the port once the socket is closed
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+
+        config = self.scrape(port, max_consecutive_failures=1)
+        self.assert_nothing_stored(config)
+
+if __name__ == '__main__':
+    unittest.main()
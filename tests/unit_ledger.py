@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from SearchAnalyzer.config import get_config
+from SearchAnalyzer.database import ScraperSearch, SearchEngineResultsPage, get_session
+from SearchAnalyzer.persistence import get_persistence
+from SearchAnalyzer.scrape_jobs import default_scrape_jobs_for_keywords
+
+
+class JobLedgerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config = dict(get_config())
+        self.config['job_ledger_max_attempts'] = 2
+        self.session = get_session(self.config, path=os.path.join(self.tmpdir, 'test.db'))()
+        self.scraper_search = ScraperSearch(keyword_file='test')
+
+    def tearDown(self):
+        self.session.close()
+        shutil.rmtree(self.tmpdir)
+
+    def serp(self, query, page, status='successful'):
+        return SearchEngineResultsPage(query=query, search_engine_name='bing', scrape_method='http',
+                                       page_number=page, status=status)
+
+    def test_resume(self):
+        persistence = get_persistence(self.config, self.session, self.scraper_search)
+        ledger = persistence.ledger
+        jobs = list(default_scrape_jobs_for_keywords(['one', 'two'], ['bing'], 'http', 2))
+        ledger.register(jobs + jobs[:1])
+        assert len(ledger) == 4
+
+        persistence.put(self.serp('one', 1))
+        persistence.put(self.serp('one', 2, status='Connection timeout'))
+        assert persistence.flush(5)
+
+        assert ledger.counts() == {'done': 1, 'failed': 1, 'pending': 2}
+        assert [(job['query'], job['page_number']) for job in ledger.pending()] == \
+            [('one', 2), ('two', 1), ('two', 2)]
+
+        # failed too often
+        persistence.put(self.serp('one', 2, status='Connection timeout'))
+        # replayed from the cache
+        stored = self.serp('two', 1)
+        self.session.add(stored)
+        self.session.commit()
+        persistence.link(stored)
+        persistence.close()
+
+        assert [(job['query'], job['page_number']) for job in ledger.pending()] == [('two', 2)]
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+import csv
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from SearchAnalyzer.config import get_config
+from SearchAnalyzer.database import Link, ScrapeResults, ScraperSearch, SearchEngineResultsPage, get_session
+from SearchAnalyzer.parser.tools import get_parser_by_search_engine, parse_serp
+from SearchAnalyzer.persistence import SerpPersistence, csv_rows, get_persistence
+
+
+class FlakyPersistence(SerpPersistence):
+    """Fails to insert the first `failures` batches."""
+
+    failures = 1
+
+    def insert(self, serps, linked):
+        if self.failures:
+            self.failures -= 1
+            raise IOError('database is gone')
+        super().insert(serps, linked)
+
+
+class PersistenceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config = dict(get_config())
+        self.config['persistence_flush_interval'] = 10000
+        self.session = get_session(self.config, path=os.path.join(self.tmpdir, 'test.db'))()
+
+        path = os.path.join(os.path.dirname(__file__), 'data/uncompressed_serp_pages/hello_bing_de_ip.html')
+        with open(path, 'r') as fd:
+            self.parser = get_parser_by_search_engine('bing')(self.config, html=fd.read(), query='hello')
+
+    def tearDown(self):
+        self.session.close()
+        shutil.rmtree(self.tmpdir)
+
+    def serp(self, page):
+        serp = parse_serp(self.config, parser=self.parser, query='hello')
+        serp.search_engine_name = 'bing'
+        serp.page_number = page
+        return serp
+
+    def test_batches_and_flush(self):
+        # the first batch is written once the third SERP is queued
+        self.config['persistence_batch_size'] = 3 * (1 + len(self.serp(0).links))
+        scraper_search = ScraperSearch(keyword_file='test')
+        persistence = get_persistence(self.config, self.session, scraper_search)
+        assert scraper_search.id
+
+        acks = [persistence.put(self.serp(page)) for page in range(1, 4)]
+        assert all(ack.wait(5) for ack in acks)
+
+        persistence.put(self.serp(4))
+        assert persistence.flush(5)
+        persistence.close()
+
+        assert self.session.query(SearchEngineResultsPage).count() == 4
+        assert self.session.query(Link).count() == 4 * self.parser.num_results
+        self.session.expire_all()
+        assert sorted(serp.page_number for serp in scraper_search.serps) == [1, 2, 3, 4]
+        assert all(serp.requested_by == '127.0.0.1' for serp in scraper_search.serps)
+
+    def test_close_writes_pending(self):
+        persistence = get_persistence(self.config, self.session, ScraperSearch())
+        ack = persistence.put(self.serp(1))
+        persistence.close()
+        assert ack.wait(0)
+        assert self.session.query(SearchEngineResultsPage).count() == 1
+
+    def test_failed_batch_is_retried(self):
+        self.config['persistence_retry_delay'] = 0
+        persistence = FlakyPersistence(self.config, self.session.get_bind())
+        persistence.start()
+        assert persistence.put(self.serp(1)).wait(0) is False
+        assert persistence.flush(5)
+        persistence.close()
+        assert self.session.query(SearchEngineResultsPage).count() == 1
+
+    def test_failure_stops_the_scrape(self):
+        self.config.update({'persistence_retries': 1, 'persistence_retry_delay': 0})
+        persistence = FlakyPersistence(self.config, self.session.get_bind())
+        persistence.failures = 2
+        persistence.start()
+        ack = persistence.put(self.serp(1))
+        assert not persistence.flush(5)
+        assert not ack.wait(0) and isinstance(ack.error, IOError)
+
+        persistence.thread.join(5)
+        with self.assertRaises(IOError):
+            persistence.put(self.serp(2))
+        with self.assertRaises(IOError):
+            persistence.close()
+        assert self.session.query(SearchEngineResultsPage).count() == 0
+
+    def test_link_and_results(self):
+        first = get_persistence(self.config, self.session, ScraperSearch())
+        first.put(self.serp(1))
+        first.put(self.serp(2))
+        first.close()
+
+        # a later search replays the stored SERPs
+        scraper_search = ScraperSearch(keyword_file='again')
+        second = get_persistence(self.config, self.session, scraper_search)
+        for serp in self.session.query(SearchEngineResultsPage):
+            second.link(serp)
+        assert second.flush(5)
+        second.close()
+        assert second.num_linked == 2 and second.num_stored == 0
+
+        results = ScrapeResults(self.session, scraper_search.id)
+        assert results.keyword_file == 'again'
+        assert len(results.serps) == 2
+        assert [serp.page_number for serp in results.serps] == [1, 2]
+        assert results.serps[-1].page_number == 2
+        with self.assertRaises(IndexError):
+            results.serps[2]
+        assert results.links.count() == 2 * self.parser.num_results
+
+    def test_csv_rows(self):
+        rows = [{'title': 'a "quoted", title', 'rank': 1, 'domain': None}, {'title': '', 'rank': 2, 'domain': 'x.com'}]
+        lines = csv_rows(rows, ['title', 'rank', 'domain']).read().splitlines()
+        # NULL is unquoted, empty strings are quoted
+        assert lines == ['"a ""quoted"", title",1,', '"",2,"x.com"']
+        assert next(csv.reader(lines[:1])) == ['a "quoted", title', '1', '']
+
+    def test_database_url(self):
+        url = 'sqlite:///' + os.path.join(self.tmpdir, 'url.db')
+        session_cls = get_session(dict(self.config, database_url=url), scoped=True)
+        assert str(session_cls().get_bind().url) == url
+
+        # every thread has its own session
+        sessions = []
+        thread = threading.Thread(target=lambda: sessions.append(session_cls()))
+        thread.start()
+        thread.join()
+        assert sessions[0] is not session_cls()
+
+
+if __name__ == '__main__':
+    unittest.main()
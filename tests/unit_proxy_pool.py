@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from sqlalchemy import create_engine
+
+from SearchAnalyzer.database import SearchEngineProxyStatus, get_engine, get_session
+from SearchAnalyzer.proxies import Proxy, add_proxies_to_db
+from SearchAnalyzer.proxy_pool import ProxyPool, proxy_name
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000000.0
+
+    def __call__(self):
+        return self.now
+
+
+class ProxyPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config = {'proxy_detected_timeout': 100, 'proxy_max_quarantine_time': 300, 'proxy_max_failures': 2}
+        self.clock = Clock()
+        self.first = Proxy(proto='socks5', host='10.0.0.1', port='1080', username='', password='')
+        self.second = Proxy(proto='socks5', host='10.0.0.2', port='1080', username='', password='')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_best_proxy(self):
+        pool = ProxyPool(self.config, [self.first, self.second], clock=self.clock)
+
+        # untried proxies are tried first and the requests spread over them
+        assert pool.acquire('bing') == self.first
+        assert pool.acquire('bing') == self.second
+        pool.release(self.first, 'bing', True, latency=2.0)
+        pool.release(self.second, 'bing', True, latency=0.5)
+        assert pool.acquire('bing') == self.second
+        assert pool.acquire('bing') == self.first
+        pool.release(self.second, 'bing', False)
+        pool.release(self.first, 'bing', True, latency=2.0)
+        # one failure doesn't cost the much faster proxy its lead
+        assert pool.acquire('bing') == self.second
+        pool.release(self.second, 'bing', False)
+        # but the second failure in a row quarantines it
+        assert pool.acquire('bing') == self.first
+
+        # the health is tracked per search engine
+        assert pool.acquire('google') == self.first
+
+    def test_quarantine_backoff(self):
+        pool = ProxyPool(self.config, [self.first, self.second], clock=self.clock)
+
+        for quarantine in (100, 200, 300, 300):
+            assert pool.acquire('bing') == self.first
+            pool.release(self.first, 'bing', False, latency=0.1, blocked=True)
+            assert pool.acquire('bing') == self.second
+            pool.release(self.second, 'bing', True, latency=3)
+
+            self.clock.now += quarantine - 1
+            assert pool.acquire('bing') == self.second
+            pool.release(self.second, 'bing', True, latency=3)
+            self.clock.now += 1
+
+        # a successful request resets the backoff
+        assert pool.acquire('bing') == self.first
+        pool.release(self.first, 'bing', True, latency=0.1)
+        pool.acquire('bing')
+        pool.release(self.first, 'bing', False, blocked=True)
+        assert pool.healths('bing')[self.first].quarantined_until == self.clock.now + 100
+
+        # failures in a row quarantine a proxy too
+        pool.acquire('google')
+        pool.release(self.first, 'google', False)
+        assert pool.acquire('google') == self.second
+        pool.release(self.second, 'google', False)
+        pool.acquire('google')
+        pool.release(self.second, 'google', False)
+        assert pool.acquire('google') == self.first
+
+    def test_stored_health(self):
+        path = os.path.join(self.tmpdir, 'test.db')
+        session = get_session({}, path=path)()
+        add_proxies_to_db([self.first, self.second], session)
+
+        pool = ProxyPool(self.config, [self.first, self.second, None], engine=session.get_bind(), clock=self.clock)
+        pool.acquire('bing')
+        pool.release(self.first, 'bing', False, latency=0.2, blocked=True)
+        pool.acquire('bing')
+        pool.release(self.second, 'bing', True, latency=0.4)
+        pool.acquire('bing')
+        pool.release(None, 'bing', True, latency=0.1)
+        pool.close()
+
+        statuses = {status.proxy_id: status for status in session.query(SearchEngineProxyStatus)}
+        assert len(statuses) == 2
+        assert statuses[pool.proxy_ids[self.first]].num_bans == 1
+        assert not statuses[pool.proxy_ids[self.first]].available
+        assert statuses[pool.proxy_ids[self.second]].latency == 0.4
+
+        # the next run knows the ban
+        pool = ProxyPool(self.config, [self.first, self.second], engine=session.get_bind(), clock=self.clock)
+        health = pool.healths('bing')[self.first]
+        assert health.num_bans == 1 and health.backoff == 1
+        assert abs(health.quarantined_until - (self.clock.now + 100)) < 1e-3
+        assert pool.acquire('bing') == self.second
+        session.close()
+
+    def test_failed_flush_keeps_changes(self):
+        session = get_session({}, path=os.path.join(self.tmpdir, 'test.db'))()
+        add_proxies_to_db([self.first, self.second], session)
+        pool = ProxyPool(self.config, [self.first, self.second], engine=session.get_bind(), clock=self.clock)
+        pool.acquire('bing')
+        pool.release(self.first, 'bing', True, latency=0.2)
+
+        session.get_bind().execute('DROP TABLE search_engine_proxy_status')
+        pool.flush()
+        assert pool.healths('bing')[self.first].dirty
+        session.close()
+
+    def test_proxy_name(self):
+        assert proxy_name(self.first) == '10.0.0.1:1080'
+        assert proxy_name(self.first._replace(port=1080)) == '10.0.0.1:1080'
+        assert proxy_name(None) == 'localhost'
+
+    def test_migrate_adds_columns(self):
+        path = os.path.join(self.tmpdir, 'old.db')
+        old = create_engine('sqlite:///' + path)
+        old.execute('CREATE TABLE search_engine_proxy_status (id INTEGER PRIMARY KEY, proxy_id INTEGER, '
+                    'search_engine_id INTEGER, available BOOLEAN, last_check DATETIME)')
+        old.execute('INSERT INTO search_engine_proxy_status (proxy_id, search_engine_id) VALUES (1, 1)')
+        old.dispose()
+
+        session = get_session({}, engine=get_engine({}, path=path))()
+        status = session.query(SearchEngineProxyStatus).one()
+        assert status.proxy_id == 1 and status.num_bans is None
+        session.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
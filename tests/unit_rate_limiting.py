@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import unittest
+
+from SearchAnalyzer.config import get_config
+from SearchAnalyzer.rate_limiting import RateLimiter, TokenBucket
+from SearchAnalyzer.scraping import detect_block
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class RateLimitingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.config = {'requests_per_minute': 60, 'rate_limit_burst': 2, 'rate_limit_jitter': 0,
+                       'google_requests_per_minute': 30, 'bing_requests_per_minute': 0}
+
+    def test_bucket(self):
+        bucket = TokenBucket(1, 2, clock=self.clock)
+        # the burst, then the reservations queue up
+        assert [bucket.reserve() for _ in range(4)] == [0, 0, 1, 2]
+
+        # the reservations are paid back first
+        self.clock.now = 3
+        assert bucket.reserve() == 0
+        # an idle bucket fills up to the burst only
+        self.clock.now = 100
+        assert [bucket.reserve() for _ in range(3)] == [0, 0, 1]
+
+    def test_limiter_keys(self):
+        limiter = RateLimiter(self.config, clock=self.clock)
+        assert [limiter.reserve('yahoo', 'localhost') for _ in range(3)] == [0, 0, 1]
+        # another proxy and another search engine have their own buckets
+        assert limiter.reserve('yahoo', '10.0.0.1:8080') == 0
+        assert [limiter.reserve('google', 'localhost') for _ in range(3)] == [0, 0, 2]
+        # not rate limited
+        assert limiter.reserve('bing', 'localhost') is None
+
+    def test_off_by_default(self):
+        limiter = RateLimiter({}, clock=self.clock)
+        assert limiter.reserve('google', 'localhost') is None
+        assert RateLimiter(get_config()).reserve('google', 'localhost') is None
+
+    def test_jitter(self):
+        limiter = RateLimiter(dict(self.config, rate_limit_jitter=0.5), clock=self.clock)
+        delays = [limiter.reserve('yahoo', 'localhost') for _ in range(3)]
+        assert all(0 <= delay <= 0.5 for delay in delays[:2]) and 1 <= delays[2] <= 1.5
+
+    def test_wait_async(self):
+        limiter = RateLimiter(dict(self.config, requests_per_minute=6000, rate_limit_burst=1))
+
+        async def wait():
+            return await asyncio.gather(*[limiter.wait_async('yahoo', 'localhost') for _ in range(3)])
+
+        delays = asyncio.run(wait())
+        assert delays[0] == 0 and 0 < delays[1] < delays[2] <= 0.03
+
+    def test_aimd(self):
+        limiter = RateLimiter(dict(self.config, rate_limit_increase=6, max_requests_per_minute=62,
+                                   min_requests_per_minute=10), clock=self.clock)
+        limiter.reserve('yahoo', 'localhost')
+
+        # about a minute of clean responses adds 6 requests per minute
+        for _ in range(60):
+            limiter.feedback('yahoo', 'localhost', False)
+        self.assertAlmostEqual(limiter.rates()[('yahoo', 'localhost')], 62)
+
+        limiter.feedback('yahoo', 'localhost', True)
+        self.assertAlmostEqual(limiter.rates()[('yahoo', 'localhost')], 31)
+        # no burst after a block
+        self.assertAlmostEqual(limiter.reserve('yahoo', 'localhost'), 60 / 31)
+        for _ in range(3):
+            limiter.feedback('yahoo', 'localhost', True)
+        self.assertAlmostEqual(limiter.rates()[('yahoo', 'localhost')], 10)
+        # other proxies keep their rate
+        limiter.feedback('yahoo', '10.0.0.1:8080', False)
+        assert 60 < limiter.rates()[('yahoo', '10.0.0.1:8080')] < 60.2
+
+        fixed = RateLimiter(dict(self.config, adaptive_rate_limit=False), clock=self.clock)
+        fixed.feedback('yahoo', 'localhost', True)
+        assert fixed.rates() == {}
+
+    def test_detect_block(self):
+        assert detect_block('bing', 429)
+        assert not detect_block('bing', 200, 'https://www.bing.com/search?q=sorry', 'detected unusual traffic')
+        assert detect_block('google', 200, 'https://www.google.com/sorry/index?continue=')
+        assert detect_block('google', 200, 'https://www.google.com/search', '<p>Our systems have detected unusual traffic')
+        assert not detect_block('google', 200, 'https://www.google.com/search', '<html>results</html>')
+
+
+if __name__ == '__main__':
+    unittest.main()
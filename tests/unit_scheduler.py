@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+import unittest
+
+from SearchAnalyzer.scheduler import JobScheduler, group_jobs
+from SearchAnalyzer.scrape_jobs import default_scrape_jobs_for_keywords
+
+
+class JobSchedulerTestCase(unittest.TestCase):
+
+    def jobs(self, num_keywords, pages=1):
+        keywords = ['kw{}'.format(i) for i in range(num_keywords)]
+        return default_scrape_jobs_for_keywords(keywords, ['bing'], 'http', pages)
+
+    def test_group_jobs(self):
+        items = list(group_jobs(self.jobs(2, pages=3)))
+        assert [(item['query'], item['pages']) for item in items] == [('kw0', [1, 2, 3]), ('kw1', [1, 2, 3])]
+
+    def test_fast_worker_takes_more(self):
+        scheduler = JobScheduler({'scheduler_queue_size': 2})
+        done = {'slow': [], 'fast': []}
+
+        def work(name, delay):
+            stream = scheduler.stream('bing', 'http')
+            for query, pages in stream.items():
+                time.sleep(delay)
+                done[name].append(query)
+            stream.close()
+
+        threads = [threading.Thread(target=work, args=('slow', 0.05)), threading.Thread(target=work, args=('fast', 0))]
+        for thread in threads:
+            thread.start()
+        assert scheduler.feed(self.jobs(20)) == 20
+        scheduler.close()
+        for thread in threads:
+            thread.join(5)
+
+        assert sorted(done['slow'] + done['fast']) == sorted('kw{}'.format(i) for i in range(20))
+        assert len(done['fast']) > len(done['slow'])
+
+    def test_stream_counts_fed_jobs(self):
+        scheduler = JobScheduler({})
+        stream = scheduler.stream('bing', 'http')
+        assert stream and len(stream) == 0
+
+        scheduler.feed(self.jobs(3, pages=2))
+        assert len(stream) == 6 and scheduler.num_jobs == 6
+        scheduler.close()
+        assert stream
+
+        assert len(list(stream.items())) == 3
+        assert not stream
+        stream.close()
+
+    def test_banned_worker_requeues(self):
+        scheduler = JobScheduler({'scheduler_max_attempts': 3})
+        banned = scheduler.stream('bing', 'http')
+        healthy = scheduler.stream('bing', 'http')
+        scheduler.feed(self.jobs(2, pages=2))
+        scheduler.close()
+
+        # the banned worker gives up its first keyword and stops
+        for query, pages in banned.items():
+            assert banned.retry(pages)
+            break
+        banned.close()
+
+        scraped = [(query, pages) for query, pages in healthy.items()]
+        assert scraped == [('kw0', [1, 2]), ('kw1', [1, 2])]
+        healthy.close()
+
+        assert len(healthy) == 4 and not healthy
+
+        # jobs for search engines without workers are dropped
+        assert scheduler.feed(self.jobs(1)) == 0 and scheduler.num_dropped == 1
+
+
+if __name__ == '__main__':
+    unittest.main()
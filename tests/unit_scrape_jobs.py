@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from SearchAnalyzer.scrape_jobs import KeywordSet, read_keywords
+from SearchAnalyzer.utils import chunked
+
+
+class KeywordStreamTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_read_keywords(self):
+        path = os.path.join(self.tmpdir, 'keywords.txt')
+        with open(path, 'w') as fd:
+            fd.write('one\n\n  two \nthree')
+        assert list(read_keywords(path)) == ['one', 'two', 'three']
+
+    def test_chunked(self):
+        assert list(chunked(iter(range(5)), 2)) == [[0, 1], [2, 3], [4]]
+        assert list(chunked([], 2)) == []
+
+    def test_unique(self):
+        keywords = ['kw{}'.format(i % 30) for i in range(100)]
+        keyword_set = KeywordSet(max_memory=10, chunk_size=7)
+        unique = list(keyword_set.unique(iter(keywords)))
+
+        assert unique == ['kw{}'.format(i) for i in range(30)]
+        assert keyword_set.count == 30
+        # the hashes were moved to disk
+        assert keyword_set.db is not None and not keyword_set.hashes
+        path = keyword_set.path
+        keyword_set.close()
+        assert not os.path.exists(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import shutil
+import socket
+import socketserver
+import ssl
+import struct
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from SearchAnalyzer.database import Proxy as db_Proxy, get_session
+from SearchAnalyzer.proxies import Proxy, add_proxies_to_db, check_proxies, proxy_report
+from SearchAnalyzer.transport import get_http_session, stats_info
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = self.client_address[0].encode()
+        if self.path == '/json':
+            body = json.dumps({'ip': self.client_address[0], 'city': 'Testville'}).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Socks5Handler(socketserver.BaseRequestHandler):
+    """A SOCKS5 proxy without authentication that only supports CONNECT."""
+
+    def handle(self):
+        conn = self.request
+        conn.recv(3)
+        conn.sendall(b'\x05\x00')
+        _, _, _, atyp = conn.recv(4)
+        if atyp == 3:
+            host = conn.recv(conn.recv(1)[0]).decode()
+        else:
+            host = socket.inet_ntoa(conn.recv(4))
+        port, = struct.unpack('>H', conn.recv(2))
+        self.server.connections.append((host, port))
+
+        upstream = socket.create_connection((host, port))
+        conn.sendall(b'\x05\x00\x00\x01' + socket.inet_aton('127.0.0.1') + struct.pack('>H', 0))
+
+        def pipe(source, target):
+            try:
+                while True:
+                    data = source.recv(65536)
+                    if not data:
+                        break
+                    target.sendall(data)
+            except OSError:
+                pass
+            finally:
+                target.close()
+
+        threading.Thread(target=pipe, args=(upstream, conn), daemon=True).start()
+        pipe(conn, upstream)
+
+
+class Socks5Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), Socks5Handler)
+        self.connections = []
+
+
+class TransportTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = [ThreadingHTTPServer(('127.0.0.1', 0), Handler), Socks5Server(), Socks5Server()]
+        for server in self.servers:
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.url = 'http://localhost:{}/'.format(self.servers[0].server_address[1])
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def test_every_session_uses_its_proxy(self):
+        proxies = [Proxy('socks5', '127.0.0.1', str(server.server_address[1]), '', '') for server in self.servers[1:]]
+        sessions = [get_http_session(proxy) for proxy in proxies]
+
+        threads = [threading.Thread(target=lambda s=session: [s.get(self.url) for _ in range(3)]) for session in sessions]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        for session in sessions:
+            session.close()
+
+        # the host name is resolved by the proxy, the connections are kept alive
+        for server in self.servers[1:]:
+            assert server.connections == [('localhost', self.servers[0].server_address[1])]
+
+        # the socket module is untouched
+        assert socket.socket.__module__ == 'socket'
+        assert get_http_session().get(self.url).text == '127.0.0.1'
+
+    def test_connections_are_reused(self):
+        session = get_http_session(config={'http_idle_timeout': 0.2})
+        for _ in range(3):
+            session.get(self.url)
+        assert session.stats['requests'] == 3 and session.stats['connections'] == 1
+
+        # the idle connection is dropped before the next request
+        time.sleep(0.3)
+        session.get(self.url)
+        assert session.stats['requests'] == 4 and session.stats['connections'] == 2
+        assert '2 new and 2 reused connections' in stats_info(session.stats)
+        session.close()
+
+    def test_proxy_connections_are_counted(self):
+        proxy = Proxy('socks5', '127.0.0.1', str(self.servers[1].server_address[1]), '', '')
+        session = get_http_session(proxy)
+        for _ in range(2):
+            assert session.get(self.url).text == '127.0.0.1'
+        assert session.stats['requests'] == 2 and session.stats['connections'] == 1
+
+        # a new pool of the same session counts in the same stats
+        session.get(self.url.replace('localhost', '127.0.0.1'))
+        assert session.stats['connections'] == 2
+        assert len(self.servers[1].connections) == 2
+        session.close()
+
+    def tls_server(self):
+        """Start a https server with a certificate for localhost.
+
+        Returns:
+            The port and the path of the certificate.
+        """
+        tls = os.path.join(os.path.dirname(__file__), 'data/tls')
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(os.path.join(tls, 'localhost.crt'), os.path.join(tls, 'localhost.key'))
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.servers.append(server)
+        return server.server_address[1], os.path.join(tls, 'localhost.crt')
+
+    def test_tls_sessions_are_resumed(self):
+        port, cert = self.tls_server()
+        url = 'https://localhost:{}/'.format(port)
+        session = get_http_session(config={'http_idle_timeout': 0.2})
+        for _ in range(2):
+            for _ in range(2):
+                session.get(url, verify=cert)
+            time.sleep(0.3)
+
+        assert session.stats['connections'] == 2
+        assert session.stats['tls_handshakes'] == 2 and session.stats['tls_resumed'] == 1
+        session.close()
+
+    def test_tls_host_name_is_checked(self):
+        port, cert = self.tls_server()
+        proxy = Proxy('socks5', '127.0.0.1', str(self.servers[1].server_address[1]), '', '')
+
+        for session in (get_http_session(), get_http_session(proxy)):
+            assert session.get('https://localhost:{}/'.format(port), verify=cert).status_code == 200
+            # the certificate is for localhost only
+            with self.assertRaises(requests.exceptions.SSLError):
+                session.get('https://127.0.0.1:{}/'.format(port), verify=cert)
+
+            # not even after a request that didn't verify the certificate
+            assert session.get('https://127.0.0.1:{}/'.format(port), verify=False).status_code == 200
+            session.close()
+            with self.assertRaises(requests.exceptions.SSLError):
+                session.get('https://127.0.0.1:{}/'.format(port), verify=cert)
+            session.close()
+
+    def test_check_proxies(self):
+        live = Proxy('socks5', '127.0.0.1', str(self.servers[1].server_address[1]), '', '')
+        # nothing listens there
+        dead = Proxy('socks5', '127.0.0.2', str(self.servers[1].server_address[1]), '', '')
+        unsupported = Proxy('ftp', '127.0.0.3', '21', '', '')
+        # another proxy on the same host that isn't checked
+        neighbour = Proxy('socks5', '127.0.0.1', '9', '', '')
+
+        tmpdir = tempfile.mkdtemp()
+        session = get_session({}, path=os.path.join(tmpdir, 'test.db'))()
+        add_proxies_to_db([live, dead, neighbour], session)
+
+        config = {'proxy_info_url': self.url + 'json', 'proxy_check_timeout': 2}
+        checks = check_proxies(config, [None, live, dead, unsupported], engine=session.get_bind())
+        assert [check.proxy for check in checks] == [live, dead, unsupported]
+        assert [check.online for check in checks] == [True, False, False]
+        assert checks[0].ipinfo['ip'] == '127.0.0.1' and checks[0].latency < 2
+        assert 'Unsupported proxy protocol' in checks[2].status
+
+        stored = {(proxy.ip, str(proxy.port)): proxy for proxy in session.query(db_Proxy)}
+        assert stored[live[1:3]].online and stored[live[1:3]].city == 'Testville'
+        assert not stored[dead[1:3]].online and stored[dead[1:3]].checked_at
+        assert stored[neighbour[1:3]].checked_at is None
+        session.close()
+        shutil.rmtree(tmpdir)
+
+        report = proxy_report(checks).splitlines()
+        assert report[0].startswith('online') and 'Testville' in report[0]
+        assert report[-1] == '1 of 3 proxies are online.'
+
+    def test_unsupported_proxy(self):
+        with self.assertRaises(ValueError):
+            get_http_session(Proxy('ftp', '127.0.0.1', '21', '', ''))
+
+
+if __name__ == '__main__':
+    unittest.main()